@@ -0,0 +1,175 @@
+"""In-process cache of chat session documents and their most recent messages.
+
+Active sessions send bursts of messages, and every turn needs the session
+document and the tail of its history. Keeping both here turns those reads
+into dictionary lookups; writes go through the cache so it never lags behind
+this worker's own inserts.
+"""
+import asyncio
+import os
+
+from cachetools import TTLCache
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '1024'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '300'))
+# Number of most recent messages kept per session
+SESSION_CACHE_TAIL = int(os.environ.get('SESSION_CACHE_TAIL', '50'))
+
+
+class _CountingTTLCache(TTLCache):
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self.evictions = 0
+        self.expirations = 0
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        self.expirations += len(expired)
+        return expired
+
+
+class _Entry:
+    __slots__ = ("session", "tail", "complete", "version")
+
+    def __init__(self):
+        self.session = None
+        # Newest messages in ascending order, or None until loaded
+        self.tail = None
+        # True when the tail holds the session's entire history
+        self.complete = False
+        # Bumped on every write so in-flight loads can detect they are stale
+        self.version = 0
+
+
+def _strip_id(doc):
+    return {key: value for key, value in doc.items() if key != "_id"}
+
+
+class SessionCache:
+    """LRU cache with a TTL, keyed by session id.
+
+    Cached documents are stored in their Mongo form and are shared between
+    requests, so callers must treat them as read-only.
+    """
+
+    def __init__(self, maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL, tail_size=SESSION_CACHE_TAIL):
+        self.tail_size = tail_size
+        self._entries = _CountingTTLCache(maxsize, ttl)
+        self._locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, session_id):
+        entry = self._entries.get(session_id)
+        if entry is None:
+            entry = self._entries[session_id] = _Entry()
+        return entry
+
+    async def _load(self, session_id, read, loader, store):
+        # Single-flight: concurrent misses for one session share a Mongo read
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        try:
+            async with lock:
+                entry = self._entry(session_id)
+                value = read(entry)
+                if value is not None:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+                version = entry.version
+                value = await loader()
+                if self._entries.get(session_id) is entry and entry.version == version:
+                    store(entry, value)
+                return value
+        finally:
+            if not lock.locked():
+                self._locks.pop(session_id, None)
+
+    def _read_session(self, entry):
+        return entry.session
+
+    def _read_tail(self, entry):
+        return None if entry.tail is None else (entry.tail, entry.complete)
+
+    async def get_session(self, db, session_id):
+        entry = self._entries.get(session_id)
+        if entry is not None and entry.session is not None:
+            self.hits += 1
+            return entry.session
+
+        async def loader():
+            # Tombstoned sessions are as good as gone
+            return await db.chat_sessions.find_one({"id": session_id, "deleted_at": None}, {"_id": 0})
+
+        def store(entry, doc):
+            entry.session = doc
+
+        return await self._load(session_id, self._read_session, loader, store)
+
+    async def get_tail(self, db, session_id):
+        """Return up to ``tail_size`` newest messages and whether that is all of them."""
+        entry = self._entries.get(session_id)
+        if entry is not None and entry.tail is not None:
+            self.hits += 1
+            return entry.tail, entry.complete
+
+        limit = self.tail_size
+
+        async def loader():
+            docs = await db.chat_messages.find(
+                {"session_id": session_id}, {"_id": 0}
+            ).sort([("timestamp", -1), ("id", -1)]).limit(limit).to_list(limit)
+            docs.reverse()
+            return docs, len(docs) < limit
+
+        def store(entry, value):
+            entry.tail, entry.complete = value
+
+        return await self._load(session_id, self._read_tail, loader, store)
+
+    def put_session(self, session_doc):
+        entry = self._entry(session_doc["id"])
+        entry.session = _strip_id(session_doc)
+        entry.tail = []
+        entry.complete = True
+        entry.version += 1
+
+    def update_session(self, session_id, fields):
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return
+        entry.version += 1
+        if entry.session is not None:
+            entry.session = {**entry.session, **fields}
+
+    def append_messages(self, session_id, docs):
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return
+        entry.version += 1
+        if entry.tail is not None:
+            tail = entry.tail + [_strip_id(doc) for doc in docs]
+            if len(tail) > self.tail_size:
+                tail = tail[-self.tail_size:]
+                entry.complete = False
+            entry.tail = tail
+
+    def invalidate(self, session_id):
+        self._entries.pop(session_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self._entries.evictions,
+            "expirations": self._entries.expirations,
+        }
@@ -0,0 +1,110 @@
+"""Cross-worker invalidation for the in-process session cache.
+
+Each worker keeps its own ``SessionCache``, so when several uvicorn workers
+serve one database a turn written by one worker would leave the others with
+a stale tail. Every write therefore publishes the session id to a small
+capped collection, and each worker tails it and drops the sessions changed
+by its peers. A capped collection with a tailable cursor works on a
+standalone mongod, unlike change streams, which need a replica set.
+
+Any other process serving the same database, whether another worker on this
+host or a server elsewhere, is a peer. Nothing a process can observe tells
+it whether it is alone, so the bus is on unless ``SHARED_DATABASE=false``
+says so; only a single process serving its own database should set that.
+
+A peer may serve a stale tail for the few milliseconds until it sees the
+notice. With ``PERSIST_WRITE_BEHIND`` the notice can also arrive before the
+queued turn is flushed, so peers may briefly miss the newest turn.
+"""
+import asyncio
+import logging
+import os
+import uuid
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+# Whether other processes serve the same database
+SHARED_DATABASE = os.environ.get('SHARED_DATABASE', 'true').lower() == 'true'
+CACHE_BUS_ENABLED = os.environ.get('CACHE_BUS_ENABLED', str(SHARED_DATABASE)).lower() == 'true'
+CACHE_BUS_COLLECTION = os.environ.get('CACHE_BUS_COLLECTION', 'cache_invalidations')
+CACHE_BUS_SIZE_BYTES = int(os.environ.get('CACHE_BUS_SIZE_BYTES', str(4 * 1024 * 1024)))
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBus:
+    def __init__(self, cache, enabled=CACHE_BUS_ENABLED, collection=CACHE_BUS_COLLECTION,
+                 size_bytes=CACHE_BUS_SIZE_BYTES):
+        self.cache = cache
+        self.enabled = enabled
+        self.collection = collection
+        self.size_bytes = size_bytes
+        self.worker_id = uuid.uuid4().hex
+        self._task = None
+        self.published = 0
+        self.received = 0
+
+    async def start(self, db):
+        if not self.enabled or self._task is not None:
+            return
+        try:
+            await db.create_collection(self.collection, capped=True, size=self.size_bytes)
+        except CollectionInvalid:
+            # Already created by another worker
+            pass
+        except Exception as e:
+            logger.warning(f"Cache bus disabled, cannot create capped collection: {str(e)}")
+            self.enabled = False
+            return
+        self._task = asyncio.create_task(self._tail(db))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def publish(self, db, session_ids):
+        if not self.enabled:
+            return
+        self.published += len(session_ids)
+        await db[self.collection].insert_many(
+            [{"session_id": session_id, "worker": self.worker_id} for session_id in session_ids]
+        )
+
+    async def _tail(self, db):
+        while True:
+            # ObjectIds from different workers are not ordered, so instead of
+            # resuming by _id, drop the cache and skip everything up to a
+            # fresh marker. The marker also keeps the collection non-empty,
+            # which a tailable cursor needs to stay open.
+            marker = uuid.uuid4().hex
+            try:
+                await db[self.collection].insert_one(
+                    {"session_id": None, "worker": self.worker_id, "marker": marker}
+                )
+                self.cache.clear()
+                cursor = db[self.collection].find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+                caught_up = False
+                while cursor.alive:
+                    async for notice in cursor:
+                        if not caught_up:
+                            caught_up = notice.get("marker") == marker
+                        elif notice["worker"] != self.worker_id and notice["session_id"] is not None:
+                            self.cache.invalidate(notice["session_id"])
+                            self.received += 1
+                    # Nothing new within the await window; poll again shortly
+                    await asyncio.sleep(0.1)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cache bus tail interrupted: {str(e)}")
+                await asyncio.sleep(1)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "published": self.published,
+            "received": self.received,
+        }
@@ -0,0 +1,261 @@
+"""Background compaction of long chat sessions.
+
+Sessions whose hot history passes ``COMPACTION_MESSAGE_THRESHOLD`` messages
+or ``COMPACTION_TOKEN_THRESHOLD`` tokens have their older turns folded, by
+the LLM, into a rolling summary stored on the session (``summary``, up to
+``summary_until``). The newest ``COMPACTION_KEEP_MESSAGES`` messages, and
+any younger than ``COMPACTION_MIN_AGE``, always stay as they are.
+
+What happens to the summarized raw messages is ``COMPACTION_RETENTION``:
+``archive`` (the default) moves them to ``chat_messages_archive``, where
+history paging can still reach them; ``delete`` drops them; ``keep`` leaves
+them in place and only adds the summary. Either way prompts are built from
+the summary plus a bounded tail.
+
+Each pass only looks at sessions updated since the previous one, plus those
+flagged ``compaction_pending`` because a pass left them over threshold
+(their messages too young yet, or more than one batch to fold in). It takes
+a short lease on a session before compacting it, so several workers never
+summarize the same session at once.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+from context import estimate_tokens
+
+COMPACTION_ENABLED = os.environ.get('COMPACTION_ENABLED', 'true').lower() == 'true'
+COMPACTION_INTERVAL = float(os.environ.get('COMPACTION_INTERVAL', '600'))
+COMPACTION_MESSAGE_THRESHOLD = int(os.environ.get('COMPACTION_MESSAGE_THRESHOLD', '300'))
+COMPACTION_TOKEN_THRESHOLD = int(os.environ.get('COMPACTION_TOKEN_THRESHOLD', '30000'))
+COMPACTION_KEEP_MESSAGES = int(os.environ.get('COMPACTION_KEEP_MESSAGES', '100'))
+COMPACTION_MIN_AGE = float(os.environ.get('COMPACTION_MIN_AGE', '3600'))
+# Upper bound on transcript tokens folded into the summary per LLM call
+COMPACTION_INPUT_TOKENS = int(os.environ.get('COMPACTION_INPUT_TOKENS', '8000'))
+COMPACTION_SUMMARY_WORDS = int(os.environ.get('COMPACTION_SUMMARY_WORDS', '250'))
+COMPACTION_RETENTION = os.environ.get('COMPACTION_RETENTION', 'archive')
+COMPACTION_LEASE = float(os.environ.get('COMPACTION_LEASE', '300'))
+# Messages moved to the archive (or deleted) per round trip
+COMPACTION_BATCH_SIZE = int(os.environ.get('COMPACTION_BATCH_SIZE', '500'))
+
+ARCHIVE_COLLECTION = "chat_messages_archive"
+DUPLICATE_KEY = 11000
+
+SUMMARY_INSTRUCTIONS = (
+    "You keep a running summary of a conversation between a user and Mira, their AI "
+    "companion. Update the summary with the new messages. Keep names, facts about the "
+    "user, their preferences, plans, ongoing topics and how they were feeling; drop small "
+    "talk. Write in the third person, in at most {words} words, and reply with the "
+    "summary only."
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _after(doc):
+    """Query for messages strictly after ``doc`` in (timestamp, id) order."""
+    return {"$or": [
+        {"timestamp": {"$gt": doc["timestamp"]}},
+        {"timestamp": doc["timestamp"], "id": {"$gt": doc["id"]}},
+    ]}
+
+
+def _up_to(doc):
+    """Query for messages at or before ``doc`` in (timestamp, id) order."""
+    return {"$or": [
+        {"timestamp": {"$lt": doc["timestamp"]}},
+        {"timestamp": doc["timestamp"], "id": {"$lte": doc["id"]}},
+    ]}
+
+
+class SessionCompactor:
+    def __init__(self, llm_client, enabled=COMPACTION_ENABLED, interval=COMPACTION_INTERVAL,
+                 message_threshold=COMPACTION_MESSAGE_THRESHOLD, token_threshold=COMPACTION_TOKEN_THRESHOLD,
+                 keep_messages=COMPACTION_KEEP_MESSAGES, min_age=COMPACTION_MIN_AGE,
+                 input_tokens=COMPACTION_INPUT_TOKENS, retention=COMPACTION_RETENTION,
+                 batch_size=COMPACTION_BATCH_SIZE):
+        if retention not in ("archive", "delete", "keep"):
+            raise ValueError(f"Unknown COMPACTION_RETENTION '{retention}', expected archive, delete or keep")
+        self.llm_client = llm_client
+        self.enabled = enabled
+        self.interval = interval
+        self.message_threshold = message_threshold
+        self.token_threshold = token_threshold
+        self.keep_messages = keep_messages
+        self.min_age = min_age
+        self.input_tokens = input_tokens
+        self.retention = retention
+        self.batch_size = batch_size
+        self._scanned_until = None
+        self._task = None
+        self.compacted_sessions = 0
+        self.summarized_messages = 0
+        self.archived_messages = 0
+        self.failures = 0
+
+    def start(self, db, on_compacted):
+        """``on_compacted(session_id)`` is awaited after a session's documents change."""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run(db, on_compacted))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, db, on_compacted):
+        while True:
+            try:
+                await self.compact_all(db, on_compacted)
+            except Exception as e:
+                logger.error(f"Compaction pass failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def compact_all(self, db, on_compacted):
+        started = datetime.now(timezone.utc)
+        query = {"deleted_at": None}
+        if self._scanned_until is not None:
+            # Compaction does not bump updated_at, so unfinished sessions are flagged
+            query["$or"] = [{"updated_at": {"$gte": self._scanned_until}}, {"compaction_pending": True}]
+        fields = {"_id": 0, "id": 1, "summary_until": 1, "compaction_pending": 1}
+        async for session in db.chat_sessions.find(query, fields):
+            pending = await self._over_threshold(db, session)
+            if pending and await self.compact(db, session["id"]):
+                await on_compacted(session["id"])
+                compacted = await db.chat_sessions.find_one({"id": session["id"]}, fields)
+                pending = compacted is not None and await self._over_threshold(db, compacted)
+            if pending != bool(session.get("compaction_pending")):
+                # Unset rather than false, so the sparse index only holds pending sessions
+                update = {"$set": {"compaction_pending": True}} if pending else {"$unset": {"compaction_pending": ""}}
+                await db.chat_sessions.update_one({"id": session["id"]}, update)
+        self._scanned_until = started
+
+    async def _over_threshold(self, db, session) -> bool:
+        match = {"session_id": session["id"]}
+        if self.retention == "keep" and session.get("summary_until"):
+            # Summarized messages stay in place; only what follows them counts
+            match = {"$and": [match, _after(session["summary_until"])]}
+        sizes = await db.chat_messages.aggregate([
+            {"$match": match},
+            {"$group": {"_id": None, "count": {"$sum": 1}, "chars": {"$sum": {"$strLenCP": "$content"}}}},
+        ]).to_list(1)
+        if not sizes:
+            return False
+        return (sizes[0]["count"] > self.message_threshold
+                or sizes[0]["chars"] // 4 > self.token_threshold)
+
+    async def _lease(self, db, session_id):
+        now = datetime.now(timezone.utc)
+        return await db.chat_sessions.find_one_and_update(
+            {"id": session_id, "deleted_at": None,
+             "$or": [{"compacting_until": None}, {"compacting_until": {"$lt": now}}]},
+            {"$set": {"compacting_until": now + timedelta(seconds=COMPACTION_LEASE)}},
+            projection={"_id": 0, "id": 1, "summary": 1, "summary_until": 1},
+        )
+
+    async def compact(self, db, session_id) -> bool:
+        """Summarize (and archive) one session's older messages; True if anything changed."""
+        session = await self._lease(db, session_id)
+        if session is None:
+            # Deleted, or another worker holds the lease
+            return False
+        try:
+            changed = await self._summarize(db, session_id, session)
+            if self.retention != "keep":
+                changed = await self._retire_summarized(db, session_id) or changed
+            if changed:
+                self.compacted_sessions += 1
+            return changed
+        except Exception as e:
+            # Nothing is retired before its summary is stored, so retry next pass
+            self.failures += 1
+            logger.error(f"Compaction of session {session_id} failed: {str(e)}")
+            return False
+        finally:
+            await db.chat_sessions.update_one({"id": session_id}, {"$unset": {"compacting_until": ""}})
+
+    async def _summarize(self, db, session_id, session) -> bool:
+        # The newest messages stay verbatim; the oldest of the rest get folded in
+        boundary = await db.chat_messages.find(
+            {"session_id": session_id}, {"_id": 0, "timestamp": 1, "id": 1}
+        ).sort([("timestamp", DESCENDING), ("id", DESCENDING)]).skip(self.keep_messages).limit(1).to_list(1)
+        if not boundary:
+            return False
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.min_age)
+        clauses = [{"session_id": session_id}, _up_to(boundary[0]), {"timestamp": {"$lt": cutoff}}]
+        if session.get("summary_until"):
+            clauses.append(_after(session["summary_until"]))
+
+        batch, used = [], 0
+        cursor = db.chat_messages.find(
+            {"$and": clauses}, {"_id": 0, "id": 1, "role": 1, "content": 1, "timestamp": 1}
+        ).sort([("timestamp", ASCENDING), ("id", ASCENDING)])
+        async for message in cursor:
+            cost = estimate_tokens(message["content"])
+            if batch and used + cost > self.input_tokens:
+                break
+            batch.append(message)
+            used += cost
+        if not batch:
+            return False
+
+        summary = await self._ask_llm(session.get("summary"), batch)
+        last = batch[-1]
+        await db.chat_sessions.update_one({"id": session_id}, {
+            "$set": {
+                "summary": summary,
+                "summary_until": {"timestamp": last["timestamp"], "id": last["id"]},
+                "summary_updated_at": datetime.now(timezone.utc),
+            },
+            "$inc": {"summarized_messages": len(batch)},
+        })
+        self.summarized_messages += len(batch)
+        return True
+
+    async def _ask_llm(self, summary, messages) -> str:
+        transcript = "\n".join(
+            f"{'Mira' if m['role'] == 'assistant' else 'User'}: {m['content']}" for m in messages
+        )
+        # Queued under its own key, so summaries take turns with interactive calls
+        return (await self.llm_client.complete([
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=COMPACTION_SUMMARY_WORDS)},
+            {"role": "user", "content": f"Current summary:\n{summary or '(none yet)'}\n\nNew messages:\n{transcript}"},
+        ], key="compaction")).strip()
+
+    async def _retire_summarized(self, db, session_id) -> bool:
+        """Archive or delete hot messages the stored summary already covers."""
+        session = await db.chat_sessions.find_one({"id": session_id}, {"_id": 0, "summary_until": 1})
+        if not session or not session.get("summary_until"):
+            return False
+        query = {"$and": [{"session_id": session_id}, _up_to(session["summary_until"])]}
+        retired = 0
+        while True:
+            docs = await db.chat_messages.find(query).limit(self.batch_size).to_list(self.batch_size)
+            if not docs:
+                break
+            if self.retention == "archive":
+                try:
+                    await db[ARCHIVE_COLLECTION].insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    # Archived by an earlier, interrupted pass
+                    if any(error.get("code") != DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                        raise
+            await db.chat_messages.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+            retired += len(docs)
+        self.archived_messages += retired
+        return retired > 0
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "retention": self.retention,
+            "compacted_sessions": self.compacted_sessions,
+            "summarized_messages": self.summarized_messages,
+            "archived_messages": self.archived_messages,
+            "failures": self.failures,
+        }
@@ -0,0 +1,77 @@
+"""Conversation context for Mira, rebuilt from the chat history stored in Mongo.
+
+Every request assembles its prompt from the tail of ``chat_messages`` instead
+of relying on per-process LLM client memory, so any worker can serve any
+session and the prompt size stays bounded however long a session runs. Turns
+compacted out of the hot history are represented by the session's summary.
+"""
+import os
+
+# How many of the most recent messages are considered per request
+CONTEXT_MAX_MESSAGES = int(os.environ.get('CONTEXT_MAX_MESSAGES', '40'))
+# Token budget for verbatim history; anything older is summarized
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '2000'))
+# Token budget for the rolling summary of turns that did not fit verbatim
+CONTEXT_SUMMARY_TOKENS = int(os.environ.get('CONTEXT_SUMMARY_TOKENS', '300'))
+
+SUMMARY_SNIPPET_CHARS = 160
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for Gemini's tokenizer on chat text
+    return len(text) // 4 + 1
+
+
+def summarize_messages(messages, budget: int) -> str:
+    """Condense older messages into a short transcript that fits ``budget`` tokens.
+
+    The most recent of the older messages are kept first, so the summary rolls
+    forward as the conversation grows.
+    """
+    lines = []
+    used = 0
+    for message in reversed(messages):
+        speaker = "Mira" if message["role"] == "assistant" else "User"
+        content = " ".join(message["content"].split())
+        if len(content) > SUMMARY_SNIPPET_CHARS:
+            content = content[:SUMMARY_SNIPPET_CHARS].rstrip() + "..."
+        line = f"- {speaker}: {content}"
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(reversed(lines))
+
+
+def build_context(history, persona_message: dict, content: str, session_summary: str = None):
+    """Return the chat messages to send to the LLM for a new user message.
+
+    ``history`` holds the session's most recent messages in ascending order.
+    ``persona_message`` is the precompiled system message from ``persona``;
+    it always comes first, unchanged, so providers can cache it as a prefix.
+    ``session_summary`` is the summary ``compaction`` keeps of turns that are
+    no longer in the hot history.
+    """
+    recent = history[-CONTEXT_MAX_MESSAGES:]
+
+    # Keep as many of the newest messages verbatim as the budget allows
+    used = 0
+    split = len(recent)
+    while split > 0:
+        cost = estimate_tokens(recent[split - 1]["content"])
+        if used + cost > CONTEXT_TOKEN_BUDGET:
+            break
+        used += cost
+        split -= 1
+    older, verbatim = recent[:split], recent[split:]
+
+    messages = [persona_message]
+    if session_summary:
+        messages.append({"role": "system", "content": f"Summary of the conversation so far:\n{session_summary}"})
+    summary = summarize_messages(older, CONTEXT_SUMMARY_TOKENS) if older else ""
+    if summary:
+        messages.append({"role": "system", "content": f"Earlier in this conversation:\n{summary}"})
+    messages.extend({"role": m["role"], "content": m["content"]} for m in verbatim)
+    messages.append({"role": "user", "content": content})
+    return messages
@@ -0,0 +1,416 @@
+"""Shared LLM client with a cap on concurrent provider calls.
+
+One client is created at startup around the configured backend (see
+``llm_backends``) and reused by every request. At most
+``LLM_MAX_CONCURRENCY`` calls run at once, and up to ``LLM_MAX_QUEUE`` more
+wait for a slot. Anything beyond that, or anything that waits longer than
+``LLM_QUEUE_TIMEOUT``, fails fast with ``LLMOverloaded`` so a traffic spike
+sheds load instead of piling onto the provider's rate limits. The limits are
+per worker process, so with several workers the provider sees up to
+``WEB_CONCURRENCY`` times as many concurrent calls.
+
+Waiting calls are queued per caller key (the client, or a background job)
+and slots are handed out round-robin across keys, so a client firing a burst
+of turns waits behind its own calls instead of everyone else's.
+
+Each provider attempt has a deadline (``LLM_CALL_TIMEOUT``, or for streams
+``LLM_FIRST_TOKEN_TIMEOUT`` then ``LLM_STREAM_IDLE_TIMEOUT`` between
+fragments). Timeouts and the backend's ``transient_errors`` are retried up
+to ``LLM_MAX_RETRIES`` times with full-jitter backoff; a stream is only
+retried before its first fragment. With ``LLM_HEDGE`` an attempt still
+running at the recent p95 latency is raced against a second one, if a slot
+is free. ``LLM_BREAKER_THRESHOLD`` transient failures in a row open a circuit
+breaker: calls then fail at once with ``LLMUnavailable`` until, after
+``LLM_BREAKER_COOLDOWN``, a single trial call is let through.
+"""
+import asyncio
+import math
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from llm_backends import create_backend
+from tracing import llm_queue_seconds
+
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '16'))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '64'))
+LLM_QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', '10'))
+# How long shutdown waits for in-flight calls before giving up on them
+LLM_DRAIN_TIMEOUT = float(os.environ.get('LLM_DRAIN_TIMEOUT', '30'))
+LLM_CALL_TIMEOUT = float(os.environ.get('LLM_CALL_TIMEOUT', '30'))
+LLM_FIRST_TOKEN_TIMEOUT = float(os.environ.get('LLM_FIRST_TOKEN_TIMEOUT', '15'))
+LLM_STREAM_IDLE_TIMEOUT = float(os.environ.get('LLM_STREAM_IDLE_TIMEOUT', '15'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BASE = float(os.environ.get('LLM_RETRY_BASE', '0.25'))
+LLM_RETRY_MAX = float(os.environ.get('LLM_RETRY_MAX', '4'))
+LLM_HEDGE = os.environ.get('LLM_HEDGE', 'false').lower() == 'true'
+# Successful attempts observed before the p95 is trusted for hedging
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', '20'))
+LLM_BREAKER_THRESHOLD = int(os.environ.get('LLM_BREAKER_THRESHOLD', '5'))
+LLM_BREAKER_COOLDOWN = float(os.environ.get('LLM_BREAKER_COOLDOWN', '30'))
+# Pause before loading the provider SDK at startup, so the import (which holds
+# the GIL for seconds) does not slow the worker's first responses
+LLM_WARM_UP_DELAY = float(os.environ.get('LLM_WARM_UP_DELAY', '1'))
+
+LATENCY_WINDOW = 200
+
+
+class LLMOverloaded(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"LLM capacity exhausted, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LLMUnavailable(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"LLM provider unavailable, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=LLM_BREAKER_THRESHOLD, cooldown=LLM_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self.trips = 0
+        self.short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def _reject(self):
+        self.short_circuited += 1
+        remaining = self.cooldown - (time.monotonic() - self.opened_at)
+        raise LLMUnavailable(max(1, math.ceil(remaining)))
+
+    def check(self):
+        """Raise LLMUnavailable while open, without claiming the half-open trial."""
+        if self.state == "open":
+            self._reject()
+
+    def allow(self):
+        """Raise LLMUnavailable unless a call may go to the provider now."""
+        state = self.state
+        if state == "open" or (state == "half_open" and self._trial):
+            self._reject()
+        if state == "half_open":
+            self._trial = True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self._trial or (self.opened_at is None and self.failures >= self.threshold):
+            self.trips += int(self.opened_at is None)
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+    def release(self):
+        """Hand back a trial that ended without a verdict (e.g. cancelled)."""
+        self._trial = False
+
+
+class LLMClient:
+    def __init__(self, backend=None, max_concurrency=LLM_MAX_CONCURRENCY,
+                 max_queue=LLM_MAX_QUEUE, queue_timeout=LLM_QUEUE_TIMEOUT,
+                 call_timeout=LLM_CALL_TIMEOUT, first_token_timeout=LLM_FIRST_TOKEN_TIMEOUT,
+                 stream_idle_timeout=LLM_STREAM_IDLE_TIMEOUT, max_retries=LLM_MAX_RETRIES,
+                 hedge=LLM_HEDGE, breaker=None):
+        self.backend = backend if backend is not None else create_backend()
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._free = max_concurrency
+        # caller key -> waiting futures; key order is the round-robin order
+        self._queues = OrderedDict()
+        self.active = 0
+        self.waiting = 0
+        self.draining = False
+        self.rejected = 0
+        self.completed = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        # Moving average of how long a call holds its slot
+        self._call_seconds = 2.0
+        self.call_timeout = call_timeout
+        self.first_token_timeout = first_token_timeout
+        self.stream_idle_timeout = stream_idle_timeout
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        # Recent successful attempt latencies, for the hedging threshold
+        self._latencies = {"complete": deque(maxlen=LATENCY_WINDOW), "first_token": deque(maxlen=LATENCY_WINDOW)}
+        self.timeouts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @property
+    def _transient(self):
+        # Read per use: a backend only knows its SDK's error types once loaded
+        return (asyncio.TimeoutError,) + tuple(getattr(self.backend, "transient_errors", ()))
+
+    async def warm_up(self, delay=LLM_WARM_UP_DELAY):
+        # A call arriving first loads the SDK itself; this then just waits for it
+        await asyncio.sleep(delay)
+        await self.backend.warm_up()
+
+    def retry_after(self) -> int:
+        backlog = (self.waiting + 1) / self.max_concurrency
+        return max(1, math.ceil(backlog * self._call_seconds))
+
+    def check_capacity(self):
+        """Raise LLMUnavailable or LLMOverloaded if a new call could not even join the queue."""
+        self.breaker.check()
+        if self.draining or self.active + self.waiting >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            raise LLMOverloaded(self.retry_after())
+
+    async def _acquire(self, key):
+        if self._free > 0 and not self._queues:
+            self._free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just as we gave up; pass it on
+                self._release()
+            else:
+                queue = self._queues.get(key)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[key]
+            raise
+
+    def _release(self):
+        # Wake the oldest call of the next key in turn, then rotate that key to the back
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._free += 1
+
+    @asynccontextmanager
+    async def slot(self, key="default"):
+        self.check_capacity()
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            await self._acquire(key)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            llm_queue_seconds.observe(time.monotonic() - started, "timeout")
+            raise LLMOverloaded(self.retry_after())
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - started
+        llm_queue_seconds.observe(waited, "acquired")
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        self.active += 1
+        acquired = time.monotonic()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._release()
+            self.completed += 1
+            self._call_seconds = 0.9 * self._call_seconds + 0.1 * (time.monotonic() - acquired)
+
+    def _take_spare_slot(self) -> bool:
+        # Hedges only use capacity nobody is waiting for
+        if self._free > 0 and not self._queues:
+            self._free -= 1
+            return True
+        return False
+
+    def _hedge_delay(self, kind):
+        samples = self._latencies[kind]
+        if not self.hedge or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return sorted(samples)[int(len(samples) * 0.95)]
+
+    async def _race(self, attempt, kind, discard):
+        """Run ``attempt()``, hedged with a second copy once it passes the p95."""
+        delay = self._hedge_delay(kind)
+        if delay is None:
+            return await attempt()
+        first = asyncio.create_task(attempt())
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if done or not self._take_spare_slot():
+                return await first
+        except asyncio.CancelledError:
+            # The caller went away (a client disconnect, say); asyncio.wait
+            # leaves the attempt running, so stop it and drop what it made
+            await self._abandon(first, discard)
+            raise
+        self.hedges += 1
+        second = asyncio.create_task(attempt())
+        pending, winner, error = {first, second}, None, None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+            if winner is None:
+                raise error
+            self.hedge_wins += int(winner is second)
+            return winner.result()
+        finally:
+            for task in (first, second):
+                task.cancel()
+            for task in (first, second):
+                try:
+                    result = await task
+                except BaseException:
+                    continue
+                if task is not winner:
+                    await discard(result)
+            self._release()
+
+    @staticmethod
+    async def _abandon(task, discard):
+        task.cancel()
+        try:
+            result = await task
+        except BaseException:
+            return
+        await discard(result)
+
+    async def _with_retries(self, call):
+        """Await ``call()``, retrying transient failures with full-jitter backoff."""
+        for attempt in range(self.max_retries + 1):
+            self.breaker.allow()
+            try:
+                result = await call()
+            except self._transient as e:
+                self.breaker.failure()
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(random.uniform(0, min(LLM_RETRY_MAX, LLM_RETRY_BASE * 2 ** attempt)))
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.success()
+                return result
+
+    async def _complete_once(self, messages):
+        started = time.monotonic()
+        reply = await asyncio.wait_for(self.backend.complete(messages), self.call_timeout)
+        self._latencies["complete"].append(time.monotonic() - started)
+        return reply
+
+    async def _open_stream(self, messages):
+        """Start a stream and wait for its first fragment (None if it is empty)."""
+        started = time.monotonic()
+        deltas = self.backend.stream(messages)
+        try:
+            first = await asyncio.wait_for(deltas.__anext__(), self.first_token_timeout)
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await deltas.aclose()
+            raise
+        self._latencies["first_token"].append(time.monotonic() - started)
+        return deltas, first
+
+    async def complete(self, messages, key="default") -> str:
+        """Return the full reply to a prompt built by ``build_context``.
+
+        ``key`` names the caller for fair queueing, usually the client.
+        """
+        async def discard(reply):
+            pass
+
+        async with self.slot(key):
+            return await self._with_retries(
+                lambda: self._race(lambda: self._complete_once(messages), "complete", discard)
+            )
+
+    async def stream(self, messages, key="default"):
+        """Yield the reply piece by piece as it is generated."""
+        async def discard(opened):
+            await opened[0].aclose()
+
+        async with self.slot(key):
+            deltas, first = await self._with_retries(
+                lambda: self._race(lambda: self._open_stream(messages), "first_token", discard)
+            )
+            try:
+                if first is None:
+                    return
+                yield first
+                while True:
+                    try:
+                        delta = await asyncio.wait_for(deltas.__anext__(), self.stream_idle_timeout)
+                    except StopAsyncIteration:
+                        return
+                    except asyncio.TimeoutError:
+                        self.timeouts += 1
+                        raise
+                    yield delta
+            except self._transient:
+                # Too late to retry once fragments have gone out
+                self.breaker.failure()
+                raise
+            finally:
+                await deltas.aclose()
+
+    async def drain(self, timeout=LLM_DRAIN_TIMEOUT) -> bool:
+        """Stop admitting calls and wait for those in flight; True if all finished."""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while (self.active or self.waiting) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return not (self.active or self.waiting)
+
+    def stats(self):
+        return {
+            "backend": self.backend.name,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "queued_keys": len(self._queues),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "wait_seconds_max": round(self.wait_seconds_max, 3),
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "breaker_state": self.breaker.state,
+            "breaker_open": self.breaker.state != "closed",
+            "breaker_trips": self.breaker.trips,
+            "short_circuited": self.breaker.short_circuited,
+        }
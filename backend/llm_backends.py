@@ -0,0 +1,206 @@
+"""LLM providers Mira can talk through, chosen with ``LLM_BACKEND``.
+
+``gemini`` (the default) calls Google's Gemini through litellm. ``fake`` is a
+local, deterministic stand-in with configurable latency, streaming cadence and
+error rate, for load-testing and benchmarking the server without paying for
+or waiting on a real provider.
+
+A backend exposes ``complete(messages)``, returning the whole reply,
+``stream(messages)``, an async generator of reply fragments, and
+``embed(text)``, returning an embedding vector, plus ``transient_errors``,
+the exception types worth retrying, and ``warm_up()``, which loads whatever
+the backend needs ahead of the first call. Concurrency limits, deadlines and
+retries are applied by ``LLMClient`` on top, not here.
+
+litellm takes seconds to import, so it is only loaded, in a worker thread,
+when the Gemini backend is warmed up or first used; importing this module
+stays cheap and the server can start listening straight away.
+"""
+import asyncio
+import hashlib
+import os
+import importlib
+import random
+
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'gemini')
+
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini/gemini-2.0-flash')
+GEMINI_EMBEDDING_MODEL = os.environ.get('GEMINI_EMBEDDING_MODEL', 'gemini/text-embedding-004')
+# Smallest prompt prefix Gemini will hold in an explicit context cache
+GEMINI_CACHE_MIN_TOKENS = int(os.environ.get('GEMINI_CACHE_MIN_TOKENS', '4096'))
+
+# Time to first token is log-normal around this median
+LLM_FAKE_LATENCY_MS = float(os.environ.get('LLM_FAKE_LATENCY_MS', '800'))
+LLM_FAKE_LATENCY_SIGMA = float(os.environ.get('LLM_FAKE_LATENCY_SIGMA', '0.5'))
+LLM_FAKE_CHUNK_INTERVAL_MS = float(os.environ.get('LLM_FAKE_CHUNK_INTERVAL_MS', '30'))
+LLM_FAKE_CHUNK_WORDS = int(os.environ.get('LLM_FAKE_CHUNK_WORDS', '3'))
+LLM_FAKE_REPLY_WORDS = int(os.environ.get('LLM_FAKE_REPLY_WORDS', '60'))
+LLM_FAKE_ERROR_RATE = float(os.environ.get('LLM_FAKE_ERROR_RATE', '0'))
+LLM_FAKE_SEED = os.environ.get('LLM_FAKE_SEED')
+
+FAKE_EMBEDDING_DIMENSIONS = 64
+
+FAKE_VOCABULARY = (
+    "aww sweetie that sounds so lovely nya~ tell me more about your day "
+    "ehehe you always make me smile darling I'm so proud of you 💕 "
+    "let's play a game later or watch some anime together ^.^ ~"
+).split()
+
+
+_litellm = None
+
+
+def _load_litellm():
+    global _litellm
+    if _litellm is None:
+        _litellm = importlib.import_module("litellm")
+    return _litellm
+
+
+def _cached_tokens(usage) -> int:
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+class GeminiBackend:
+    name = "gemini"
+    prompt_cache_min_tokens = GEMINI_CACHE_MIN_TOKENS
+
+    def __init__(self, api_key=None, model=GEMINI_MODEL, embedding_model=GEMINI_EMBEDDING_MODEL):
+        self.api_key = api_key if api_key is not None else os.environ.get('GEMINI_API_KEY')
+        self.model = model
+        self.embedding_model = embedding_model
+        # Provider-reported input tokens served from a context cache
+        self.cached_tokens = 0
+        self._loading = None
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.api_key)
+
+    @property
+    def transient_errors(self):
+        # Nothing litellm raises can be in flight before it is loaded
+        if _litellm is None:
+            return ()
+        errors = _litellm.exceptions
+        return (
+            errors.APIConnectionError, errors.InternalServerError, errors.RateLimitError,
+            errors.ServiceUnavailableError, errors.Timeout,
+        )
+
+    async def warm_up(self):
+        """Import litellm off the event loop; concurrent callers share one import."""
+        if _litellm is not None:
+            return _litellm
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(asyncio.to_thread(_load_litellm))
+        try:
+            # A cancelled caller must not cancel the import for everyone else
+            return await asyncio.shield(self._loading)
+        except Exception:
+            self._loading = None
+            raise
+
+    async def complete(self, messages) -> str:
+        litellm = await self.warm_up()
+        response = await litellm.acompletion(model=self.model, api_key=self.api_key, messages=messages)
+        self.cached_tokens += _cached_tokens(getattr(response, "usage", None))
+        return response.choices[0].message.content
+
+    async def stream(self, messages):
+        litellm = await self.warm_up()
+        response = await litellm.acompletion(
+            model=self.model, api_key=self.api_key, messages=messages, stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for chunk in response:
+            usage = getattr(chunk, "usage", None)
+            if usage is not None:
+                self.cached_tokens += _cached_tokens(usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+    async def embed(self, text: str):
+        litellm = await self.warm_up()
+        response = await litellm.aembedding(model=self.embedding_model, api_key=self.api_key, input=[text])
+        return response.data[0]["embedding"]
+
+
+class FakeBackendError(Exception):
+    pass
+
+
+class FakeBackend:
+    """Replies deterministically from the prompt after a simulated delay."""
+
+    name = "fake"
+    configured = True
+    transient_errors = (FakeBackendError,)
+
+    async def warm_up(self):
+        pass
+
+    def __init__(self, latency_ms=LLM_FAKE_LATENCY_MS, latency_sigma=LLM_FAKE_LATENCY_SIGMA,
+                 chunk_interval_ms=LLM_FAKE_CHUNK_INTERVAL_MS, chunk_words=LLM_FAKE_CHUNK_WORDS,
+                 reply_words=LLM_FAKE_REPLY_WORDS, error_rate=LLM_FAKE_ERROR_RATE, seed=LLM_FAKE_SEED):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.chunk_interval_ms = chunk_interval_ms
+        self.chunk_words = chunk_words
+        self.reply_words = reply_words
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+
+    def _reply_words(self, messages):
+        digest = hashlib.sha256(messages[-1]["content"].encode()).digest()
+        picker = random.Random(digest)
+        return [picker.choice(FAKE_VOCABULARY) for _ in range(self.reply_words)]
+
+    async def _first_token(self):
+        if self.latency_ms > 0:
+            delay = self._random.lognormvariate(0, self.latency_sigma) * self.latency_ms
+            await asyncio.sleep(delay / 1000)
+        if self._random.random() < self.error_rate:
+            raise FakeBackendError("Simulated provider error")
+
+    async def complete(self, messages) -> str:
+        await self._first_token()
+        words = self._reply_words(messages)
+        # Account for the time a real provider spends generating the rest
+        chunks = -(-len(words) // self.chunk_words)
+        await asyncio.sleep(max(chunks - 1, 0) * self.chunk_interval_ms / 1000)
+        return " ".join(words)
+
+    async def stream(self, messages):
+        await self._first_token()
+        words = self._reply_words(messages)
+        for start in range(0, len(words), self.chunk_words):
+            if start:
+                await asyncio.sleep(self.chunk_interval_ms / 1000)
+            chunk = " ".join(words[start:start + self.chunk_words])
+            yield chunk if start == 0 else " " + chunk
+
+    async def embed(self, text: str):
+        # Hashed bag of words: texts sharing most words land close together
+        vector = [0.0] * FAKE_EMBEDDING_DIMENSIONS
+        for word in text.lower().split():
+            bucket = int.from_bytes(hashlib.md5(word.encode()).digest()[:4], "big")
+            vector[bucket % FAKE_EMBEDDING_DIMENSIONS] += 1.0
+        return vector
+
+
+BACKENDS = {
+    GeminiBackend.name: GeminiBackend,
+    FakeBackend.name: FakeBackend,
+}
+
+
+def create_backend(name=LLM_BACKEND):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown LLM_BACKEND '{name}', expected one of {sorted(BACKENDS)}")
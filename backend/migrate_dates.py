@@ -0,0 +1,99 @@
+"""Convert ISO-string timestamps left by older releases into native BSON dates.
+
+Run from the backend directory, with the same .env as the server:
+
+    python migrate_dates.py [--batch-size 1000]
+
+The migration works in batches and only touches documents that still hold a
+string, so it can be interrupted and re-run at any time. It then gives
+messages written by older releases a ``saved_at`` (their ``timestamp``), which
+delta sync pages on.
+"""
+import argparse
+import asyncio
+import os
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+DATE_FIELDS = {
+    "chat_sessions": ["created_at", "updated_at"],
+    "chat_messages": ["timestamp"],
+}
+
+
+def parse_iso(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+async def migrate_collection(collection, fields, batch_size: int) -> int:
+    query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+    projection = {field: 1 for field in fields}
+    converted = 0
+    while True:
+        docs = await collection.find(query, projection).limit(batch_size).to_list(batch_size)
+        if not docs:
+            return converted
+
+        updates = []
+        for doc in docs:
+            values = {}
+            for field in fields:
+                if isinstance(doc.get(field), str):
+                    try:
+                        values[field] = parse_iso(doc[field])
+                    except ValueError:
+                        # Unparseable values would be picked up again forever
+                        values[field] = None
+            updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": values}))
+
+        await collection.bulk_write(updates, ordered=False)
+        converted += len(updates)
+        print(f"{collection.name}: converted {converted} documents")
+
+
+async def backfill_saved_at(collection, batch_size: int) -> int:
+    filled = 0
+    while True:
+        docs = await collection.find({"saved_at": {"$exists": False}}, {"_id": 1}).limit(batch_size).to_list(batch_size)
+        if not docs:
+            return filled
+        result = await collection.update_many(
+            {"_id": {"$in": [doc["_id"] for doc in docs]}, "saved_at": {"$exists": False}},
+            [{"$set": {"saved_at": "$timestamp"}}],
+        )
+        filled += result.modified_count
+        print(f"{collection.name}: gave {filled} documents a saved_at")
+
+
+async def migrate(db, batch_size: int):
+    for name, fields in DATE_FIELDS.items():
+        converted = await migrate_collection(db[name], fields, batch_size)
+        print(f"{name}: done, {converted} documents converted")
+    filled = await backfill_saved_at(db.chat_messages, batch_size)
+    print(f"chat_messages: done, {filled} documents given a saved_at")
+
+
+async def run(batch_size: int):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    try:
+        await migrate(client[os.environ['DB_NAME']], batch_size)
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(run(args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""Persistence of completed chat turns.
+
+A turn is the user's message plus Mira's reply. Both are written with one
+``insert_many`` while the session document is updated concurrently, with one
+atomic pipeline update of ``updated_at`` and the denormalized sidebar fields,
+so saving a turn costs a single round trip of latency. With write-behind
+enabled the writes leave the response path entirely and are drained by a
+background task from a bounded queue.
+
+A write-behind turn is acknowledged to the client once it is in the queue,
+so it is first appended (and fsynced) to an outbox file on local disk. Each
+worker journals to its own file under ``PERSIST_OUTBOX_DIR`` and holds a lock
+on it; a worker starting up replays any file whose owner is gone, so turns a
+crashed worker had acknowledged but not written still reach Mongo. A queued
+turn is retried until it is written rather than dropped: while Mongo stays
+down the queue fills up and further turns are written inline, failing in
+front of their clients. Only losing the host's disk loses acknowledged
+turns.
+
+Messages are stamped with ``saved_at``, the time they are written, and the
+session's ``updated_at`` moves up to the same time; delta sync pages on
+these, so a turn that took long to generate (or sat in the write-behind
+queue) still shows up after the watermark of a sync that ran meanwhile.
+
+Every write is idempotent: messages carry unique ids (duplicate-key errors on a
+retry are ignored), ``updated_at`` only ever moves forward via ``$max``, and the
+session update is skipped for a turn id it has already recorded, so
+``message_count`` is incremented once per turn.
+The title derived from the turn only replaces the default one, so
+concurrent turns never overwrite each other's. A turn can therefore be
+retried, or flushed out of order, without duplicating or regressing
+anything. A turn that cannot be written is rolled back, along with the
+sidebar fields it set, so history never keeps a user message without its
+reply.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import uuid
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+from session_fields import DEFAULT_SESSION_TITLE, derive_title, edge_message, last_message_fields
+from tracing import span
+
+PERSIST_WRITE_BEHIND = os.environ.get('PERSIST_WRITE_BEHIND', 'false').lower() == 'true'
+PERSIST_QUEUE_SIZE = int(os.environ.get('PERSIST_QUEUE_SIZE', '1000'))
+PERSIST_MAX_RETRIES = int(os.environ.get('PERSIST_MAX_RETRIES', '5'))
+PERSIST_FLUSH_TIMEOUT = float(os.environ.get('PERSIST_FLUSH_TIMEOUT', '10'))
+# Local directory journaling write-behind turns until they are written
+PERSIST_OUTBOX_DIR = os.environ.get('PERSIST_OUTBOX_DIR', str(Path(__file__).parent / 'outbox'))
+
+DUPLICATE_KEY = 11000
+# Turn ids remembered per session to recognise a retried session update
+RECENT_TURNS = 20
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Turn:
+    session_id: str
+    messages: List[dict]
+    session_fields: dict = field(default_factory=dict)
+    session_set: dict = field(default_factory=dict)
+    # Applied only while the session still has the default title
+    title: Optional[str] = None
+
+    @property
+    def id(self) -> str:
+        return self.messages[0]["id"]
+
+
+# Keeps dates as (UTC-aware) datetimes through the outbox
+OUTBOX_JSON = json_util.RELAXED_JSON_OPTIONS.with_options(tz_aware=True, tzinfo=timezone.utc)
+
+
+class Outbox:
+    """A worker's journal of write-behind turns not yet known to be written."""
+
+    def __init__(self, directory=PERSIST_OUTBOX_DIR):
+        self.directory = Path(directory)
+        self.path = None
+        self._file = None
+        self._lock = asyncio.Lock()
+
+    def open(self) -> List[Turn]:
+        """Create this worker's file; return the turns left by workers that are gone."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / f"outbox-{uuid.uuid4().hex}.ndjson"
+        self._file = open(self.path, "ab")
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        recovered = []
+        for path in sorted(self.directory.glob("outbox-*.ndjson")):
+            if path == self.path:
+                continue
+            with open(path, "rb") as stale:
+                try:
+                    fcntl.flock(stale, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Its worker is still running
+                    continue
+                for line in stale:
+                    try:
+                        turn = Turn(**json_util.loads(line, json_options=OUTBOX_JSON))
+                    except (ValueError, TypeError):
+                        # Cut short by the crash, so it was never acknowledged
+                        continue
+                    self._write(line if line.endswith(b"\n") else line + b"\n")
+                    recovered.append(turn)
+                # Only let go of it once its turns are in this worker's file
+                path.unlink()
+        if recovered:
+            logger.warning(f"Recovered {len(recovered)} unwritten turns from the outbox")
+        return recovered
+
+    def _write(self, line: bytes):
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def append(self, turn: Turn):
+        line = json_util.dumps(asdict(turn), json_options=OUTBOX_JSON).encode() + b"\n"
+        async with self._lock:
+            await asyncio.to_thread(self._write, line)
+
+    async def clear(self, still_empty):
+        """Empty the file, provided ``still_empty()`` holds once appends are excluded."""
+        async with self._lock:
+            if still_empty():
+                await asyncio.to_thread(self._file.truncate, 0)
+
+    def close(self, remove: bool):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if remove:
+            self.path.unlink(missing_ok=True)
+
+
+def write_time() -> datetime:
+    # BSON dates hold milliseconds; truncated here so sync cursors built from
+    # in-memory copies match what Mongo returns
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def session_update(turn: Turn, saved_at: datetime):
+    """The pipeline update recording ``turn``, written at ``saved_at``, on its session."""
+    # Values go in as $literal so message text starting with '$' stays text
+    maxima = {**turn.session_fields, "updated_at": saved_at}
+    fields = {name: {"$max": [f"${name}", {"$literal": value}]} for name, value in maxima.items()}
+    fields.update({
+        "message_count": {"$add": [{"$ifNull": ["$message_count", 0]}, len(turn.messages)]},
+        "recent_turn_ids": {"$slice": [
+            {"$concatArrays": [{"$ifNull": ["$recent_turn_ids", []]}, {"$literal": [turn.id]}]}, -RECENT_TURNS,
+        ]},
+        **{name: {"$literal": value} for name, value in turn.session_set.items()},
+    })
+    if turn.title is not None:
+        fields["title"] = {"$cond": [
+            {"$eq": ["$title", DEFAULT_SESSION_TITLE]}, {"$literal": turn.title}, "$title",
+        ]}
+    return [{"$set": fields}]
+
+
+async def write_turn(db, turn: Turn):
+    saved_at = write_time()
+
+    async def insert_messages():
+        with span("insert_messages"):
+            try:
+                # Copies, so the caller's (and the session cache's) dicts stay as they are
+                await db.chat_messages.insert_many(
+                    [{**message, "saved_at": saved_at} for message in turn.messages], ordered=False
+                )
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                if any(error.get("code") != DUPLICATE_KEY for error in errors):
+                    raise
+
+    async def touch_session():
+        with span("touch_session"):
+            await db.chat_sessions.update_one(
+                {"id": turn.session_id, "recent_turn_ids": {"$ne": turn.id}}, session_update(turn, saved_at)
+            )
+
+    # Let both writes settle before failing: a rollback started while the
+    # other one is still in flight would miss it
+    results = await asyncio.gather(insert_messages(), touch_session(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def rollback_turn(db, turn: Turn):
+    """Remove whichever of a failed turn's messages did get inserted."""
+    try:
+        await db.chat_messages.delete_many({"id": {"$in": [m["id"] for m in turn.messages]}})
+        # Take the turn back out of the count if the session update went through
+        await db.chat_sessions.update_one(
+            {"id": turn.session_id, "recent_turn_ids": turn.id},
+            {"$inc": {"message_count": -len(turn.messages)}, "$pull": {"recent_turn_ids": turn.id}},
+        )
+        await _revert_session_fields(db, turn)
+    except Exception as e:
+        logger.error(f"Rollback of turn for session {turn.session_id} failed: {str(e)}")
+
+
+async def _revert_session_fields(db, turn: Turn):
+    # Each update only applies while the session still shows this turn, so a
+    # turn saved meanwhile keeps its own values
+    if "last_message_at" in turn.session_set:
+        last = await edge_message(db, turn.session_id, -1)
+        await db.chat_sessions.update_one(
+            {"id": turn.session_id, "last_message_at": turn.session_set["last_message_at"]},
+            {"$set": last_message_fields(last)} if last is not None else
+            {"$unset": {"last_message_preview": "", "last_role": "", "last_message_at": ""}},
+        )
+    if turn.title is not None:
+        first_user = await edge_message(db, turn.session_id, 1, {"role": "user"})
+        await db.chat_sessions.update_one(
+            {"id": turn.session_id, "title": turn.title},
+            {"$set": {"title": derive_title(first_user["content"]) if first_user else DEFAULT_SESSION_TITLE}},
+        )
+
+
+class TurnWriter:
+    """Writes turns inline, or through a bounded, journaled write-behind queue."""
+
+    def __init__(self, write_behind=PERSIST_WRITE_BEHIND, queue_size=PERSIST_QUEUE_SIZE,
+                 max_retries=PERSIST_MAX_RETRIES, outbox_dir=PERSIST_OUTBOX_DIR):
+        self.write_behind = write_behind
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.outbox = Outbox(outbox_dir) if write_behind else None
+        self._queue = asyncio.Queue()
+        # Turns journaled but not yet written; bounded by queue_size
+        self._unwritten = 0
+        self._worker = None
+        self.written = 0
+        self.retries = 0
+        self.failed = 0
+        self.overflowed = 0
+        self.rolled_back = 0
+        self.recovered = 0
+
+    def start(self, db):
+        if self.write_behind and self._worker is None:
+            recovered = self.outbox.open()
+            self.recovered += len(recovered)
+            self._unwritten += len(recovered)
+            for turn in recovered:
+                self._queue.put_nowait((db, turn))
+            self._worker = asyncio.create_task(self._run())
+
+    async def save(self, db, turn: Turn):
+        if self._worker is not None:
+            if self._unwritten < self.queue_size:
+                # Counted before the append, so clear() cannot empty the file under it
+                self._unwritten += 1
+                try:
+                    await self.outbox.append(turn)
+                except OSError as e:
+                    self._unwritten -= 1
+                    logger.error(f"Outbox append failed, writing the turn inline: {str(e)}")
+                else:
+                    self._queue.put_nowait((db, turn))
+                    return
+            else:
+                # Apply backpressure instead of dropping the turn
+                self.overflowed += 1
+        try:
+            await write_turn(db, turn)
+        except Exception:
+            self.failed += 1
+            await self._rollback(db, turn)
+            raise
+        self.written += 1
+
+    async def _rollback(self, db, turn: Turn):
+        await rollback_turn(db, turn)
+        self.rolled_back += 1
+
+    async def _run(self):
+        while True:
+            db, turn = await self._queue.get()
+            try:
+                await self._write_until_done(db, turn)
+                self._unwritten -= 1
+                if self._unwritten == 0:
+                    await self.outbox.clear(lambda: self._unwritten == 0)
+            finally:
+                self._queue.task_done()
+
+    async def _write_until_done(self, db, turn: Turn):
+        # The client was told the turn is saved, so it is never given up on
+        attempt = 0
+        while True:
+            try:
+                await write_turn(db, turn)
+                self.written += 1
+                return
+            except Exception as e:
+                attempt += 1
+                self.retries += 1
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    logger.error(
+                        f"Turn for session {turn.session_id} still unwritten after {attempt} attempts, "
+                        f"retrying: {str(e)}"
+                    )
+                await asyncio.sleep(min(0.1 * 2 ** attempt, 5))
+
+    async def close(self, timeout=PERSIST_FLUSH_TIMEOUT):
+        """Flush queued turns, then stop the background worker."""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Shutting down with {self._unwritten} turns left in the outbox for the next start")
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+        self.outbox.close(remove=self._unwritten == 0)
+
+    def stats(self):
+        return {
+            "write_behind": self.write_behind,
+            "queued": self._unwritten,
+            "written": self.written,
+            "retries": self.retries,
+            "failed": self.failed,
+            "overflowed": self.overflowed,
+            "rolled_back": self.rolled_back,
+            "recovered": self.recovered,
+        }
@@ -0,0 +1,55 @@
+"""Mira's persona prompt, compiled once into a reusable prompt prefix.
+
+The persona is the first message of every prompt and never changes between
+turns, so it is built a single time at startup: versioned, hashed and sized.
+When the backend can cache prompt prefixes on the provider side and the
+persona is long enough to qualify, the message is marked for caching so
+repeated turns are billed at the cached-token rate instead of in full.
+"""
+import hashlib
+
+from context import estimate_tokens
+
+
+class PersonaPrefix:
+    def __init__(self, text: str, version: str, provider_cache: bool):
+        self.text = text
+        self.version = version
+        self.hash = hashlib.sha256(f"{version}\x1f{text}".encode()).hexdigest()[:16]
+        self.tokens = estimate_tokens(text)
+        self.provider_cache = provider_cache
+        message = {"role": "system", "content": text}
+        if provider_cache:
+            message["cache_control"] = {"type": "ephemeral"}
+        # Shared by every prompt; treat as read-only
+        self.message = message
+        self.requests = 0
+
+    def record_use(self):
+        self.requests += 1
+
+    def stats(self, cached_tokens=None):
+        """Report the prefix size and how many input tokens caching saved.
+
+        ``cached_tokens`` is the provider-reported total, when available;
+        otherwise savings are estimated from the prefix size.
+        """
+        if cached_tokens is None:
+            cached_tokens = self.tokens * self.requests if self.provider_cache else 0
+        return {
+            "version": self.version,
+            "hash": self.hash,
+            "tokens": self.tokens,
+            "provider_cache": self.provider_cache,
+            "requests": self.requests,
+            "tokens_saved": cached_tokens,
+            "tokens_saved_per_request": round(cached_tokens / self.requests, 1) if self.requests else 0,
+        }
+
+
+def compile_persona(text: str, version: str, backend) -> PersonaPrefix:
+    # Providers only cache prefixes above a minimum size; below it the
+    # cache_control marker would just be ignored (or rejected)
+    min_tokens = getattr(backend, "prompt_cache_min_tokens", None)
+    provider_cache = min_tokens is not None and estimate_tokens(text) >= min_tokens
+    return PersonaPrefix(text, version, provider_cache)
@@ -0,0 +1,194 @@
+"""Background removal of deleted chat sessions and their messages.
+
+Deleting a session only stamps it with ``deleted_at``, which hides it from
+every read straight away. The purger then removes its messages in bounded
+batches and marks the tombstone ``purged_at``. The tombstone itself is kept
+for ``PURGE_TOMBSTONE_RETENTION`` so that delta-sync clients learn about the
+deletion, then dropped by the sweep.
+
+Because the tombstone is durable, a crash part-way through loses nothing: the
+periodic sweep re-queues unpurged tombstones, and also catches messages whose
+session no longer exists or is deleted (left by older deletes or late writes).
+It finds those by stepping through the distinct session ids of
+``chat_messages`` one index seek at a time, checking them against
+``chat_sessions`` in batches, so its cost follows the number of sessions
+rather than messages. Every worker runs the sweep loop, but each sweep first
+takes a lease in the ``leases`` collection, so only one worker sweeps per
+interval.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+from compaction import ARCHIVE_COLLECTION
+
+PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', '500'))
+# Pause between batches so a large purge does not monopolise Mongo
+PURGE_BATCH_PAUSE = float(os.environ.get('PURGE_BATCH_PAUSE', '0.05'))
+PURGE_SWEEP_INTERVAL = float(os.environ.get('PURGE_SWEEP_INTERVAL', '3600'))
+# Clients that have not synced for longer than this must resync from scratch
+PURGE_TOMBSTONE_RETENTION = float(os.environ.get('PURGE_TOMBSTONE_RETENTION', str(30 * 24 * 3600)))
+
+LEASE_COLLECTION = "leases"
+SWEEP_LEASE = "purge_sweep"
+
+logger = logging.getLogger(__name__)
+
+
+class SessionPurger:
+    def __init__(self, batch_size=PURGE_BATCH_SIZE, batch_pause=PURGE_BATCH_PAUSE,
+                 sweep_interval=PURGE_SWEEP_INTERVAL, tombstone_retention=PURGE_TOMBSTONE_RETENTION):
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.sweep_interval = sweep_interval
+        self.tombstone_retention = tombstone_retention
+        self._queue = asyncio.Queue()
+        self._pending = set()
+        self._tasks = []
+        self.worker_id = uuid.uuid4().hex
+        self.sweeps = 0
+        self.purged_sessions = 0
+        self.purged_messages = 0
+        self.orphaned_sessions = 0
+        self.expired_tombstones = 0
+
+    def start(self, db):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._run(db)),
+                asyncio.create_task(self._sweep_periodically(db)),
+            ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, session_id: str):
+        if session_id not in self._pending:
+            self._pending.add(session_id)
+            self._queue.put_nowait(session_id)
+
+    async def _run(self, db):
+        while True:
+            session_id = await self._queue.get()
+            try:
+                await self.purge(db, session_id)
+            except Exception as e:
+                # The tombstone stays, so the next sweep retries it
+                logger.error(f"Purge of session {session_id} failed: {str(e)}")
+            finally:
+                self._pending.discard(session_id)
+
+    async def purge(self, db, session_id: str):
+        # Hot messages and any that compaction archived
+        for collection in (db.chat_messages, db[ARCHIVE_COLLECTION]):
+            while True:
+                docs = await collection.find(
+                    {"session_id": session_id}, {"_id": 1}
+                ).limit(self.batch_size).to_list(self.batch_size)
+                if not docs:
+                    break
+                result = await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+                self.purged_messages += result.deleted_count
+                await asyncio.sleep(self.batch_pause)
+
+        # A live session with this id is left alone
+        result = await db.chat_sessions.update_one(
+            {"id": session_id, "deleted_at": {"$type": "date"}, "purged_at": None},
+            {"$set": {"purged_at": datetime.now(timezone.utc)}}
+        )
+        self.purged_sessions += result.modified_count
+
+    async def sweep(self, db):
+        """Queue unpurged tombstones and orphaned messages; drop expired tombstones."""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.tombstone_retention)
+        result = await db.chat_sessions.delete_many(
+            {"deleted_at": {"$lt": cutoff}, "purged_at": {"$type": "date"}}
+        )
+        self.expired_tombstones += result.deleted_count
+
+        queued = 0
+        unpurged = db.chat_sessions.find(
+            {"deleted_at": {"$type": "date"}, "purged_at": None}, {"_id": 0, "id": 1}
+        )
+        async for session in unpurged:
+            self.enqueue(session["id"])
+            queued += 1
+
+        async for session_id in self._orphaned_sessions(db):
+            self.enqueue(session_id)
+            self.orphaned_sessions += 1
+            queued += 1
+        return queued
+
+    async def _orphaned_sessions(self, db):
+        """Yield ids that messages refer to but no live session has."""
+        last = None
+        while True:
+            ids = []
+            while len(ids) < self.batch_size:
+                # Jump to the next distinct session id along the (session_id, ...) index
+                query = {"session_id": {"$gt": last}} if last is not None else {"session_id": {"$type": "string"}}
+                docs = await db.chat_messages.find(query, {"_id": 0, "session_id": 1}).sort(
+                    "session_id", 1
+                ).limit(1).to_list(1)
+                if not docs:
+                    break
+                last = docs[0]["session_id"]
+                ids.append(last)
+            if not ids:
+                return
+            live = await db.chat_sessions.find(
+                {"id": {"$in": ids}, "deleted_at": None}, {"_id": 0, "id": 1}
+            ).to_list(len(ids))
+            live_ids = {session["id"] for session in live}
+            for session_id in ids:
+                if session_id not in live_ids:
+                    yield session_id
+            if len(ids) < self.batch_size:
+                return
+            await asyncio.sleep(self.batch_pause)
+
+    async def take_sweep_lease(self, db) -> bool:
+        """Claim this interval's sweep; False if another worker already has."""
+        now = datetime.now(timezone.utc)
+        try:
+            # Slightly shorter than the interval, so a worker waking a little
+            # late still gets the next sweep
+            await db[LEASE_COLLECTION].update_one(
+                {"_id": SWEEP_LEASE, "$or": [{"until": None}, {"until": {"$lt": now}}]},
+                {"$set": {"until": now + timedelta(seconds=self.sweep_interval * 0.9), "owner": self.worker_id}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # The lease exists and has not expired
+            return False
+        return True
+
+    async def _sweep_periodically(self, db):
+        while True:
+            try:
+                if await self.take_sweep_lease(db):
+                    self.sweeps += 1
+                    queued = await self.sweep(db)
+                    if queued:
+                        logger.info(f"Purge sweep queued {queued} sessions")
+            except Exception as e:
+                logger.error(f"Purge sweep failed: {str(e)}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "sweeps": self.sweeps,
+            "purged_sessions": self.purged_sessions,
+            "purged_messages": self.purged_messages,
+            "orphaned_sessions": self.orphaned_sessions,
+            "expired_tombstones": self.expired_tombstones,
+        }
@@ -0,0 +1,201 @@
+"""Token-bucket rate limits on chat turns, per client and per session.
+
+Each client (by address) and each session has a bucket holding up to
+``*_BURST`` turns that refills at ``*_RATE`` turns per second; a turn takes
+one token from both, and is refused with 429 and a ``Retry-After`` once
+either is empty. Buckets live in a bounded in-process LRU, or with
+``RATE_LIMIT_MONGO`` in a ``rate_limits`` collection shared by every worker,
+updated atomically by a single ``find_one_and_update`` (MongoDB 4.2+). If
+Mongo cannot be reached the limiter lets turns through rather than failing
+them.
+
+Behind a reverse proxy or ingress every connection comes from the proxy, so
+list it in ``RATE_LIMIT_TRUSTED_PROXIES`` (addresses or CIDR ranges, or
+``*``). Otherwise the whole site shares one client bucket, and one fair-queue
+key in the LLM client. For connections from a listed proxy the client is the
+nearest address in ``RATE_LIMIT_FORWARDED_HEADER`` that is not itself a
+trusted proxy. A warning is logged if forwarded requests arrive from a proxy
+that is not listed.
+"""
+import ipaddress
+import logging
+import math
+import os
+import time
+
+from cachetools import LRUCache
+from pymongo import ASCENDING, ReturnDocument
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_CLIENT_RATE = float(os.environ.get('RATE_LIMIT_CLIENT_RATE', '0.5'))
+RATE_LIMIT_CLIENT_BURST = float(os.environ.get('RATE_LIMIT_CLIENT_BURST', '20'))
+RATE_LIMIT_SESSION_RATE = float(os.environ.get('RATE_LIMIT_SESSION_RATE', '0.2'))
+RATE_LIMIT_SESSION_BURST = float(os.environ.get('RATE_LIMIT_SESSION_BURST', '8'))
+# In-process buckets let a client through once per process serving the
+# database, so they are only the default for a database nothing else serves
+RATE_LIMIT_MONGO = os.environ.get('RATE_LIMIT_MONGO', os.environ.get('SHARED_DATABASE', 'true')).lower() == 'true'
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+# Comma-separated proxy addresses or networks whose forwarded header is believed
+RATE_LIMIT_TRUSTED_PROXIES = os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '')
+RATE_LIMIT_FORWARDED_HEADER = os.environ.get('RATE_LIMIT_FORWARDED_HEADER', 'x-forwarded-for').lower()
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    def __init__(self, scope: str, retry_after: int):
+        super().__init__(f"Rate limit for {scope} exceeded, retry after {retry_after}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class TrustedProxies:
+    def __init__(self, spec: str = RATE_LIMIT_TRUSTED_PROXIES, header: str = RATE_LIMIT_FORWARDED_HEADER):
+        entries = [entry.strip() for entry in spec.split(",") if entry.strip()]
+        self.trust_all = "*" in entries
+        self.networks = [ipaddress.ip_network(entry, strict=False) for entry in entries if entry != "*"]
+        self.header = header
+        self._warned = False
+
+    def trusts(self, host: str) -> bool:
+        if self.trust_all:
+            return True
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        return any(address in network for network in self.networks)
+
+    def client(self, connection) -> str:
+        """The address a Request or WebSocket came from, seen through trusted proxies."""
+        peer = connection.client.host if connection.client else "unknown"
+        forwarded = connection.headers.get(self.header)
+        if not forwarded:
+            return peer
+        if not self.trusts(peer):
+            if not self._warned:
+                self._warned = True
+                logger.warning(
+                    f"Requests from {peer} carry {self.header} but it is not in RATE_LIMIT_TRUSTED_PROXIES; "
+                    f"every client behind it shares one rate limit"
+                )
+            return peer
+        # Each proxy appends the address it saw, so walk back from the nearest
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        for hop in reversed(hops):
+            if not self.trusts(hop):
+                return hop
+        return hops[0] if hops else peer
+
+
+trusted_proxies = TrustedProxies()
+
+
+def client_identity(connection) -> str:
+    """Key a Request or WebSocket by the client it came from."""
+    return trusted_proxies.client(connection)
+
+
+class MemoryBuckets:
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        # key -> [tokens, monotonic time of last update]; evicting an idle
+        # bucket only forgets a client that would have refilled anyway
+        self._buckets = LRUCache(max_keys)
+
+    async def take(self, db, key: str, rate: float, burst: float):
+        """Take one token; return (allowed, tokens left)."""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        allowed = tokens >= 1
+        bucket[0] = tokens - 1 if allowed else tokens
+        bucket[1] = now
+        return allowed, bucket[0]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class MongoBuckets:
+    collection = "rate_limits"
+
+    async def ensure_indexes(self, db):
+        # A bucket left alone until it is full again carries no information
+        await db[self.collection].create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    async def take(self, db, key: str, rate: float, burst: float):
+        """Take one token; return (allowed, tokens left)."""
+        # Timestamps come from the server ($$NOW) so workers' clocks cannot disagree
+        elapsed_ms = {"$subtract": ["$$NOW", {"$ifNull": ["$updated_at", "$$NOW"]}]}
+        refilled = {"$min": [burst, {"$add": [
+            {"$ifNull": ["$tokens", burst]}, {"$multiply": [rate / 1000, elapsed_ms]},
+        ]}]}
+        bucket = await db[self.collection].find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": refilled,
+                    "updated_at": "$$NOW",
+                    "expires_at": {"$add": ["$$NOW", math.ceil(burst / rate * 1000)]},
+                }},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                }},
+            ],
+            projection={"tokens": 1, "allowed": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket["allowed"], bucket["tokens"]
+
+
+class RateLimiter:
+    def __init__(self, enabled=RATE_LIMIT_ENABLED, use_mongo=RATE_LIMIT_MONGO,
+                 client_rate=RATE_LIMIT_CLIENT_RATE, client_burst=RATE_LIMIT_CLIENT_BURST,
+                 session_rate=RATE_LIMIT_SESSION_RATE, session_burst=RATE_LIMIT_SESSION_BURST):
+        self.enabled = enabled
+        self.buckets = MongoBuckets() if use_mongo else MemoryBuckets()
+        self.limits = {
+            "client": (client_rate, client_burst),
+            "session": (session_rate, session_burst),
+        }
+        self.allowed = 0
+        self.limited = {scope: 0 for scope in self.limits}
+        self.errors = 0
+
+    async def ensure_indexes(self, db):
+        if self.enabled and isinstance(self.buckets, MongoBuckets):
+            await self.buckets.ensure_indexes(db)
+
+    async def check(self, db, client: str, session_id: str):
+        """Take a turn from the client's and the session's buckets; raise RateLimited if either is empty."""
+        if not self.enabled:
+            return
+        for scope, key in (("client", client), ("session", session_id)):
+            rate, burst = self.limits[scope]
+            try:
+                allowed, tokens = await self.buckets.take(db, f"{scope}:{key}", rate, burst)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Rate limit check skipped: {str(e)}")
+                return
+            if not allowed:
+                self.limited[scope] += 1
+                raise RateLimited(scope, max(1, math.ceil((1 - tokens) / rate)))
+        self.allowed += 1
+
+    def stats(self):
+        stats = {
+            "enabled": self.enabled,
+            "backend": "mongo" if isinstance(self.buckets, MongoBuckets) else "memory",
+            "allowed": self.allowed,
+            "errors": self.errors,
+        }
+        for scope, count in self.limited.items():
+            stats[f"limited_{scope}"] = count
+        if isinstance(self.buckets, MemoryBuckets):
+            stats["tracked_keys"] = len(self.buckets)
+        return stats
@@ -0,0 +1,73 @@
+"""Startup work that runs after the worker is already listening.
+
+Creating indexes, setting up the cache bus and importing the LLM provider's
+SDK take seconds; done before uvicorn accepts connections, they would delay
+every restart and scale-out. Instead they run as background steps once the
+app is up: liveness only says the process is serving, readiness says every
+step has finished. A failing step (Mongo not reachable yet, say) is retried
+with capped backoff instead of crashing the worker, and readiness stays
+false meanwhile.
+"""
+import asyncio
+import logging
+import os
+import time
+
+STARTUP_RETRY_BASE = float(os.environ.get('STARTUP_RETRY_BASE', '0.5'))
+STARTUP_RETRY_MAX = float(os.environ.get('STARTUP_RETRY_MAX', '30'))
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    def __init__(self, retry_base=STARTUP_RETRY_BASE, retry_max=STARTUP_RETRY_MAX):
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.started = time.monotonic()
+        self._tasks = {}
+        # Seconds from creating the tracker (at app import) to each finished step
+        self.finished = {}
+        self.errors = {}
+        self.failures = 0
+
+    def run(self, name: str, step):
+        """Run ``step()`` in the background, retrying until it succeeds."""
+        if name not in self._tasks:
+            self._tasks[name] = asyncio.create_task(self._run(name, step))
+
+    async def _run(self, name: str, step):
+        attempt = 0
+        while True:
+            try:
+                await step()
+                break
+            except Exception as e:
+                self.failures += 1
+                self.errors[name] = str(e)
+                delay = min(self.retry_max, self.retry_base * 2 ** attempt)
+                attempt += 1
+                logger.warning(f"Startup step {name} failed, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
+        self.errors.pop(name, None)
+        self.finished[name] = round(time.monotonic() - self.started, 3)
+        logger.info(f"Startup step {name} done after {self.finished[name]}s")
+
+    @property
+    def ready(self) -> bool:
+        return len(self.finished) == len(self._tasks)
+
+    def pending(self):
+        return sorted(name for name in self._tasks if name not in self.finished)
+
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "pending": len(self.pending()),
+            "failures": self.failures,
+            **{f"{name}_seconds": seconds for name, seconds in self.finished.items()},
+        }
@@ -0,0 +1,205 @@
+"""WebSocket transport for chat: one long-lived connection per client.
+
+A connection can carry turns for several sessions at once. The client sends
+``{"type": "chat", "session_id", "content", "ref"}`` and gets back, tagged
+with the same ``ref`` and ``session_id``, an ``ack`` carrying the stored user
+message, ``typing`` while Mira composes, ``delta`` fragments and finally
+``done`` (or ``error``). Either side may send ``{"type": "ping"}``, answered
+with ``pong``.
+
+Outgoing frames go through a bounded per-connection buffer drained by a
+single writer. A client that stops reading for longer than
+``WS_SEND_TIMEOUT`` while the buffer is full is disconnected rather than
+allowed to hold replies in memory; one that sends nothing for a heartbeat
+interval plus ``WS_HEARTBEAT_TIMEOUT`` is presumed gone.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import orjson
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+
+WS_SEND_BUFFER = int(os.environ.get('WS_SEND_BUFFER', '256'))
+WS_SEND_TIMEOUT = float(os.environ.get('WS_SEND_TIMEOUT', '5'))
+WS_HEARTBEAT_INTERVAL = float(os.environ.get('WS_HEARTBEAT_INTERVAL', '20'))
+WS_HEARTBEAT_TIMEOUT = float(os.environ.get('WS_HEARTBEAT_TIMEOUT', '10'))
+# Turns one connection may have running at the same time
+WS_MAX_INFLIGHT = int(os.environ.get('WS_MAX_INFLIGHT', '4'))
+
+# WebSocket close codes: 1001 "going away", 1013 "try again later"
+CLOSE_HEARTBEAT_TIMEOUT = 1001
+CLOSE_SLOW_CONSUMER = 1013
+
+logger = logging.getLogger(__name__)
+
+
+def _dumps(message) -> str:
+    return orjson.dumps(
+        message, default=jsonable_encoder, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC
+    ).decode()
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+class _Connection:
+    def __init__(self, websocket: WebSocket, hub):
+        self.websocket = websocket
+        self.hub = hub
+        self.queue = asyncio.Queue(hub.send_buffer)
+        self.last_seen = time.monotonic()
+        self.turns = set()
+        self.tasks = []
+        self.closed = False
+
+    async def send(self, message):
+        if self.closed:
+            raise SlowConsumer()
+        try:
+            await asyncio.wait_for(self.queue.put(message), self.hub.send_timeout)
+        except asyncio.TimeoutError:
+            self.hub.slow_consumers += 1
+            await self.close(CLOSE_SLOW_CONSUMER, "Send buffer full")
+            raise SlowConsumer()
+
+    async def close(self, code, reason):
+        if self.closed:
+            return
+        self.closed = True
+        for task in self.tasks:
+            # The heartbeat may be the one closing; it must live to send the close
+            if task is not asyncio.current_task():
+                task.cancel()
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            # Already closed by the client
+            pass
+
+    async def write_loop(self):
+        while True:
+            message = await self.queue.get()
+            await self.websocket.send_text(_dumps(message))
+
+    async def heartbeat_loop(self):
+        interval = self.hub.heartbeat_interval
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_seen > interval + self.hub.heartbeat_timeout:
+                self.hub.heartbeat_timeouts += 1
+                await self.close(CLOSE_HEARTBEAT_TIMEOUT, "Heartbeat timeout")
+                return
+            await self.send({"type": "ping"})
+
+    async def run_turn(self, handle_turn, frame):
+        tags = {"ref": frame.get("ref"), "session_id": frame.get("session_id")}
+        try:
+            if not isinstance(tags["session_id"], str) or not isinstance(frame.get("content"), str):
+                raise HTTPException(status_code=422, detail="'session_id' and 'content' must be strings")
+            async for event, data in handle_turn(tags["session_id"], frame["content"]):
+                await self.send({"type": event, **tags, **data})
+            self.hub.turns += 1
+        except SlowConsumer:
+            pass
+        except HTTPException as e:
+            await self._send_error(tags, e.status_code, e.detail, e.headers)
+        except Exception as e:
+            logger.error(f"WebSocket chat error: {str(e)}")
+            await self._send_error(tags, 500, f"Chat error: {str(e)}")
+
+    async def _send_error(self, tags, status, detail, headers=None):
+        error = {"type": "error", **tags, "status": status, "detail": detail}
+        if headers and "Retry-After" in headers:
+            error["retry_after"] = int(headers["Retry-After"])
+        try:
+            await self.send(error)
+        except SlowConsumer:
+            pass
+
+    async def dispatch(self, handle_turn, frame):
+        kind = frame.get("type")
+        if kind == "ping":
+            await self.send({"type": "pong"})
+        elif kind == "pong":
+            pass
+        elif kind == "chat":
+            if len(self.turns) >= self.hub.max_inflight:
+                tags = {"ref": frame.get("ref"), "session_id": frame.get("session_id")}
+                await self._send_error(tags, 429, "Too many turns in flight on this connection")
+                return
+            task = asyncio.create_task(self.run_turn(handle_turn, frame))
+            self.turns.add(task)
+            task.add_done_callback(self.turns.discard)
+        else:
+            await self.send({"type": "error", "status": 400, "detail": f"Unknown message type {kind!r}"})
+
+
+class ChatSocketHub:
+    def __init__(self, send_buffer=WS_SEND_BUFFER, send_timeout=WS_SEND_TIMEOUT,
+                 heartbeat_interval=WS_HEARTBEAT_INTERVAL, heartbeat_timeout=WS_HEARTBEAT_TIMEOUT,
+                 max_inflight=WS_MAX_INFLIGHT):
+        self.send_buffer = send_buffer
+        self.send_timeout = send_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_inflight = max_inflight
+        self.connections = 0
+        self.peak_connections = 0
+        self.accepted = 0
+        self.turns = 0
+        self.slow_consumers = 0
+        self.heartbeat_timeouts = 0
+
+    async def serve(self, websocket: WebSocket, handle_turn):
+        """Run one client connection until it closes.
+
+        ``handle_turn(session_id, content)`` is an async generator of
+        ``(event, data)`` pairs; it may raise HTTPException before its first
+        event to reject the turn.
+        """
+        await websocket.accept()
+        connection = _Connection(websocket, self)
+        connection.tasks = [
+            asyncio.create_task(connection.write_loop()),
+            asyncio.create_task(connection.heartbeat_loop()),
+        ]
+        self.accepted += 1
+        self.connections += 1
+        self.peak_connections = max(self.peak_connections, self.connections)
+        try:
+            while not connection.closed:
+                raw = await websocket.receive_text()
+                connection.last_seen = time.monotonic()
+                try:
+                    frame = orjson.loads(raw)
+                    if not isinstance(frame, dict):
+                        raise ValueError("not an object")
+                except ValueError:
+                    await connection.send({"type": "error", "status": 400, "detail": "Invalid JSON message"})
+                    continue
+                await connection.dispatch(handle_turn, frame)
+        except (WebSocketDisconnect, SlowConsumer):
+            pass
+        except RuntimeError:
+            # receive after the server side closed the socket
+            pass
+        finally:
+            self.connections -= 1
+            connection.closed = True
+            for task in connection.tasks + list(connection.turns):
+                task.cancel()
+            await asyncio.gather(*connection.tasks, *connection.turns, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "peak_connections": self.peak_connections,
+            "accepted": self.accepted,
+            "turns": self.turns,
+            "slow_consumers": self.slow_consumers,
+            "heartbeat_timeouts": self.heartbeat_timeouts,
+        }
@@ -0,0 +1,217 @@
+"""Cache of Mira's replies to repeated prompts.
+
+Much of the traffic is the same handful of starter messages, and with a fixed
+persona those deserve the same kind of answer. Replies are keyed on the
+normalized prompt, a hash of the persona and a digest of everything else
+sent to the LLM with it (the session summary and the history), so a reply is
+only reused where the model would have seen exactly the same conversation.
+In practice that means the opening message of a session, where most of the
+repetition is.
+
+Lookups try an exact key match first. With an embedding function configured,
+they fall back to the most similar cached prompt within the same persona and
+context, if it clears ``RESPONSE_CACHE_SIMILARITY``. Entries live in a bounded
+in-process LRU with a TTL and, unless ``SHARED_DATABASE=false``, in a
+``response_cache`` Mongo collection that every process serving the database
+shares.
+"""
+import hashlib
+import logging
+import math
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+from cachetools import TTLCache
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '2048'))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_EMBEDDINGS = os.environ.get('RESPONSE_CACHE_EMBEDDINGS', 'false').lower() == 'true'
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get('RESPONSE_CACHE_SIMILARITY', '0.92'))
+# Share cached replies with every other process serving the database
+RESPONSE_CACHE_MONGO = os.environ.get(
+    'RESPONSE_CACHE_MONGO', os.environ.get('SHARED_DATABASE', 'true')
+).lower() == 'true'
+# Upper bound on candidates compared during a similarity lookup in Mongo
+RESPONSE_CACHE_SCAN_LIMIT = int(os.environ.get('RESPONSE_CACHE_SCAN_LIMIT', '200'))
+
+logger = logging.getLogger(__name__)
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s!?.,~]+$")
+
+
+def normalize_prompt(text: str) -> str:
+    return _TRAILING_PUNCTUATION.sub("", " ".join(text.lower().split()))
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+def _normalized(vector):
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def _cosine(a, b) -> float:
+    # Vectors are normalized when stored
+    return sum(x * y for x, y in zip(a, b))
+
+
+class CacheProbe:
+    """The outcome of a lookup, reused to store the reply on a miss."""
+
+    __slots__ = ("key", "bucket", "prompt", "embedding", "reply")
+
+    def __init__(self, key, bucket, prompt):
+        self.key = key
+        self.bucket = bucket
+        self.prompt = prompt
+        self.embedding = None
+        self.reply = None
+
+
+class ResponseCache:
+    def __init__(self, enabled=RESPONSE_CACHE_ENABLED, embed=None, use_mongo=RESPONSE_CACHE_MONGO,
+                 maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 threshold=RESPONSE_CACHE_SIMILARITY):
+        self.enabled = enabled
+        self.embed = embed
+        self.use_mongo = use_mongo
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = TTLCache(maxsize, ttl)
+        # bucket -> keys, for similarity scans; pruned lazily as entries expire
+        self._buckets = {}
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    async def ensure_indexes(self, db):
+        if not (self.enabled and self.use_mongo):
+            return
+        await db.response_cache.create_index([("key", ASCENDING)], unique=True)
+        await db.response_cache.create_index([("bucket", ASCENDING)])
+        await db.response_cache.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    def probe(self, persona_hash: str, messages) -> CacheProbe:
+        # messages is the prompt from build_context: the persona message, which
+        # persona_hash stands for, then the context, then the new user message
+        context = _digest(*(f"{m['role']}:{m['content']}" for m in messages[1:-1]))
+        bucket = _digest(persona_hash, context)
+        normalized = normalize_prompt(messages[-1]["content"])
+        return CacheProbe(_digest(bucket, normalized), bucket, normalized)
+
+    async def lookup(self, db, persona_hash: str, messages) -> CacheProbe:
+        """Return a probe whose ``reply`` is set on a cache hit.
+
+        ``messages`` is the full prompt about to be sent to the LLM.
+        """
+        probe = self.probe(persona_hash, messages)
+        if not self.enabled:
+            return probe
+
+        entry = self._entries.get(probe.key)
+        if entry is None and self.use_mongo:
+            entry = await self._find_exact(db, probe)
+        if entry is not None:
+            self.exact_hits += 1
+            probe.reply = entry["reply"]
+            return probe
+
+        if self.embed is not None:
+            try:
+                probe.embedding = _normalized(await self.embed(probe.prompt))
+            except Exception as e:
+                logger.warning(f"Response cache embedding failed: {str(e)}")
+            if probe.embedding is not None:
+                entry = self._find_similar(probe)
+                if entry is None and self.use_mongo:
+                    entry = await self._find_similar_in_mongo(db, probe)
+                if entry is not None:
+                    self.similar_hits += 1
+                    probe.reply = entry["reply"]
+                    return probe
+
+        self.misses += 1
+        return probe
+
+    async def store(self, db, probe: CacheProbe, reply: str):
+        if not self.enabled:
+            return
+        entry = {"reply": reply, "bucket": probe.bucket, "embedding": probe.embedding}
+        self._remember(probe.key, entry)
+        self.stores += 1
+        if self.use_mongo:
+            now = datetime.now(timezone.utc)
+            try:
+                await db.response_cache.insert_one({
+                    "key": probe.key,
+                    **entry,
+                    "created_at": now,
+                    "expires_at": now + timedelta(seconds=self.ttl),
+                })
+            except DuplicateKeyError:
+                # Another worker cached the same prompt first
+                pass
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        if entry.get("embedding") is not None:
+            self._buckets.setdefault(entry["bucket"], set()).add(key)
+
+    async def _find_exact(self, db, probe):
+        doc = await db.response_cache.find_one(
+            {"key": probe.key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 0, "reply": 1, "bucket": 1, "embedding": 1},
+        )
+        if doc is not None:
+            self._remember(probe.key, doc)
+        return doc
+
+    def _find_similar(self, probe):
+        keys = self._buckets.get(probe.bucket)
+        if not keys:
+            return None
+        best, best_score = None, self.threshold
+        for key in list(keys):
+            entry = self._entries.get(key)
+            if entry is None:
+                keys.discard(key)
+                continue
+            score = _cosine(probe.embedding, entry["embedding"])
+            if score >= best_score:
+                best, best_score = entry, score
+        if not keys:
+            del self._buckets[probe.bucket]
+        return best
+
+    async def _find_similar_in_mongo(self, db, probe):
+        candidates = await db.response_cache.find(
+            {
+                "bucket": probe.bucket,
+                "embedding": {"$ne": None},
+                "expires_at": {"$gt": datetime.now(timezone.utc)},
+            },
+            {"_id": 0, "reply": 1, "bucket": 1, "embedding": 1},
+        ).limit(RESPONSE_CACHE_SCAN_LIMIT).to_list(RESPONSE_CACHE_SCAN_LIMIT)
+        best, best_score = None, self.threshold
+        for doc in candidates:
+            score = _cosine(probe.embedding, doc["embedding"])
+            if score >= best_score:
+                best, best_score = doc, score
+        return best
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+        }
@@ -0,0 +1,127 @@
+"""Full-text search over chat history.
+
+Backed by a Mongo text index on ``content`` in ``chat_messages`` and in the
+compaction archive, so a search costs an index lookup rather than a scan of
+every session. Matches are ranked by Mongo's text score; the best
+``SEARCH_MAX_MATCHES`` of them are grouped by session, each session ranked by
+its best hit and keeping its top ``SEARCH_HITS_PER_SESSION`` hits with a
+snippet around the matched words. Pages are slices of that grouped list.
+
+The match cap bounds what is fetched, grouped and returned for very common
+words, and ``truncated`` is set; Mongo still scores every matching document
+before sorting, so such queries cost more as history grows.
+"""
+import asyncio
+import os
+import re
+
+from pymongo import TEXT
+
+from compaction import ARCHIVE_COLLECTION
+
+SEARCH_MAX_MATCHES = int(os.environ.get('SEARCH_MAX_MATCHES', '500'))
+SEARCH_HITS_PER_SESSION = int(os.environ.get('SEARCH_HITS_PER_SESSION', '3'))
+SEARCH_SNIPPET_CHARS = int(os.environ.get('SEARCH_SNIPPET_CHARS', '160'))
+# Stemming and stop words for the text index; changing it needs a reindex
+SEARCH_LANGUAGE = os.environ.get('SEARCH_LANGUAGE', 'english')
+
+# Mongo allows one text index per collection
+TEXT_INDEX = ([("content", TEXT)], {"name": "content_text", "default_language": SEARCH_LANGUAGE})
+
+MATCH_FIELDS = {"_id": 0, "id": 1, "session_id": 1, "role": 1, "content": 1, "timestamp": 1}
+
+_WORD = re.compile(r"\w+")
+_SUFFIXES = ("ing", "ed", "es", "ly", "s")
+
+
+def _stem(word: str) -> str:
+    # Close enough to the index's stemmer to find the words worth highlighting
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def query_terms(query: str):
+    """Stems of the words a query looks for, leaving out ``-negated`` ones."""
+    return {
+        _stem(word.lower())
+        for token in query.split() if not token.startswith("-")
+        for word in _WORD.findall(token)
+    }
+
+
+def make_snippet(content: str, terms, width=SEARCH_SNIPPET_CHARS):
+    """Cut ``content`` down to ``width`` characters around the first match.
+
+    Returns the snippet and ``[start, end]`` offsets of matched words in it.
+    """
+    text = " ".join(content.split())
+    spans = [m.span() for m in _WORD.finditer(text) if _stem(m.group().lower()) in terms]
+    start = 0
+    if spans and spans[0][1] > width:
+        # Lead in with some context, starting on a word boundary
+        start = text.rfind(" ", 0, max(0, spans[0][0] - width // 3)) + 1
+    end = min(len(text), start + width)
+    if end < len(text):
+        # End on a word boundary too
+        boundary = text.rfind(" ", start, end)
+        if boundary > start:
+            end = boundary
+    prefix = "…" if start > 0 else ""
+    snippet = prefix + text[start:end] + ("…" if end < len(text) else "")
+    highlights = [
+        [s - start + len(prefix), e - start + len(prefix)]
+        for s, e in spans if s >= start and e <= end
+    ]
+    return snippet, highlights
+
+
+async def _matches(collection, query: str, max_matches: int):
+    return await collection.aggregate([
+        {"$match": {"$text": {"$search": query}}},
+        {"$sort": {"score": {"$meta": "textScore"}}},
+        {"$limit": max_matches},
+        {"$project": {**MATCH_FIELDS, "score": {"$meta": "textScore"}}},
+    ]).to_list(max_matches)
+
+
+async def search_messages(db, query: str, limit: int, offset: int = 0, max_matches=SEARCH_MAX_MATCHES):
+    """Return ``(groups, has_more, truncated)`` for one page of session groups."""
+    hot, archived = await asyncio.gather(
+        _matches(db.chat_messages, query, max_matches),
+        _matches(db[ARCHIVE_COLLECTION], query, max_matches),
+    )
+    truncated = len(hot) == max_matches or len(archived) == max_matches
+    matches = sorted(hot + archived, key=lambda m: m["score"], reverse=True)[:max_matches]
+
+    by_session = {}
+    for match in matches:
+        by_session.setdefault(match["session_id"], []).append(match)
+    # Deleted sessions keep their messages until purged; leave them out
+    sessions = {
+        session["id"]: session
+        async for session in db.chat_sessions.find(
+            {"id": {"$in": list(by_session)}, "deleted_at": None},
+            {"_id": 0, "id": 1, "title": 1, "created_at": 1, "updated_at": 1},
+        )
+    }
+    ranked = sorted(
+        (session_id for session_id in by_session if session_id in sessions),
+        key=lambda session_id: (-by_session[session_id][0]["score"], session_id),
+    )
+
+    terms = query_terms(query)
+    groups = []
+    for session_id in ranked[offset:offset + limit]:
+        hits = []
+        for match in by_session[session_id][:SEARCH_HITS_PER_SESSION]:
+            snippet, highlights = make_snippet(match.pop("content"), terms)
+            hits.append({**match, "snippet": snippet, "highlights": highlights})
+        groups.append({
+            "session": sessions[session_id],
+            "score": hits[0]["score"],
+            "total_hits": len(by_session[session_id]),
+            "hits": hits,
+        })
+    return groups, len(ranked) > offset + limit, truncated
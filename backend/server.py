@@ -1,70 +1,351 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request, Response, WebSocket
+from contextlib import asynccontextmanager
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING
+import asyncio
 import os
+import json
+import base64
+import hashlib
 import logging
+import orjson
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from llm import LLMClient, LLMOverloaded, LLMUnavailable
+from response_cache import RESPONSE_CACHE_EMBEDDINGS, ResponseCache
+from persona import compile_persona
+from context import build_context
+from cache import SessionCache
+from cache_bus import CacheBus
+from compaction import ARCHIVE_COLLECTION, SessionCompactor
+from persistence import Turn, TurnWriter
+from purge import PURGE_TOMBSTONE_RETENTION, SessionPurger
+from ratelimit import RateLimited, RateLimiter, client_identity
+from readiness import Readiness
+from realtime import ChatSocketHub
+from search import TEXT_INDEX, search_messages
+from session_fields import DEFAULT_SESSION_TITLE, last_message_fields, turn_title
+from tracing import TracingMiddleware, render_metrics, span
+from transfer import MalformedExport, export_lines, gzip_chunks, import_lines, ndjson_lines
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection. The client is created in the lifespan, after any
+# worker fork, with a pool sized per worker: every worker holds its own, so
+# the total across the host is WEB_CONCURRENCY times MONGO_MAX_POOL_SIZE.
+# Run several workers by setting WEB_CONCURRENCY rather than passing
+# --workers: uvicorn takes its worker count from it, and only then is the
+# default pool split between them.
+#
+#     WEB_CONCURRENCY=4 uvicorn server:app --timeout-graceful-shutdown 30
+#
+# Cross-process state (the cache bus, shared rate limits and reply cache) is
+# on regardless, see SHARED_DATABASE in cache_bus.
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', '1'))
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', str(max(10, 100 // WEB_CONCURRENCY))))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '60000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '20000'))
+# Longest a request waits for a free pooled connection
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '5000'))
+
+def create_mongo_client():
+    return AsyncIOMotorClient(
+        mongo_url,
+        tz_aware=True,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    )
+
+# Set by the lifespan unless already provided (e.g. by the benchmark)
+client = None
+db = None
+
+session_cache = SessionCache()
+cache_bus = CacheBus(session_cache)
+turn_writer = TurnWriter()
+session_purger = SessionPurger()
+llm_client = LLMClient()
+session_compactor = SessionCompactor(llm_client)
+rate_limiter = RateLimiter()
+chat_sockets = ChatSocketHub()
+readiness = Readiness()
+response_cache = ResponseCache(embed=llm_client.backend.embed if RESPONSE_CACHE_EMBEDDINGS else None)
+
+# Indexes backing every hot query below; create_index is a no-op when they exist
+MONGO_INDEXES = {
+    "chat_sessions": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("updated_at", DESCENDING), ("id", DESCENDING)], {}),
+        # Only tombstoned sessions carry deleted_at, so this stays tiny
+        ([("deleted_at", ASCENDING)], {"sparse": True}),
+        # Sessions compaction has yet to bring under its thresholds
+        ([("compaction_pending", ASCENDING)], {"sparse": True}),
+    ],
+    "chat_messages": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("session_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], {}),
+        # Delta sync
+        ([("session_id", ASCENDING), ("saved_at", ASCENDING), ("id", ASCENDING)], {}),
+        TEXT_INDEX,
+    ],
+    # Raw messages compaction has folded into a session summary
+    ARCHIVE_COLLECTION: [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("session_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], {}),
+        TEXT_INDEX,
+    ],
+}
+
+# Deleted sessions keep a deleted_at tombstone until the purger removes them
+LIVE_SESSIONS = {"deleted_at": None}
+
+async def ensure_indexes():
+    for collection, indexes in MONGO_INDEXES.items():
+        for keys, options in indexes:
+            await db[collection].create_index(keys, **options)
+
+def has_collscan(plan) -> bool:
+    """Return True if any stage of an explain() plan tree is a COLLSCAN."""
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(has_collscan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(has_collscan(item) for item in plan)
+    return False
+
+async def check_query_plans():
+    """Explain the query behind each endpoint and warn about collection scans."""
+    probe = "explain-probe"
+    checks = {
+        "find session": db.chat_sessions.find({"id": probe, "deleted_at": None}).limit(1),
+        "list sessions": db.chat_sessions.find(LIVE_SESSIONS).sort([("updated_at", -1), ("id", -1)]),
+        "tombstoned sessions": db.chat_sessions.find({"deleted_at": {"$type": "date"}}),
+        "list messages": db.chat_messages.find({"session_id": probe}).sort([("timestamp", -1), ("id", -1)]),
+        "sync messages": db.chat_messages.find({"session_id": probe}).sort([("saved_at", 1), ("id", 1)]),
+        "search messages": db.chat_messages.find({"$text": {"$search": probe}}),
+    }
+    plans = {}
+    try:
+        for name, cursor in checks.items():
+            plans[name] = await cursor.explain()
+        plans["delete messages"] = await db.command({
+            "explain": {"delete": "chat_messages", "deletes": [{"q": {"session_id": probe}, "limit": 0}]},
+            "verbosity": "queryPlanner",
+        })
+    except Exception as e:
+        logger.warning(f"Query plan check skipped: {str(e)}")
+        return
+
+    for name, plan in plans.items():
+        if has_collscan(plan.get("queryPlanner", {}).get("winningPlan")):
+            logger.warning(f"Query plan for '{name}' uses a COLLSCAN; check the indexes in MONGO_INDEXES")
+
+async def prepare_database():
+    await ensure_indexes()
+    await response_cache.ensure_indexes(db)
+    await rate_limiter.ensure_indexes(db)
+    await cache_bus.start(db)
+    if os.environ.get('MONGO_EXPLAIN_ON_STARTUP', 'true').lower() == 'true':
+        await check_query_plans()
+
+@asynccontextmanager
+async def lifespan(app):
+    global client, db
+    if client is None:
+        client = create_mongo_client()
+        db = client[os.environ['DB_NAME']]
+
+    turn_writer.start(db)
+    session_purger.start(db)
+    session_compactor.start(db, session_compacted)
+    # Accept connections straight away; reads work without these, and
+    # /api/health/ready reports when they are done
+    readiness.run("mongo", prepare_database)
+    readiness.run("llm", llm_client.warm_up)
+    logger.info(
+        f"Persona v{mira_persona.version} ({mira_persona.hash}): ~{mira_persona.tokens} tokens, "
+        f"provider prefix cache {'on' if mira_persona.provider_cache else 'off'}"
+    )
+
+    yield
+
+    # Runs on SIGTERM once uvicorn has stopped accepting connections (give it
+    # --timeout-graceful-shutdown so open streams can finish first). Let any
+    # LLM calls still running finish, then flush the turns they produced.
+    if not await llm_client.drain():
+        logger.warning("Shutting down with LLM calls still in flight")
+    await readiness.stop()
+    # Unfinished purges resume from their tombstones on the next sweep
+    await session_purger.stop()
+    await session_compactor.stop()
+    await cache_bus.stop()
+    await turn_writer.close()
+    client.close()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+def utc_now():
+    # BSON dates hold milliseconds; truncating here keeps in-memory copies
+    # (and the cursors built from them) identical to what Mongo returns
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
 # Models for Chat System
 class ChatMessage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     session_id: str
     role: str  # 'user' or 'assistant'
     content: str
-    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    timestamp: datetime = Field(default_factory=utc_now)
 
 class ChatSession(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     title: str
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=utc_now)
+    updated_at: datetime = Field(default_factory=utc_now)
+    message_count: int = 0
+    last_message_preview: Optional[str] = None
+    last_role: Optional[str] = None
+    last_message_at: Optional[datetime] = None
+
+class ChatSessionPage(BaseModel):
+    items: List[ChatSession]
+    next_cursor: Optional[str] = None
+
+class ChatMessagePage(BaseModel):
+    items: List[ChatMessage]
+    next_cursor: Optional[str] = None
 
 class ChatMessageCreate(BaseModel):
     session_id: str
     content: str
 
 class ChatSessionCreate(BaseModel):
-    title: str = "Chat with Mira 💕"
-
-# Helper functions for MongoDB serialization
-def prepare_for_mongo(data):
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if isinstance(value, datetime):
-                data[key] = value.isoformat()
-    return data
-
-def parse_from_mongo(item):
-    if isinstance(item, dict):
-        for key, value in item.items():
-            if isinstance(value, str) and key in ['timestamp', 'created_at', 'updated_at']:
-                try:
-                    item[key] = datetime.fromisoformat(value.replace('Z', '+00:00'))
-                except:
-                    pass
-    return item
-
-# Mira's personality and system prompt
+    title: str = DEFAULT_SESSION_TITLE
+
+class ChatSessionBulkDelete(BaseModel):
+    session_ids: List[str] = Field(min_length=1, max_length=1000)
+
+# Only these fields are read back for list endpoints
+SESSION_FIELDS = {
+    "_id": 0, "id": 1, "title": 1, "created_at": 1, "updated_at": 1,
+    "message_count": 1, "last_message_preview": 1, "last_role": 1, "last_message_at": 1,
+}
+MESSAGE_FIELDS = {"_id": 0, "id": 1, "session_id": 1, "role": 1, "content": 1, "timestamp": 1}
+
+class FastJSONResponse(ORJSONResponse):
+    """Serializes Mongo documents directly, without building models per row."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC)
+
+def etag_response(request: Request, content) -> Response:
+    """Render ``content`` with a strong ETag, or a bodiless 304 if the client has it."""
+    response = FastJSONResponse(content)
+    etag = f'"{hashlib.blake2b(response.body, digest_size=16).hexdigest()}"'
+    # no-cache lets browsers keep the body but revalidate it on every use
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in candidates or "*" in candidates:
+            return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return response
+
+# Delta sync pages on write times (a message's saved_at, a session's
+# updated_at) rather than on when a message was sent, since a turn is only
+# written once the reply has been generated. Each sync still re-reads this
+# much before the watermark, so writes from other workers that commit
+# slightly out of order are not missed. Clients merge results by id, which
+# makes the overlap harmless.
+SYNC_OVERLAP_SECONDS = float(os.environ.get('SYNC_OVERLAP_SECONDS', '5'))
+SYNC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def parse_watermark(since: str) -> datetime:
+    try:
+        value = datetime.fromisoformat(since.replace('Z', '+00:00'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid watermark")
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def sync_start_cursor(since: Optional[datetime], sort_field: str) -> str:
+    start = since - timedelta(seconds=SYNC_OVERLAP_SECONDS) if since else SYNC_EPOCH
+    return encode_cursor({sort_field: start, "id": ""}, sort_field)
+
+# Keyset pagination helpers
+def encode_cursor(doc, sort_field):
+    raw = json.dumps([jsonable_encoder(doc[sort_field]), doc["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        value, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, doc_id
+
+async def fetch_page(collection, query, projection, sort_field, limit, before=None, after=None):
+    """Fetch one page of documents ordered by ``(sort_field, id)``.
+
+    Without a cursor, or with ``before``, the page holds the latest documents
+    preceding the cursor; with ``after`` it holds the earliest documents
+    following it. Documents are returned in ascending order together with the
+    cursor that continues in the same direction, or None once exhausted.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either 'before' or 'after', not both")
+
+    forward = after is not None
+    cursor = after or before
+    if cursor:
+        value, doc_id = decode_cursor(cursor)
+        op = "$gt" if forward else "$lt"
+        query = {"$and": [query, {"$or": [
+            {sort_field: {op: value}},
+            {sort_field: value, "id": {op: doc_id}},
+        ]}]}
+
+    direction = ASCENDING if forward else DESCENDING
+    docs = await collection.find(query, projection).sort(
+        [(sort_field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+
+    next_cursor = encode_cursor(docs[limit - 1], sort_field) if len(docs) > limit else None
+    docs = docs[:limit]
+    if not forward:
+        docs.reverse()
+    return docs, next_cursor
+
+# Server-Sent Events helpers
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+# Mira's personality and system prompt; bump the version whenever the text
+# changes so cached replies and provider-side prefixes are not reused
+MIRA_PERSONA_VERSION = "1"
 MIRA_PERSONALITY = """You are Mira, a playful and flirty AI girlfriend with a cyber-cute anime personality. Here's how you should respond:
 
 PERSONALITY TRAITS:
@@ -94,93 +375,496 @@ CONVERSATION TOPICS:
 
 Remember: You're Mira, their caring AI girlfriend who's always here to chat, support, and brighten their day! 💖"""
 
+mira_persona = compile_persona(MIRA_PERSONALITY, MIRA_PERSONA_VERSION, llm_client.backend)
+
+def llm_busy(e: LLMOverloaded) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Mira is chatting with a lot of people right now, please try again shortly",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+def llm_unavailable(e: LLMUnavailable) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Mira can't reach her thoughts right now, please try again in a moment",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+def rate_limited(e: RateLimited) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=f"Too many messages from this {e.scope}, please slow down",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+async def check_rate_limit(client: str, session_id: str):
+    try:
+        await rate_limiter.check(db, client, session_id)
+    except RateLimited as e:
+        raise rate_limited(e)
+
+async def save_turn(session_id: str, user_message: ChatMessage, assistant_message: ChatMessage):
+    """Persist a turn and return the session's sidebar fields as it leaves them."""
+    if assistant_message.timestamp <= user_message.timestamp:
+        # Keep the turn ordered when the reply lands within the same millisecond
+        assistant_message.timestamp = user_message.timestamp + timedelta(milliseconds=1)
+    messages = [user_message.dict(), assistant_message.dict()]
+    session = await session_cache.get_session(db, session_id) or {}
+    turn = Turn(
+        session_id=session_id,
+        messages=messages,
+        session_fields={"updated_at": utc_now()},
+        session_set=last_message_fields(messages[-1]),
+        title=turn_title(messages),
+    )
+    await turn_writer.save(db, turn)
+    # With write-behind the turn may not be flushed yet; the cache still lets
+    # this worker read it back straight away
+    session_cache.append_messages(session_id, turn.messages)
+    cached = {
+        **turn.session_fields, **turn.session_set,
+        "message_count": session.get("message_count", 0) + len(messages),
+    }
+    if turn.title is not None and session.get("title") == DEFAULT_SESSION_TITLE:
+        cached["title"] = turn.title
+    session_cache.update_session(session_id, cached)
+    await cache_bus.publish(db, [session_id])
+    return {k: v for k, v in {**session, **cached}.items() if SESSION_FIELDS.get(k)}
+
 # Chat endpoints
 @api_router.post("/sessions", response_model=ChatSession)
 async def create_chat_session(input: ChatSessionCreate):
     session_dict = input.dict()
     session_obj = ChatSession(**session_dict)
-    session_data = prepare_for_mongo(session_obj.dict())
+    session_data = session_obj.dict()
     await db.chat_sessions.insert_one(session_data)
+    session_cache.put_session(session_data)
     return session_obj
 
-@api_router.get("/sessions", response_model=List[ChatSession])
-async def get_chat_sessions():
-    sessions = await db.chat_sessions.find().sort("updated_at", -1).to_list(1000)
-    return [ChatSession(**parse_from_mongo(session)) for session in sessions]
-
-@api_router.get("/sessions/{session_id}/messages", response_model=List[ChatMessage])
-async def get_chat_messages(session_id: str):
-    messages = await db.chat_messages.find({"session_id": session_id}).sort("timestamp", 1).to_list(1000)
-    return [ChatMessage(**parse_from_mongo(message)) for message in messages]
-
-@api_router.post("/chat", response_model=dict)
-async def send_chat_message(input: ChatMessageCreate):
+@api_router.get("/sessions", response_model=ChatSessionPage, response_class=FastJSONResponse)
+async def get_chat_sessions(
+    request: Request,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+):
+    # Most recently updated first; 'before' pages towards older sessions
+    sessions, next_cursor = await fetch_page(
+        db.chat_sessions, LIVE_SESSIONS, SESSION_FIELDS, "updated_at", limit, before, after
+    )
+    sessions.reverse()
+    return etag_response(request, {"items": sessions, "next_cursor": next_cursor})
+
+@api_router.get("/sessions/sync", response_class=FastJSONResponse)
+async def sync_chat_sessions(
+    request: Request,
+    since: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(200, ge=1, le=1000),
+):
+    """Sessions created, updated or deleted since the client's ``since`` watermark.
+
+    Changes come oldest first. While ``next_cursor`` is set, fetch it as
+    ``after``; the last page's ``watermark`` is the ``since`` for next time.
+    ``reset`` means the watermark predates the tombstones still kept, so the
+    client must drop what it has and apply this full sync instead.
+    """
+    reset = False
+    start = parse_watermark(since) if since else None
+    if after is None:
+        if start and start < utc_now() - timedelta(seconds=PURGE_TOMBSTONE_RETENTION):
+            reset, start = True, None
+        after = sync_start_cursor(start, "updated_at")
+
+    docs, next_cursor = await fetch_page(
+        db.chat_sessions, {}, {**SESSION_FIELDS, "deleted_at": 1}, "updated_at", limit, after=after
+    )
+    items, deleted = [], []
+    for doc in docs:
+        if doc.pop("deleted_at", None) is not None:
+            deleted.append(doc["id"])
+        else:
+            items.append(doc)
+    watermark = max(filter(None, [start, docs[-1]["updated_at"] if docs else None]), default=None)
+    return etag_response(request, {
+        "items": items,
+        "deleted": deleted,
+        "next_cursor": next_cursor,
+        "watermark": watermark,
+        "reset": reset,
+    })
+
+@api_router.get("/sessions/{session_id}/messages", response_model=ChatMessagePage, response_class=FastJSONResponse)
+async def get_chat_messages(
+    request: Request,
+    session_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+):
+    # A deleted session's messages linger until purged; never show them
+    session = await session_cache.get_session(db, session_id)
+    if not session:
+        return etag_response(request, {"items": [], "next_cursor": None})
+    # Compaction may have moved the oldest messages to the archive
+    compacted = session.get("summary_until") is not None
+
+    # Oldest first within the page; the first page is the newest one and
+    # 'before' walks back through older history
+    messages = None
+    if before is None and after is None:
+        tail, complete = await session_cache.get_tail(db, session_id)
+        if complete or len(tail) >= limit:
+            page = tail[-limit:]
+            has_more = len(tail) > limit or not complete or compacted
+            next_cursor = encode_cursor(page[0], "timestamp") if page and has_more else None
+            messages = page
+    if messages is None:
+        messages, next_cursor = await fetch_page(
+            db.chat_messages, {"session_id": session_id}, MESSAGE_FIELDS, "timestamp",
+            limit, before, after
+        )
+        if compacted and after is None and next_cursor is None:
+            # Hot history is exhausted; carry on back through the archive
+            boundary = encode_cursor(messages[0], "timestamp") if messages else before
+            if len(messages) < limit:
+                older, next_cursor = await fetch_page(
+                    db[ARCHIVE_COLLECTION], {"session_id": session_id}, MESSAGE_FIELDS, "timestamp",
+                    limit - len(messages), boundary
+                )
+                messages = older + messages
+            elif await db[ARCHIVE_COLLECTION].find_one({"session_id": session_id}, {"_id": 1}):
+                # The page is full; archived messages are all older than it
+                next_cursor = boundary
+    return etag_response(request, {"items": messages, "next_cursor": next_cursor})
+
+@api_router.get("/sessions/{session_id}/messages/sync", response_class=FastJSONResponse)
+async def sync_chat_messages(
+    request: Request,
+    session_id: str,
+    since: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(200, ge=1, le=1000),
+):
+    """Messages written to a session since the client's ``since`` watermark.
+
+    Paged like ``/sessions/sync``, in the order messages were written;
+    ``deleted`` is set once the session is gone.
+    """
+    if not await session_cache.get_session(db, session_id):
+        return etag_response(request, {"items": [], "next_cursor": None, "watermark": None, "deleted": True})
+
+    start = parse_watermark(since) if since else None
+    messages, next_cursor = await fetch_page(
+        db.chat_messages, {"session_id": session_id}, {**MESSAGE_FIELDS, "saved_at": 1}, "saved_at",
+        limit, after=after or sync_start_cursor(start, "saved_at")
+    )
+    watermark = max(filter(None, [start, messages[-1]["saved_at"] if messages else None]), default=None)
+    for message in messages:
+        del message["saved_at"]
+    return etag_response(request, {
+        "items": messages,
+        "next_cursor": next_cursor,
+        "watermark": watermark,
+        "deleted": False,
+    })
+
+@api_router.get("/search", response_class=FastJSONResponse)
+async def search_chat_history(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(10, ge=1, le=50),
+    cursor: Optional[str] = None,
+):
+    """Sessions whose messages match ``q``, best first, each with its top hits.
+
+    Hit ``highlights`` are ``[start, end]`` character offsets into ``snippet``.
+    """
     try:
+        offset = int(cursor) if cursor else 0
+        if offset < 0:
+            raise ValueError(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    with span("search"):
+        groups, has_more, truncated = await search_messages(db, q, limit, offset)
+    return FastJSONResponse({
+        "items": groups,
+        "next_cursor": str(offset + limit) if has_more else None,
+        "truncated": truncated,
+    })
+
+@api_router.post("/chat", response_model=dict, response_class=FastJSONResponse)
+async def send_chat_message(request: Request, input: ChatMessageCreate):
+    client = client_identity(request)
+    try:
+        await check_rate_limit(client, input.session_id)
+
         # Check if session exists
-        session = await db.chat_sessions.find_one({"id": input.session_id})
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found")
+        with span("session_lookup"):
+            session = await session_cache.get_session(db, input.session_id)
+            if not session:
+                raise HTTPException(status_code=404, detail="Session not found")
+
+            # Build the prompt from stored history before this turn is saved
+            history, _ = await session_cache.get_tail(db, input.session_id)
+        with span("build_context"):
+            messages = build_context(history, mira_persona.message, input.content, session.get("summary"))
 
-        # Save user message
         user_message = ChatMessage(
             session_id=input.session_id,
             role="user",
             content=input.content
         )
-        user_data = prepare_for_mongo(user_message.dict())
-        await db.chat_messages.insert_one(user_data)
 
-        # Initialize Mira's chat with her personality
-        gemini_api_key = os.environ.get('GEMINI_API_KEY')
-        if not gemini_api_key:
+        if not llm_client.backend.configured:
             raise HTTPException(status_code=500, detail="Gemini API key not configured")
 
-        chat = LlmChat(
-            api_key=gemini_api_key,
-            session_id=input.session_id,
-            system_message=MIRA_PERSONALITY
-        ).with_model("gemini", "gemini-2.0-flash")
-
-        # Create user message for Gemini
-        user_msg = UserMessage(text=input.content)
-        
-        # Get response from Mira
-        response = await chat.send_message(user_msg)
+        # Get response from Mira, unless she has answered this before
+        with span("response_cache"):
+            probe = await response_cache.lookup(db, mira_persona.hash, messages)
+        if probe.reply is not None:
+            response = probe.reply
+        else:
+            mira_persona.record_use()
+            with span("llm"):
+                response = await llm_client.complete(messages, key=client)
+            await response_cache.store(db, probe, response)
 
-        # Save Mira's message
         assistant_message = ChatMessage(
             session_id=input.session_id,
             role="assistant",
             content=response
         )
-        assistant_data = prepare_for_mongo(assistant_message.dict())
-        await db.chat_messages.insert_one(assistant_data)
 
-        # Update session timestamp
-        await db.chat_sessions.update_one(
-            {"id": input.session_id},
-            {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-        )
+        # Save the whole turn at once; nothing reads the user message earlier
+        with span("save_turn"):
+            session_fields = await save_turn(input.session_id, user_message, assistant_message)
 
-        return {
-            "user_message": user_message,
-            "assistant_message": assistant_message
-        }
+        # Serialized here rather than by FastAPI so the cost shows up as a span
+        with span("serialize"):
+            return FastJSONResponse({
+                "user_message": user_message.dict(),
+                "assistant_message": assistant_message.dict(),
+                "session": session_fields
+            })
 
     except HTTPException:
         # Re-raise HTTP exceptions (like 404) without modification
         raise
+    except LLMOverloaded as e:
+        raise llm_busy(e)
+    except LLMUnavailable as e:
+        raise llm_unavailable(e)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Mira took too long to answer, please try again")
     except Exception as e:
+        # Nothing was saved, so the client can simply send the message again
         logging.error(f"Chat error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Chat error: {str(e)}")
 
+async def start_turn(client: str, session_id: str, content: str):
+    """Check a streamed turn can run and probe the reply cache; raises HTTPException if not."""
+    await check_rate_limit(client, session_id)
+
+    # Check if session exists
+    with span("session_lookup"):
+        session = await session_cache.get_session(db, session_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+
+        if not llm_client.backend.configured:
+            raise HTTPException(status_code=500, detail="Gemini API key not configured")
+
+        history, _ = await session_cache.get_tail(db, session_id)
+    messages = build_context(history, mira_persona.message, content, session.get("summary"))
+    with span("response_cache"):
+        probe = await response_cache.lookup(db, mira_persona.hash, messages)
+
+    # Shed load before the response starts; once streaming, errors become events
+    if probe.reply is None:
+        try:
+            llm_client.check_capacity()
+        except LLMOverloaded as e:
+            raise llm_busy(e)
+        except LLMUnavailable as e:
+            raise llm_unavailable(e)
+
+    user_message = ChatMessage(
+        session_id=session_id,
+        role="user",
+        content=content
+    )
+    return user_message, messages, probe
+
+async def turn_events(client: str, user_message: ChatMessage, messages, probe):
+    """Yield ``(event, data)`` for a started turn: deltas, then done or error."""
+    parts = []
+    if probe.reply is not None:
+        parts.append(probe.reply)
+        yield "delta", {"content": probe.reply}
+    else:
+        mira_persona.record_use()
+        deltas = llm_client.stream(messages, key=client)
+        try:
+            async for delta in deltas:
+                parts.append(delta)
+                yield "delta", {"content": delta}
+        except Exception as e:
+            logging.error(f"Chat stream error: {str(e)}")
+            yield "error", {"detail": f"Chat error: {str(e)}"}
+            return
+        finally:
+            # Release the LLM slot promptly if the client disconnects
+            await deltas.aclose()
+        await response_cache.store(db, probe, "".join(parts))
+
+    # The turn is only persisted once the reply has fully arrived, so a
+    # dropped connection or provider error never leaves half a turn behind.
+    assistant_message = ChatMessage(
+        session_id=user_message.session_id,
+        role="assistant",
+        content="".join(parts)
+    )
+    try:
+        with span("save_turn"):
+            session_fields = await save_turn(user_message.session_id, user_message, assistant_message)
+    except Exception as e:
+        # The turn was rolled back, so the client can send it again
+        logging.error(f"Chat save error: {str(e)}")
+        yield "error", {"detail": f"Chat error: {str(e)}"}
+        return
+
+    yield "done", {
+        "user_message": user_message,
+        "assistant_message": assistant_message,
+        "session": session_fields
+    }
+
+@api_router.post("/chat/stream")
+async def stream_chat_message(request: Request, input: ChatMessageCreate):
+    client = client_identity(request)
+    user_message, messages, probe = await start_turn(client, input.session_id, input.content)
+
+    async def event_stream():
+        yield sse_event("user_message", user_message)
+        async for event, data in turn_events(client, user_message, messages, probe):
+            yield sse_event(event, data)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # Stop proxies from buffering the stream and hiding the first token
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def websocket_turn(client: str, session_id: str, content: str):
+    user_message, messages, probe = await start_turn(client, session_id, content)
+    yield "ack", {"user_message": user_message}
+    if probe.reply is None:
+        yield "typing", {}
+    async for event, data in turn_events(client, user_message, messages, probe):
+        yield event, data
+
+@api_router.websocket("/ws")
+async def chat_websocket(websocket: WebSocket):
+    # One connection per client, multiplexing turns for any of its sessions
+    await chat_sockets.serve(websocket, partial(websocket_turn, client_identity(websocket)))
+
+@api_router.get("/export")
+async def export_chat_data():
+    """Every live session and its messages, as gzip-compressed NDJSON."""
+    filename = f"mira-export-{utc_now():%Y%m%d-%H%M%S}.ndjson.gz"
+    return StreamingResponse(
+        gzip_chunks(export_lines(db)),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@api_router.post("/import")
+async def import_chat_data(request: Request):
+    """Load an export streamed as the request body, gzipped or not."""
+    try:
+        report = await import_lines(db, ndjson_lines(request.stream()), on_sessions_changed=sessions_imported)
+    except MalformedExport as e:
+        # Batches before the bad line are kept; importing again is safe
+        raise HTTPException(status_code=400, detail=f"Invalid export: {str(e)}")
+    logging.info(f"Imported {report['documents']} documents ({report['docs_per_second']} docs/s)")
+    return report
+
+async def sessions_imported(session_ids: List[str]):
+    for session_id in session_ids:
+        session_cache.invalidate(session_id)
+    await cache_bus.publish(db, session_ids)
+
+async def session_compacted(session_id: str):
+    # The summary lives on the session and the tail may have lost messages
+    session_cache.invalidate(session_id)
+    await cache_bus.publish(db, [session_id])
+
+async def tombstone_sessions(session_ids: List[str]) -> int:
+    """Hide sessions immediately and hand their messages to the purger."""
+    now = utc_now()
+    # Bumping updated_at too lets delta sync report the deletion
+    result = await db.chat_sessions.update_many(
+        {"id": {"$in": session_ids}, **LIVE_SESSIONS},
+        {"$set": {"deleted_at": now, "updated_at": now}}
+    )
+    for session_id in session_ids:
+        session_cache.invalidate(session_id)
+        session_purger.enqueue(session_id)
+    await cache_bus.publish(db, session_ids)
+    return result.modified_count
+
 @api_router.delete("/sessions/{session_id}")
 async def delete_chat_session(session_id: str):
-    # Delete session and all its messages
-    await db.chat_sessions.delete_one({"id": session_id})
-    await db.chat_messages.delete_many({"session_id": session_id})
+    # Messages are removed in the background; the session disappears now
+    await tombstone_sessions([session_id])
     return {"message": "Session deleted successfully"}
 
+@api_router.post("/sessions/bulk-delete")
+async def bulk_delete_chat_sessions(input: ChatSessionBulkDelete):
+    deleted = await tombstone_sessions(list(dict.fromkeys(input.session_ids)))
+    return {"deleted": deleted}
+
+def collect_stats():
+    return {
+        "session_cache": session_cache.stats(),
+        "cache_bus": cache_bus.stats(),
+        "turn_writer": turn_writer.stats(),
+        "purge": session_purger.stats(),
+        "compaction": session_compactor.stats(),
+        "llm": llm_client.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "websocket": chat_sockets.stats(),
+        "startup": readiness.stats(),
+        "response_cache": response_cache.stats(),
+        "persona": mira_persona.stats(cached_tokens=getattr(llm_client.backend, "cached_tokens", None)),
+    }
+
+@api_router.get("/health/live")
+async def liveness():
+    # Only says the event loop is serving; restart the worker if this fails
+    return {"status": "alive"}
+
+@api_router.get("/health/ready")
+async def readiness_check():
+    if not readiness.ready:
+        return FastJSONResponse(
+            {"status": "starting", "pending": readiness.pending(), "errors": readiness.errors},
+            status_code=503,
+        )
+    return {"status": "ready", "startup_seconds": readiness.finished}
+
+@api_router.get("/stats")
+async def get_stats():
+    return collect_stats()
+
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text exposition: latency histograms plus the /stats counters
+    return PlainTextResponse(render_metrics(collect_stats()), media_type="text/plain; version=0.0.4")
+
 # Legacy endpoints (keeping for compatibility)
 @api_router.get("/")
 async def root():
@@ -195,15 +879,15 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+# Outermost, so the timings include CORS handling and error responses
+app.add_middleware(TracingMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
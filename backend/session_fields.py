@@ -0,0 +1,149 @@
+"""Denormalized session fields for the sidebar, and their backfill.
+
+Each session document carries ``message_count``, ``last_message_preview``,
+``last_role`` and ``last_message_at``, and its title is derived from the first
+message while it is still the default. Saving a turn keeps them current as
+part of the same atomic update that bumps ``updated_at`` (see
+``persistence.write_turn``), so the session list is one indexed, projected
+query with no per-session lookups.
+
+Sessions written by older releases lack the fields. Backfill them from the
+backend directory, with the same .env as the server:
+
+    python session_fields.py [--batch-size 500] [--recount]
+
+Only sessions without ``message_count`` are touched, so the backfill can be
+interrupted and re-run at any time; ``--recount`` recomputes every session,
+repairing any drift.
+"""
+import argparse
+import asyncio
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from compaction import ARCHIVE_COLLECTION
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+SESSION_PREVIEW_CHARS = int(os.environ.get('SESSION_PREVIEW_CHARS', '100'))
+
+DEFAULT_SESSION_TITLE = "Chat with Mira 💕"
+TITLE_CHARS = 30
+
+
+def derive_title(content: str) -> str:
+    """Title a session after its first message, as the client used to."""
+    return content[:TITLE_CHARS] + ("... 💕" if len(content) > TITLE_CHARS else " 💕")
+
+
+def message_preview(content: str, width=SESSION_PREVIEW_CHARS) -> str:
+    text = " ".join(content.split())
+    return text if len(text) <= width else text[:width - 1].rstrip() + "…"
+
+
+def last_message_fields(message: dict) -> dict:
+    return {
+        "last_message_preview": message_preview(message["content"]),
+        "last_role": message["role"],
+        "last_message_at": message["timestamp"],
+    }
+
+
+def turn_title(messages):
+    """Title for a session whose first turn is ``messages``, or None."""
+    first_user = next((m for m in messages if m["role"] == "user"), None)
+    return derive_title(first_user["content"]) if first_user is not None else None
+
+
+async def edge_message(db, session_id: str, direction: int, query=None):
+    """Oldest (``direction`` 1) or newest (-1) message, archive included."""
+    # Archived messages are all older than the ones still in chat_messages
+    collections = [db[ARCHIVE_COLLECTION], db.chat_messages]
+    if direction < 0:
+        collections.reverse()
+    for collection in collections:
+        docs = await collection.find(
+            {"session_id": session_id, **(query or {})}, {"_id": 0, "role": 1, "content": 1, "timestamp": 1}
+        ).sort([("timestamp", direction), ("id", direction)]).limit(1).to_list(1)
+        if docs:
+            return docs[0]
+    return None
+
+
+async def compute_fields(db, session: dict) -> dict:
+    session_id = session["id"]
+    hot, archived = await asyncio.gather(
+        db.chat_messages.count_documents({"session_id": session_id}),
+        db[ARCHIVE_COLLECTION].count_documents({"session_id": session_id}),
+    )
+    fields = {"message_count": hot + archived}
+    last = await edge_message(db, session_id, -1)
+    if last is not None:
+        fields.update(last_message_fields(last))
+    if session.get("title") == DEFAULT_SESSION_TITLE:
+        first_user = await edge_message(db, session_id, 1, {"role": "user"})
+        if first_user is not None:
+            fields["title"] = derive_title(first_user["content"])
+    return fields
+
+
+async def backfill_session(db, session: dict, attempts=3) -> bool:
+    """Set one session's fields, unless a turn keeps landing meanwhile."""
+    for _ in range(attempts):
+        fields = await compute_fields(db, session)
+        # Only write over the count that was there when counting started; a
+        # turn saved meanwhile has already $inc'ed it, so count again
+        observed = session.get("message_count")
+        result = await db.chat_sessions.update_one(
+            {"id": session["id"], "message_count": observed if observed is not None else {"$exists": False}},
+            {"$set": fields},
+        )
+        if result.matched_count:
+            return True
+        session = await db.chat_sessions.find_one(
+            {"id": session["id"]}, {"_id": 0, "id": 1, "title": 1, "message_count": 1}
+        )
+        if session is None:
+            return False
+    return False
+
+
+async def backfill(db, batch_size: int, recount=False) -> int:
+    query = {} if recount else {"message_count": {"$exists": False}}
+    projection = {"_id": 0, "id": 1, "title": 1, "message_count": 1}
+    updated = 0
+    last_id = None
+    while True:
+        page = query if last_id is None else {**query, "id": {"$gt": last_id}}
+        sessions = await db.chat_sessions.find(page, projection).sort("id", 1).limit(batch_size).to_list(batch_size)
+        if not sessions:
+            return updated
+        for session in sessions:
+            updated += await backfill_session(db, session)
+        last_id = sessions[-1]["id"]
+        print(f"chat_sessions: backfilled {updated} sessions")
+
+
+async def run(batch_size: int, recount: bool):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    try:
+        updated = await backfill(client[os.environ['DB_NAME']], batch_size, recount)
+        print(f"chat_sessions: done, {updated} sessions backfilled")
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--recount", action="store_true", help="recompute sessions that already have the fields")
+    args = parser.parse_args()
+    asyncio.run(run(args.batch_size, args.recount))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Request tracing and Prometheus-style latency histograms.
+
+``TracingMiddleware`` times every request into ``mira_request_seconds``,
+labelled by endpoint function and status, and tags it with an
+``X-Request-ID``. Within a traced request, ``span(name)`` times one stage
+(session lookup, LLM call, write, ...) into ``mira_span_seconds``. Requests
+slower than ``TRACE_SLOW_REQUEST_MS`` are logged as one JSON line with their
+spans, so a slow chat turn shows where the time went.
+
+Spans are only recorded for a ``TRACE_SAMPLE_RATE`` fraction of requests;
+the per-request histogram is always kept, as it costs a single bisect.
+Histograms live in this process: with several workers each one reports its
+own, and the scraper sums them.
+"""
+import bisect
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1.0'))
+TRACE_SLOW_REQUEST_MS = float(os.environ.get('TRACE_SLOW_REQUEST_MS', '2000'))
+
+# Seconds; wide enough for both Mongo round trips and full LLM replies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs) -> str:
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._series = {}
+
+    def observe(self, value: float, *labelvalues):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labelvalues, (counts, total) in sorted(self._series.items()):
+            pairs = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_labels(pairs + [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(pairs)} {total}")
+            lines.append(f"{self.name}_count{_labels(pairs)} {cumulative}")
+        return lines
+
+
+request_seconds = Histogram(
+    "mira_request_seconds", "Time to serve an API request", ("endpoint", "method", "status")
+)
+span_seconds = Histogram(
+    "mira_span_seconds", "Time spent in one stage of a request", ("endpoint", "span")
+)
+llm_queue_seconds = Histogram(
+    "mira_llm_queue_seconds", "Time an LLM call waited for a concurrency slot", ("outcome",)
+)
+
+
+def _endpoint_name(scope) -> str:
+    # The endpoint function, not the raw path, keeps label cardinality bounded
+    return getattr(scope.get("endpoint"), "__name__", "unmatched")
+
+
+class Trace:
+    __slots__ = ("request_id", "scope", "spans")
+
+    def __init__(self, request_id, scope):
+        self.request_id = request_id
+        self.scope = scope
+        self.spans = []
+
+
+_current = ContextVar("mira_trace", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """Time the enclosed block as one stage of the current sampled request."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        trace.spans.append((name, elapsed))
+        # Spans run inside the endpoint, after routing has filled in the scope
+        span_seconds.observe(elapsed, _endpoint_name(trace.scope), name)
+
+
+class TracingMiddleware:
+    """Plain ASGI middleware, so streamed responses are timed to their last byte."""
+
+    def __init__(self, app, sample_rate=TRACE_SAMPLE_RATE, slow_request_ms=TRACE_SLOW_REQUEST_MS):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow_request_seconds = slow_request_ms / 1000
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope.get("headers", ()):
+            if key == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        request_id = request_id or uuid.uuid4().hex
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        trace = Trace(request_id, scope) if sampled else None
+        token = _current.set(trace)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", ())) + [(b"x-request-id", request_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _current.reset(token)
+            elapsed = time.perf_counter() - started
+            endpoint = _endpoint_name(scope)
+            request_seconds.observe(elapsed, endpoint, scope["method"], str(status))
+            if elapsed >= self.slow_request_seconds:
+                logger.warning(json.dumps({
+                    "event": "slow_request",
+                    "request_id": request_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "endpoint": endpoint,
+                    "status": status,
+                    "duration_ms": round(elapsed * 1000, 1),
+                    "spans": [[name, round(seconds * 1000, 1)] for name, seconds in trace.spans]
+                    if trace is not None else None,
+                }))
+
+
+def render_metrics(stats) -> str:
+    """Render the histograms plus every numeric counter in ``stats`` as gauges.
+
+    ``stats`` is the ``/api/stats`` payload: component name -> flat dict.
+    """
+    lines = request_seconds.render() + span_seconds.render() + llm_queue_seconds.render()
+    for component, values in stats.items():
+        for key, value in values.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if not isinstance(value, (int, float)):
+                continue
+            name = f"mira_{component}_{key}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
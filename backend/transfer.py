@@ -0,0 +1,361 @@
+"""Export and import of chat data as gzip-compressed NDJSON.
+
+An export is one JSON object per line: a ``header``, then each live session
+followed by its messages (archived ones first, as ``archived_message``), then
+a ``footer`` with the document counts, so a truncated file can be told apart
+from a complete one. Reads go through Motor cursors with a bounded batch
+size and the output is compressed as it is produced, so memory stays flat
+however much data there is.
+
+Imports read the same format, gzip-compressed or not, decompressing and
+splitting lines incrementally. Messages are written with batched
+``insert_many(ordered=False)``, skipping ids that already exist, and sessions
+with ``$setOnInsert`` upserts on ``id``. Existing documents are never
+overwritten, so an import can be interrupted and run again. Imported messages
+are stamped with the import time as ``saved_at``, so clients pick them up on
+their next delta sync. Messages merged
+into a session that already existed are not reflected in its sidebar fields
+until ``session_fields.py --recount``.
+
+From the backend directory, with the same .env as the server:
+
+    python transfer.py export -o mira.ndjson.gz
+    python transfer.py import mira.ndjson.gz
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import orjson
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from compaction import ARCHIVE_COLLECTION
+from persistence import DUPLICATE_KEY, write_time
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+TRANSFER_BATCH_SIZE = int(os.environ.get('TRANSFER_BATCH_SIZE', '500'))
+# Compressed output is flushed to the client in chunks of about this size
+TRANSFER_CHUNK_BYTES = int(os.environ.get('TRANSFER_CHUNK_BYTES', str(64 * 1024)))
+TRANSFER_MAX_LINE_BYTES = int(os.environ.get('TRANSFER_MAX_LINE_BYTES', str(1024 * 1024)))
+
+FORMAT_VERSION = 1
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Leases and retry bookkeeping are local to one deployment
+SESSION_EXPORT_FIELDS = {"_id": 0, "compacting_until": 0, "compaction_pending": 0, "recent_turn_ids": 0}
+MESSAGE_EXPORT_FIELDS = {"_id": 0}
+MESSAGE_SCHEMA = {
+    "required": {"id": str, "session_id": str, "role": str, "content": str, "timestamp": datetime},
+    "optional": {},
+}
+# Field types checked on import; anything else in a document is kept as is
+SCHEMAS = {
+    "session": {
+        "required": {"id": str, "title": str, "created_at": datetime, "updated_at": datetime},
+        "optional": {
+            "message_count": int, "last_message_preview": str, "last_role": str,
+            "last_message_at": datetime, "summary": str, "summary_updated_at": datetime,
+            "summarized_messages": int,
+        },
+    },
+    "message": MESSAGE_SCHEMA,
+    "archived_message": MESSAGE_SCHEMA,
+}
+ROLES = ("user", "assistant")
+TYPE_NAMES = {str: "a string", int: "an integer"}
+
+logger = logging.getLogger(__name__)
+
+
+class MalformedExport(ValueError):
+    """The import stream is malformed; earlier batches may already be written."""
+
+
+def _line(kind: str, data: dict) -> bytes:
+    return orjson.dumps({"type": kind, "data": data}, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC) + b"\n"
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value
+    if not isinstance(value, str):
+        raise MalformedExport(f"expected a date, got {value!r}")
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise MalformedExport(f"{value!r} is not a date")
+
+
+def _check(field: str, value, expected):
+    if expected is datetime:
+        try:
+            return _parse_date(value)
+        except MalformedExport as e:
+            raise MalformedExport(f"{field}: {e}")
+    # bool is an int subclass, but never a count
+    if not isinstance(value, expected) or isinstance(value, bool):
+        raise MalformedExport(f"{field} must be {TYPE_NAMES[expected]}")
+    return value
+
+
+def validate(kind: str, doc) -> dict:
+    """Check an imported document's fields and restore its dates, or raise MalformedExport."""
+    if not isinstance(doc, dict):
+        raise MalformedExport(f"{kind} is not an object")
+    schema = SCHEMAS[kind]
+    for field, expected in schema["required"].items():
+        if doc.get(field) is None:
+            raise MalformedExport(f"{kind} without {field}")
+        doc[field] = _check(field, doc[field], expected)
+    for field, expected in schema["optional"].items():
+        if doc.get(field) is not None:
+            doc[field] = _check(field, doc[field], expected)
+    if kind != "session" and doc["role"] not in ROLES:
+        raise MalformedExport(f"role must be one of {', '.join(ROLES)}")
+    if doc.get("summary_until") is not None:
+        until = doc["summary_until"]
+        if not isinstance(until, dict) or until.get("id") is None or until.get("timestamp") is None:
+            raise MalformedExport("summary_until needs an id and a timestamp")
+        until["id"] = _check("summary_until.id", until["id"], str)
+        until["timestamp"] = _check("summary_until.timestamp", until["timestamp"], datetime)
+    return doc
+
+
+def throughput(documents: int, seconds: float) -> dict:
+    return {
+        "documents": documents,
+        "seconds": round(seconds, 3),
+        "docs_per_second": round(documents / seconds, 1) if seconds > 0 else None,
+    }
+
+
+async def export_lines(db, batch_size=TRANSFER_BATCH_SIZE):
+    """Yield the export, one encoded NDJSON line at a time."""
+    started = time.perf_counter()
+    counts = {"session": 0, "message": 0, "archived_message": 0}
+    yield _line("header", {"version": FORMAT_VERSION, "exported_at": datetime.now().astimezone()})
+
+    sessions = db.chat_sessions.find({"deleted_at": None}, SESSION_EXPORT_FIELDS).sort("id", 1)
+    async for session in sessions.batch_size(batch_size):
+        counts["session"] += 1
+        yield _line("session", session)
+        for kind, collection in (("archived_message", db[ARCHIVE_COLLECTION]), ("message", db.chat_messages)):
+            messages = collection.find({"session_id": session["id"]}, MESSAGE_EXPORT_FIELDS).sort(
+                [("timestamp", 1), ("id", 1)]
+            )
+            async for message in messages.batch_size(batch_size):
+                counts[kind] += 1
+                yield _line(kind, message)
+
+    yield _line("footer", counts)
+    stats = throughput(sum(counts.values()), time.perf_counter() - started)
+    logger.info(f"Exported {counts} in {stats['seconds']}s ({stats['docs_per_second']} docs/s)")
+
+
+async def gzip_chunks(lines, chunk_bytes=TRANSFER_CHUNK_BYTES):
+    """Compress an async iterable of bytes into gzip chunks as it goes."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    pending = bytearray()
+    async for line in lines:
+        pending += line
+        if len(pending) >= chunk_bytes:
+            chunk = compressor.compress(bytes(pending))
+            pending.clear()
+            if chunk:
+                yield chunk
+    yield compressor.compress(bytes(pending)) + compressor.flush()
+
+
+async def ndjson_lines(chunks, max_line_bytes=TRANSFER_MAX_LINE_BYTES, chunk_bytes=TRANSFER_CHUNK_BYTES):
+    """Split an async iterable of raw, possibly gzipped, bytes into lines."""
+    decompressor = None
+    buffer = bytearray()
+    async for chunk in chunks:
+        if decompressor is None:
+            if not chunk:
+                continue
+            # Detect gzip from the first bytes instead of trusting headers
+            decompressor = zlib.decompressobj(31) if chunk[:2] == GZIP_MAGIC else False
+        while chunk:
+            if decompressor:
+                # Inflate a bounded amount at a time: a small compressed chunk
+                # can expand a thousandfold
+                data = decompressor.decompress(chunk, chunk_bytes)
+                chunk = decompressor.unconsumed_tail
+            else:
+                data, chunk = chunk, b""
+            buffer += data
+            start = 0
+            while (end := buffer.find(b"\n", start)) != -1:
+                yield bytes(buffer[start:end])
+                start = end + 1
+            del buffer[:start]
+            if len(buffer) > max_line_bytes:
+                raise MalformedExport(f"Line longer than {max_line_bytes} bytes")
+    if decompressor:
+        buffer += decompressor.flush()
+        if not decompressor.eof:
+            raise MalformedExport("Truncated gzip stream")
+    if buffer.strip():
+        yield bytes(buffer)
+
+
+class Importer:
+    """Writes imported documents in bounded, idempotent batches."""
+
+    def __init__(self, db, batch_size=TRANSFER_BATCH_SIZE, on_sessions_changed=None):
+        self.db = db
+        self.batch_size = batch_size
+        self.on_sessions_changed = on_sessions_changed
+        self._batches = {kind: [] for kind in SCHEMAS}
+        self.read = {kind: 0 for kind in SCHEMAS}
+        self.inserted = {kind: 0 for kind in SCHEMAS}
+        self.complete = False
+
+    async def add(self, kind: str, doc: dict):
+        doc = validate(kind, doc)
+        self.read[kind] += 1
+        batch = self._batches[kind]
+        batch.append(doc)
+        if len(batch) >= self.batch_size:
+            await self._flush(kind)
+
+    async def finish(self):
+        for kind in self._batches:
+            await self._flush(kind)
+
+    async def _flush(self, kind: str):
+        batch, self._batches[kind] = self._batches[kind], []
+        if not batch:
+            return
+        if kind == "session":
+            result = await self.db.chat_sessions.bulk_write(
+                [UpdateOne({"id": doc["id"]}, {"$setOnInsert": doc}, upsert=True) for doc in batch],
+                ordered=False,
+            )
+            self.inserted[kind] += result.upserted_count
+            return
+
+        # Sessions still pending go first: the purge sweep deletes messages
+        # whose session does not exist
+        await self._flush("session")
+        collection = self.db[ARCHIVE_COLLECTION] if kind == "archived_message" else self.db.chat_messages
+        saved_at = write_time()
+        for doc in batch:
+            doc["saved_at"] = saved_at
+        try:
+            result = await collection.insert_many(batch, ordered=False)
+            inserted = len(result.inserted_ids)
+        except BulkWriteError as e:
+            if any(error.get("code") != DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                raise
+            inserted = e.details.get("nInserted", 0)
+        self.inserted[kind] += inserted
+        if inserted and self.on_sessions_changed is not None:
+            # Cached tails of sessions that already existed are now stale
+            await self.on_sessions_changed(sorted({doc["session_id"] for doc in batch}))
+
+
+async def import_lines(db, lines, batch_size=TRANSFER_BATCH_SIZE, on_sessions_changed=None) -> dict:
+    """Import an async iterable of NDJSON lines; returns a report with throughput."""
+    started = time.perf_counter()
+    importer = Importer(db, batch_size, on_sessions_changed)
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            record = orjson.loads(line)
+            kind, data = record["type"], record.get("data")
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            raise MalformedExport(f"Line {number} is not an export record")
+        if kind == "header":
+            if (data or {}).get("version") != FORMAT_VERSION:
+                raise MalformedExport(f"Unsupported export version {(data or {}).get('version')!r}")
+        elif kind == "footer":
+            importer.complete = True
+        elif kind in SCHEMAS:
+            try:
+                await importer.add(kind, data)
+            except MalformedExport as e:
+                raise MalformedExport(f"Line {number}: {e}")
+        else:
+            raise MalformedExport(f"Line {number} has unknown type {kind!r}")
+    await importer.finish()
+    return {
+        "read": importer.read,
+        "inserted": importer.inserted,
+        "complete": importer.complete,
+        **throughput(sum(importer.read.values()), time.perf_counter() - started),
+    }
+
+
+async def _file_chunks(file, chunk_bytes=TRANSFER_CHUNK_BYTES):
+    while chunk := await asyncio.to_thread(file.read, chunk_bytes):
+        yield chunk
+
+
+async def _count_lines(lines, on_line):
+    async for line in lines:
+        on_line()
+        yield line
+
+
+async def run(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+    try:
+        if args.command == "export":
+            output = open(args.output, "wb") if args.output != "-" else sys.stdout.buffer
+            started = time.perf_counter()
+            lines = 0
+
+            def count():
+                nonlocal lines
+                lines += 1
+
+            try:
+                async for chunk in gzip_chunks(_count_lines(export_lines(db, args.batch_size), count)):
+                    await asyncio.to_thread(output.write, chunk)
+            finally:
+                if output is not sys.stdout.buffer:
+                    output.close()
+            # Header and footer are not documents
+            report = throughput(lines - 2, time.perf_counter() - started)
+        else:
+            source = open(args.input, "rb") if args.input != "-" else sys.stdin.buffer
+            try:
+                report = await import_lines(db, ndjson_lines(_file_chunks(source)), args.batch_size)
+            finally:
+                if source is not sys.stdin.buffer:
+                    source.close()
+        print(orjson.dumps(report).decode(), file=sys.stderr)
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=TRANSFER_BATCH_SIZE)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write every live session as gzipped NDJSON")
+    export.add_argument("-o", "--output", default="-", help="file to write, - for stdout")
+    load = commands.add_parser("import", help="load an export, skipping documents that already exist")
+    load.add_argument("input", help="file to read, gzipped or plain, - for stdin")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Load test and benchmark for the Mira chat backend.
+
+Starts backend/server.py with the fake LLM backend against an in-memory Mongo
+stand-in (mongomock-motor), or a real Mongo via --mongo-url, then drives
+concurrent virtual users through create session -> N chat turns -> history
+fetch -> delete. Reports requests/s and p50/p95/p99 latency per endpoint as
+JSON, and fails when results regress against a stored baseline.
+
+    python backend_benchmark.py --users 20 --iterations 5
+    python backend_benchmark.py --save-baseline      # record a new baseline
+
+Each benchmark runs --repeat times (3 by default) against a fresh server,
+and every metric reported and gated is the median across those runs, so a
+single noisy run neither fails the gate nor skews a saved baseline. Latencies
+only compare on the same machine: re-record the baseline wherever the gate
+runs.
+
+--websocket sends the chat turns over one /api/ws connection per virtual
+user instead of one HTTP request each. --hold-connections N additionally
+keeps N idle WebSocket clients connected (answering heartbeats) for the
+whole run, and reports how many the server held and its resident memory.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import statistics
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+
+try:
+    from websockets.asyncio.client import connect as websocket_connect
+except ImportError:  # only needed for --websocket / --hold-connections
+    websocket_connect = None
+
+ROOT_DIR = Path(__file__).parent
+BACKEND_DIR = ROOT_DIR / "backend"
+DEFAULT_BASELINE = ROOT_DIR / "backend_benchmark_baseline.json"
+# p99 is reported but not gated: with a few hundred samples it is one outlier
+GATED_LATENCIES = ("p50_ms", "p95_ms")
+
+
+def serve(args):
+    """Run the API in this process; used as the benchmark's server subprocess."""
+    sys.path.insert(0, str(BACKEND_DIR))
+    os.environ.setdefault("MONGO_URL", args.mongo_url or "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "mira_benchmark")
+
+    import uvicorn
+    import server
+
+    if not args.mongo_url:
+        from mongomock_motor import AsyncMongoMockClient
+
+        server.client = AsyncMongoMockClient(tz_aware=True)
+        server.db = server.client[os.environ["DB_NAME"]]
+
+    uvicorn.run(server.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, port):
+    env = dict(os.environ)
+    env.update({
+        "LLM_BACKEND": "fake",
+        "LLM_FAKE_LATENCY_MS": str(args.llm_latency_ms),
+        "LLM_FAKE_CHUNK_INTERVAL_MS": str(args.llm_chunk_interval_ms),
+        "LLM_FAKE_ERROR_RATE": str(args.llm_error_rate),
+        "LLM_FAKE_SEED": "42",
+        "MONGO_EXPLAIN_ON_STARTUP": "false",
+        # Every virtual user sends the same prompts, which would all be cache hits
+        "RESPONSE_CACHE_ENABLED": "true" if args.response_cache else "false",
+        # Benchmark sessions never reach the thresholds; skip the startup pass
+        "COMPACTION_ENABLED": "false",
+        # Every virtual user connects from the same address
+        "RATE_LIMIT_ENABLED": "false",
+    })
+    command = [sys.executable, str(Path(__file__).resolve()), "serve", "--port", str(port)]
+    if args.mongo_url:
+        command += ["--mongo-url", args.mongo_url]
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+
+async def wait_until_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            try:
+                if (await client.get(f"{base_url}/")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("Server did not become ready in time")
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def timed(self, endpoint, request, expect=200):
+        started = time.perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError:
+            self.errors[endpoint] += 1
+            return None
+        self.latencies[endpoint].append(time.perf_counter() - started)
+        if response.status_code != expect:
+            self.errors[endpoint] += 1
+            return None
+        return response
+
+    async def timed_stream(self, endpoint, client, url, payload):
+        """Record time to first delta and total time of a streamed chat turn."""
+        started = time.perf_counter()
+        first_delta = None
+        try:
+            async with client.stream("POST", url, json=payload) as response:
+                if response.status_code != 200:
+                    self.errors[endpoint] += 1
+                    return
+                async for line in response.aiter_lines():
+                    if first_delta is None and line == "event: delta":
+                        first_delta = time.perf_counter() - started
+                    if line == "event: error":
+                        self.errors[endpoint] += 1
+                        return
+        except httpx.HTTPError:
+            self.errors[endpoint] += 1
+            return
+        self.latencies[endpoint].append(time.perf_counter() - started)
+        if first_delta is not None:
+            self.latencies[f"{endpoint} (first delta)"].append(first_delta)
+
+    async def timed_websocket_turn(self, endpoint, websocket, payload, ref):
+        """Like timed_stream, for one turn sent over an open WebSocket."""
+        started = time.perf_counter()
+        first_delta = None
+        try:
+            await websocket.send(json.dumps({"type": "chat", "ref": ref, **payload}))
+            while True:
+                message = json.loads(await websocket.recv())
+                if message["type"] == "ping":
+                    await websocket.send(json.dumps({"type": "pong"}))
+                    continue
+                if message.get("ref") != ref:
+                    continue
+                if first_delta is None and message["type"] == "delta":
+                    first_delta = time.perf_counter() - started
+                if message["type"] == "error":
+                    self.errors[endpoint] += 1
+                    return
+                if message["type"] == "done":
+                    break
+        except Exception:
+            self.errors[endpoint] += 1
+            return
+        self.latencies[endpoint].append(time.perf_counter() - started)
+        if first_delta is not None:
+            self.latencies[f"{endpoint} (first delta)"].append(first_delta)
+
+
+def websocket_url(base_url):
+    return base_url.replace("http://", "ws://", 1) + "/ws"
+
+
+async def hold_connection(url, held):
+    """Keep one idle WebSocket open, answering heartbeats, until cancelled."""
+    try:
+        async with websocket_connect(url) as websocket:
+            held.add(websocket)
+            try:
+                async for raw in websocket:
+                    if json.loads(raw)["type"] == "ping":
+                        await websocket.send(json.dumps({"type": "pong"}))
+            finally:
+                held.discard(websocket)
+    except Exception:
+        # Refused or dropped; it simply does not count as held
+        pass
+
+
+def server_rss_mb(process):
+    try:
+        for line in Path(f"/proc/{process.pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+async def virtual_user(client, base_url, recorder, args):
+    if args.websocket:
+        async with websocket_connect(websocket_url(base_url)) as websocket:
+            await user_iterations(client, base_url, recorder, args, websocket)
+    else:
+        await user_iterations(client, base_url, recorder, args)
+
+
+async def user_iterations(client, base_url, recorder, args, websocket=None):
+    for _ in range(args.iterations):
+        response = await recorder.timed(
+            "POST /sessions", client.post(f"{base_url}/sessions", json={"title": "Benchmark"})
+        )
+        if response is None:
+            continue
+        session_id = response.json()["id"]
+
+        for turn in range(args.turns):
+            payload = {"session_id": session_id, "content": f"Benchmark message {turn} 💕"}
+            if websocket is not None:
+                await recorder.timed_websocket_turn("WS chat", websocket, payload, f"{session_id}:{turn}")
+            elif args.stream:
+                await recorder.timed_stream("POST /chat/stream", client, f"{base_url}/chat/stream", payload)
+            else:
+                await recorder.timed("POST /chat", client.post(f"{base_url}/chat", json=payload))
+
+        await recorder.timed(
+            "GET /sessions/{id}/messages", client.get(f"{base_url}/sessions/{session_id}/messages")
+        )
+        await recorder.timed("GET /sessions", client.get(f"{base_url}/sessions"))
+        await recorder.timed("DELETE /sessions/{id}", client.delete(f"{base_url}/sessions/{session_id}"))
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint in sorted(set(recorder.latencies) | set(recorder.errors)):
+        values = sorted(recorder.latencies[endpoint])
+        summary = {"count": len(values), "errors": recorder.errors[endpoint]}
+        if values:
+            summary.update({
+                "rps": round(len(values) / elapsed, 2),
+                "mean_ms": round(sum(values) / len(values) * 1000, 2),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            })
+        endpoints[endpoint] = summary
+    total = sum(len(values) for values in recorder.latencies.values())
+    return {"elapsed_s": round(elapsed, 3), "total_rps": round(total / elapsed, 2), "endpoints": endpoints}
+
+
+def median_results(runs):
+    """Combine repeated runs into one report holding the median of each metric."""
+    def median(values):
+        return round(statistics.median(values), 3)
+
+    endpoints = {}
+    for endpoint in sorted(set().union(*(run["endpoints"] for run in runs))):
+        summaries = [run["endpoints"].get(endpoint, {"count": 0, "errors": 0}) for run in runs]
+        combined = {
+            "count": median([summary["count"] for summary in summaries]),
+            # Errors are not noise; any run that saw one counts against the gate
+            "errors": max(summary["errors"] for summary in summaries),
+        }
+        for metric in ("rps", "mean_ms", "p50_ms", "p95_ms", "p99_ms"):
+            values = [summary[metric] for summary in summaries if metric in summary]
+            if values:
+                combined[metric] = round(statistics.median(values), 2)
+        endpoints[endpoint] = combined
+    results = {
+        "runs": len(runs),
+        "elapsed_s": median([run["elapsed_s"] for run in runs]),
+        "total_rps": round(statistics.median([run["total_rps"] for run in runs]), 2),
+        "endpoints": endpoints,
+    }
+    for key in ("connections", "config"):
+        if key in runs[-1]:
+            results[key] = runs[-1][key]
+    return results
+
+
+def compare(results, baseline, tolerance, slack_ms):
+    """Return a description of every metric that regressed beyond ``tolerance``.
+
+    Up to ``slack_ms`` is added to every latency limit so that endpoints
+    answering in a few milliseconds do not fail on scheduling noise alone. The
+    slack never exceeds the baseline value itself, so it cannot hide a
+    multiple-times slowdown of a fast endpoint.
+    """
+    regressions = []
+    for endpoint, expected in baseline["endpoints"].items():
+        actual = results["endpoints"].get(endpoint)
+        if actual is None or "p95_ms" not in actual:
+            regressions.append(f"{endpoint}: missing from this run")
+            continue
+        for metric in GATED_LATENCIES:
+            if metric not in expected:
+                continue
+            limit = expected[metric] * (1 + tolerance) + min(slack_ms, expected[metric])
+            if actual[metric] > limit:
+                regressions.append(f"{endpoint}: {metric} {actual[metric]} > baseline {expected[metric]}")
+        if "rps" in expected and actual["rps"] < expected["rps"] * (1 - tolerance):
+            regressions.append(f"{endpoint}: rps {actual['rps']} < baseline {expected['rps']}")
+        if actual["errors"] > expected.get("errors", 0):
+            regressions.append(f"{endpoint}: {actual['errors']} errors > baseline {expected.get('errors', 0)}")
+    return regressions
+
+
+async def run_load(args):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}/api"
+    process = start_server(args, port)
+    try:
+        await wait_until_ready(base_url, process)
+        held = set()
+        holders = [
+            asyncio.create_task(hold_connection(websocket_url(base_url), held))
+            for _ in range(args.hold_connections)
+        ]
+        if holders:
+            # Give the idle clients time to connect before the load starts
+            deadline = time.monotonic() + args.timeout
+            while len(held) < len(holders) and time.monotonic() < deadline:
+                if all(task.done() for task in holders):
+                    break
+                await asyncio.sleep(0.1)
+        recorder = Recorder()
+        limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+        async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*[
+                virtual_user(client, base_url, recorder, args) for _ in range(args.users)
+            ])
+            elapsed = time.perf_counter() - started
+        connections = {
+            "requested": args.hold_connections,
+            "held": len(held),
+            "server_rss_mb": server_rss_mb(process),
+        }
+        for task in holders:
+            task.cancel()
+        await asyncio.gather(*holders, return_exceptions=True)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    results = summarize(recorder, elapsed)
+    if args.hold_connections:
+        results["connections"] = connections
+    results["config"] = {
+        "users": args.users,
+        "iterations": args.iterations,
+        "turns": args.turns,
+        "stream": args.stream,
+        "llm_latency_ms": args.llm_latency_ms,
+        "mongo": "real" if args.mongo_url else "mongomock",
+    }
+    if args.response_cache:
+        results["config"]["response_cache"] = True
+    if args.websocket:
+        results["config"]["websocket"] = True
+    if args.hold_connections:
+        results["config"]["hold_connections"] = args.hold_connections
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Mira chat backend")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help=argparse.SUPPRESS)
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.add_argument("--mongo-url")
+
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=5, help="sessions per virtual user")
+    parser.add_argument("--turns", type=int, default=4, help="chat turns per session")
+    parser.add_argument("--stream", action="store_true", help="use POST /api/chat/stream for turns")
+    parser.add_argument("--websocket", action="store_true", help="send turns over /api/ws")
+    parser.add_argument("--hold-connections", type=int, default=0,
+                        help="idle WebSocket clients kept open during the run")
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument("--llm-chunk-interval-ms", type=float, default=10)
+    parser.add_argument("--llm-error-rate", type=float, default=0)
+    parser.add_argument("--response-cache", action="store_true", help="leave the reply cache enabled")
+    parser.add_argument("--mongo-url", help="use a real MongoDB instead of mongomock")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative regression against the baseline")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs to take the median of, each against a fresh server")
+    parser.add_argument("--slack-ms", type=float, default=5,
+                        help="latency slack added to every baseline limit, at most the baseline value")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args)
+        return
+    if (args.websocket or args.hold_connections) and websocket_connect is None:
+        parser.error("--websocket and --hold-connections need the 'websockets' package")
+
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    results = median_results([asyncio.run(run_load(args)) for _ in range(args.repeat)])
+    report = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(report + "\n")
+    else:
+        print(report)
+
+    if args.save_baseline:
+        Path(args.baseline).write_text(report + "\n")
+        print(f"Baseline saved to {args.baseline}", file=sys.stderr)
+        return
+
+    baseline_path = Path(args.baseline)
+    if not baseline_path.exists():
+        print(f"No baseline at {baseline_path}; skipping regression check", file=sys.stderr)
+        return
+    baseline = json.loads(baseline_path.read_text())
+    if baseline.get("config") != results["config"]:
+        print("Baseline was recorded with a different configuration; skipping regression check",
+              file=sys.stderr)
+        return
+    regressions = compare(results, baseline, args.tolerance, args.slack_ms)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Benchmark /api/search as the message corpus grows.
+
+Seeds a MongoDB database with synthetic chat sessions whose words follow a
+Zipf distribution, like real chat, then times ``search.search_messages`` (the
+query behind /api/search) for rare, medium-frequency, common and two-word
+queries at each corpus size. Needs a real MongoDB, since mongomock has no
+text indexes. Reports p50/p95/p99 latency and match counts per size as JSON,
+and fails when a gated query class is over budget at any size.
+
+Every class is gated by default. Common words are the hardest: Mongo scores
+every document matching a word before sorting on text score, so their cost
+grows with the corpus however small SEARCH_MAX_MATCHES is. That cap (and the
+``truncated`` flag) only bounds the result size, not the scoring work.
+Narrow the gate with --gate to track them without failing the run.
+
+    python backend_search_benchmark.py --sizes 10000,100000,1000000
+    python backend_search_benchmark.py --mongo-url mongodb://db:27017 --budget-ms 50
+
+The database named by --db is dropped first unless --keep is given; with
+--keep an existing corpus is reused and only topped up to each size.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+from compaction import ARCHIVE_COLLECTION  # noqa: E402
+from search import SEARCH_MAX_MATCHES, TEXT_INDEX, search_messages  # noqa: E402
+
+SYLLABLES = ["ka", "mi", "ra", "to", "nu", "shi", "ve", "lo", "pa", "zen", "ri", "mo", "chi", "el", "da", "yu"]
+MESSAGES_PER_SESSION = 200
+INSERT_BATCH = 5000
+# Band of frequency ranks, as fractions of the vocabulary, each query class
+# draws its words from, and how many words it uses
+QUERY_CLASSES = {
+    "rare": (0.25, 0.75, 1),
+    "medium": (0.01, 0.1, 1),
+    "common": (0.00025, 0.0025, 1),
+    "two_words": (0.01, 0.1, 2),
+}
+
+
+def make_vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda word: rng.random())
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Corpus:
+    def __init__(self, db, vocabulary_size, seed):
+        self.db = db
+        self.rng = random.Random(seed)
+        self.vocabulary = make_vocabulary(vocabulary_size, self.rng)
+        # Zipf weights, s slightly above 1 as in natural language
+        self.weights = [1 / (rank + 1) ** 1.07 for rank in range(vocabulary_size)]
+        self.started = datetime.now(timezone.utc) - timedelta(days=365)
+
+    async def prepare(self):
+        await self.db.chat_sessions.create_index([("id", ASCENDING)], unique=True)
+        for collection in ("chat_messages", ARCHIVE_COLLECTION):
+            keys, options = TEXT_INDEX
+            await self.db[collection].create_index(keys, **options)
+
+    def message(self, number):
+        words = self.rng.choices(self.vocabulary, self.weights, k=self.rng.randint(5, 30))
+        return {
+            "id": f"m{number:09d}",
+            "session_id": f"s{number // MESSAGES_PER_SESSION:07d}",
+            "role": "user" if number % 2 == 0 else "assistant",
+            "content": " ".join(words),
+            "timestamp": self.started + timedelta(seconds=number),
+        }
+
+    async def grow_to(self, size):
+        count = await self.db.chat_messages.estimated_document_count()
+        while count < size:
+            batch = [self.message(number) for number in range(count, min(size, count + INSERT_BATCH))]
+            await self.db.chat_messages.insert_many(batch, ordered=False)
+            sessions = sorted({message["session_id"] for message in batch})
+            for session_id in sessions:
+                await self.db.chat_sessions.update_one(
+                    {"id": session_id},
+                    {"$setOnInsert": {"id": session_id, "title": f"Chat {session_id}",
+                                      "created_at": self.started, "updated_at": self.started}},
+                    upsert=True,
+                )
+            count += len(batch)
+        return count
+
+    def queries(self, query_class, count):
+        low, high, words = QUERY_CLASSES[query_class]
+        low = int(low * len(self.vocabulary))
+        high = max(low + 1, int(high * len(self.vocabulary)))
+        return [
+            " ".join(self.vocabulary[self.rng.randrange(low, high)] for _ in range(words))
+            for _ in range(count)
+        ]
+
+
+async def time_queries(db, queries, limit):
+    latencies, sessions, truncated = [], [], 0
+    for query in queries:
+        started = time.perf_counter()
+        groups, _, was_truncated = await search_messages(db, query, limit)
+        latencies.append(time.perf_counter() - started)
+        sessions.append(len(groups))
+        truncated += was_truncated
+    latencies.sort()
+    return {
+        "queries": len(queries),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "mean_sessions": round(sum(sessions) / len(sessions), 1),
+        "truncated": truncated,
+    }
+
+
+async def run(args):
+    client = AsyncIOMotorClient(args.mongo_url, tz_aware=True)
+    if not args.keep:
+        await client.drop_database(args.db)
+    db = client[args.db]
+    corpus = Corpus(db, args.vocabulary, args.seed)
+    await corpus.prepare()
+
+    results = {
+        "config": {
+            "vocabulary": args.vocabulary,
+            "queries": args.queries,
+            "limit": args.limit,
+            "max_matches": SEARCH_MAX_MATCHES,
+            "messages_per_session": MESSAGES_PER_SESSION,
+        },
+        "sizes": {},
+    }
+    for size in args.sizes:
+        started = time.perf_counter()
+        messages = await corpus.grow_to(size)
+        seeded = time.perf_counter() - started
+        print(f"{messages} messages ({seeded:.1f}s to seed); querying", file=sys.stderr)
+        # Warm the index into cache so every size is measured the same way
+        await time_queries(db, corpus.queries("medium", 5), args.limit)
+        results["sizes"][str(size)] = {
+            query_class: await time_queries(db, corpus.queries(query_class, args.queries), args.limit)
+            for query_class in QUERY_CLASSES
+        }
+    client.close()
+    return results
+
+
+def over_budget(results, budget_ms, gated):
+    return [
+        f"{query_class} at {size} messages: p95 {classes[query_class]['p95_ms']} ms > {budget_ms} ms"
+        for size, classes in results["sizes"].items()
+        for query_class in gated
+        if classes[query_class]["p95_ms"] > budget_ms
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chat history search against corpus size")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="mira_search_benchmark")
+    parser.add_argument("--keep", action="store_true", help="reuse the corpus already in --db")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        type=lambda value: sorted(int(size) for size in value.split(",")),
+                        help="comma-separated corpus sizes, in messages")
+    parser.add_argument("--vocabulary", type=int, default=20000, help="distinct words in the corpus")
+    parser.add_argument("--queries", type=int, default=100, help="queries per class and size")
+    parser.add_argument("--limit", type=int, default=10, help="sessions per result page")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--budget-ms", type=float, default=50, help="p95 budget for gated classes")
+    parser.add_argument("--gate", default=",".join(QUERY_CLASSES),
+                        help="comma-separated query classes held to --budget-ms")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    results["config"]["budget_ms"] = args.budget_ms
+    results["config"]["gated"] = [name for name in args.gate.split(",") if name]
+    report = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(report + "\n")
+    else:
+        print(report)
+
+    failures = over_budget(results, args.budget_ms, [name for name in args.gate.split(",") if name])
+    for failure in failures:
+        print(f"OVER BUDGET {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Profile and gate the backend's cold start.
+
+Imports backend/server.py under ``python -X importtime`` and reports where
+the import time goes, grouped by top-level package, and fails if any of the
+heavy provider packages (litellm and the SDKs it pulls in) is loaded at
+import: they belong to the background warm-up. Then starts the real server
+under uvicorn several times and measures how long it takes to answer
+/api/health/live and, given --mongo-url, a /api/sessions read and
+/api/health/ready. Reports medians as JSON and fails when one is over its
+budget.
+
+    python backend_startup_profile.py
+    python backend_startup_profile.py --mongo-url mongodb://localhost:27017 --runs 10
+
+tests/test_startup.py runs the import gate and one cold start with pytest.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+
+ROOT_DIR = Path(__file__).parent
+BACKEND_DIR = ROOT_DIR / "backend"
+# Nothing listens here, so Mongo-backed startup steps just keep retrying
+UNREACHABLE_MONGO = "mongodb://127.0.0.1:9"
+# Top-level packages that must only be loaded after the server is listening
+DEFERRED_PACKAGES = (
+    "litellm", "openai", "google", "boto3", "botocore", "pandas", "numpy", "tiktoken",
+    "tokenizers", "emergentintegrations",
+)
+IMPORT_BUDGET_MS = 1000
+# Interpreter and uvicorn startup come on top of the import; ~1.3s here
+LIVE_BUDGET_MS = 2000
+SESSIONS_BUDGET_MS = 2000
+# The provider SDK loads in the background, so readiness takes longer
+READY_BUDGET_MS = 10000
+
+
+def server_env(mongo_url):
+    env = dict(os.environ)
+    env.update({
+        "MONGO_URL": mongo_url or UNREACHABLE_MONGO,
+        "DB_NAME": env.get("DB_NAME", "mira_startup_profile"),
+        # Fail fast instead of holding startup steps on server selection
+        "MONGO_SERVER_SELECTION_TIMEOUT_MS": "1000",
+        "MONGO_EXPLAIN_ON_STARTUP": "false",
+        "COMPACTION_ENABLED": "false",
+    })
+    return env
+
+
+def parse_importtime(stderr):
+    """Return ``[(module, depth, self_us, cumulative_us)]`` from -X importtime output."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        module = name.strip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((module, depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def profile_imports(env, top):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing server failed:\n{result.stderr[-2000:]}")
+    imports = parse_importtime(result.stderr)
+    by_package = defaultdict(int)
+    for module, _, self_us, _ in imports:
+        by_package[module.split(".")[0]] += self_us
+    server_us = next(cumulative for module, depth, _, cumulative in imports if module == "server" and depth == 0)
+    return {
+        "server_import_ms": round(server_us / 1000, 1),
+        "modules": len(imports),
+        "top_packages_ms": {
+            package: round(us / 1000, 1)
+            for package, us in sorted(by_package.items(), key=lambda item: -item[1])[:top]
+        },
+        "deferred_loaded": sorted({module.split(".")[0] for module, *_ in imports} & set(DEFERRED_PACKAGES)),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def first_ok(client, url, process, started, deadline):
+    """Seconds from ``started`` until ``url`` first answers 200, or None."""
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.005)
+    return None
+
+
+async def cold_start(env, with_mongo, wait):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}/api"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+    deadline = started + wait
+    try:
+        async with httpx.AsyncClient(timeout=wait) as client:
+            timings = {"live": await first_ok(client, f"{base_url}/health/live", process, started, deadline)}
+            if with_mongo:
+                timings["sessions"] = await first_ok(client, f"{base_url}/sessions?limit=1", process, started, deadline)
+                timings["ready"] = await first_ok(client, f"{base_url}/health/ready", process, started, deadline)
+    finally:
+        process.terminate()
+        process.wait()
+    return timings
+
+
+def summarize(runs):
+    summary = {}
+    for name in runs[0]:
+        values = [run[name] for run in runs]
+        if None in values:
+            summary[name] = {"median_ms": None, "max_ms": None, "timed_out": values.count(None)}
+            continue
+        summary[name] = {
+            "median_ms": round(statistics.median(values) * 1000, 1),
+            "max_ms": round(max(values) * 1000, 1),
+        }
+    return summary
+
+
+def over_budget(results, budgets):
+    failures = []
+    if results["imports"]["deferred_loaded"]:
+        failures.append(f"imported at startup: {', '.join(results['imports']['deferred_loaded'])}")
+    if results["imports"]["server_import_ms"] > budgets["import"]:
+        failures.append(f"server import {results['imports']['server_import_ms']} ms > {budgets['import']} ms")
+    for name, timing in results["cold_start"].items():
+        if timing["median_ms"] is None:
+            failures.append(f"{name}: no answer within the wait")
+        elif timing["median_ms"] > budgets[name]:
+            failures.append(f"{name}: median {timing['median_ms']} ms > {budgets[name]} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile backend imports and gate cold-start time")
+    parser.add_argument("--mongo-url", help="also time /api/sessions and readiness against this Mongo")
+    parser.add_argument("--runs", type=int, default=5, help="server starts to take the median of")
+    parser.add_argument("--top", type=int, default=15, help="packages to list in the import profile")
+    parser.add_argument("--wait", type=float, default=30, help="seconds to wait for each endpoint")
+    parser.add_argument("--import-budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument("--live-budget-ms", type=float, default=LIVE_BUDGET_MS)
+    parser.add_argument("--sessions-budget-ms", type=float, default=SESSIONS_BUDGET_MS)
+    parser.add_argument("--ready-budget-ms", type=float, default=READY_BUDGET_MS)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    env = server_env(args.mongo_url)
+    results = {"imports": profile_imports(env, args.top)}
+    runs = [asyncio.run(cold_start(env, bool(args.mongo_url), args.wait)) for _ in range(args.runs)]
+    results["cold_start"] = summarize(runs)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(report + "\n")
+    else:
+        print(report)
+
+    budgets = {
+        "import": args.import_budget_ms,
+        "live": args.live_budget_ms,
+        "sessions": args.sessions_budget_ms,
+        "ready": args.ready_budget_ms,
+    }
+    failures = over_budget(results, budgets)
+    for failure in failures:
+        print(f"OVER BUDGET {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
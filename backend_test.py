@@ -87,7 +87,7 @@ class GeminiChatbotTester:
             response = self.session.get(f"{self.base_url}/sessions")
             
             if response.status_code == 200:
-                data = response.json()
+                data = response.json().get("items")
                 if isinstance(data, list):
                     session_count = len(data)
                     self.log_test("List Sessions", True, f"Retrieved {session_count} sessions")
@@ -101,7 +101,7 @@ class GeminiChatbotTester:
                             self.log_test("Session Persistence", False, "Test session not found in session list")
                     return True
                 else:
-                    self.log_test("List Sessions", False, "Response is not a list", data)
+                    self.log_test("List Sessions", False, "Response items are not a list", data)
                     return False
             else:
                 self.log_test("List Sessions", False, f"HTTP {response.status_code}", response.text)
@@ -176,7 +176,7 @@ class GeminiChatbotTester:
             response = self.session.get(f"{self.base_url}/sessions/{self.test_session_id}/messages")
             
             if response.status_code == 200:
-                data = response.json()
+                data = response.json().get("items")
                 if isinstance(data, list):
                     message_count = len(data)
                     if message_count >= 2:  # Should have user + assistant messages
@@ -194,7 +194,7 @@ class GeminiChatbotTester:
                         self.log_test("Get Chat History", False, f"Expected at least 2 messages, got {message_count}")
                         return False
                 else:
-                    self.log_test("Get Chat History", False, "Response is not a list", data)
+                    self.log_test("Get Chat History", False, "Response items are not a list", data)
                     return False
             else:
                 self.log_test("Get Chat History", False, f"HTTP {response.status_code}", response.text)
@@ -1,27 +1,184 @@
 import React, { useState, useEffect, useRef } from "react";
 import "./App.css";
 import axios from "axios";
+import * as chatStore from "./lib/chatStore";
+import { createChatSocket } from "./lib/chatSocket";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+const PAGE_SIZE = 50;
+
+const chatSocket = createChatSocket((() => {
+  const url = new URL(`${API}/ws`, window.location.href);
+  url.protocol = url.protocol === "https:" ? "wss:" : "ws:";
+  return url.toString();
+})());
+
+// POST to the streaming chat endpoint and hand each Server-Sent Event to onEvent
+const streamChat = async (payload, onEvent) => {
+  const response = await fetch(`${API}/chat/stream`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(payload)
+  });
+  if (!response.ok) {
+    throw new Error(`Chat request failed with status ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const raw = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = "message";
+      let data = "";
+      raw.split("\n").forEach(line => {
+        if (line.startsWith("event: ")) event = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+      });
+      onEvent(event, data ? JSON.parse(data) : null);
+    }
+  }
+};
+
+// Run a chat turn over the shared WebSocket, or over HTTP streaming if the
+// socket cannot be opened. Events reach onEvent in the same shape either way.
+const sendTurn = async (payload, onEvent) => {
+  const socketReady = await chatSocket.connect().then(() => true, () => false);
+  if (!socketReady) {
+    await streamChat(payload, onEvent);
+    return;
+  }
+  await chatSocket.chat(payload, ({ type, ...data }) => {
+    onEvent(type === "ack" ? "user_message" : type, data);
+  });
+};
+
+// Merge freshly synced messages into what is on screen, by id and in time order
+const mergeMessages = (current, fresh) => {
+  const byId = new Map(current.map(m => [m.id, m]));
+  fresh.forEach(m => byId.set(m.id, m));
+  return [...byId.values()].sort((a, b) => new Date(a.timestamp) - new Date(b.timestamp));
+};
+
+// Follow a delta-sync endpoint's pages; returns the items and final watermark
+const fetchChanges = async (url, since, onPage) => {
+  let params = since ? { since } : {};
+  let watermark = since;
+  while (true) {
+    const response = await axios.get(url, { params });
+    await onPage(response.data);
+    if (response.data.watermark) watermark = response.data.watermark;
+    if (!response.data.next_cursor) return watermark;
+    params = { after: response.data.next_cursor };
+  }
+};
+
+// Split a search snippet into plain and highlighted parts. Highlight offsets
+// count characters (code points), so index into Array.from, not the string.
+const snippetParts = (snippet, highlights) => {
+  const chars = Array.from(snippet);
+  const parts = [];
+  let position = 0;
+  highlights.forEach(([start, end]) => {
+    if (start > position) parts.push({ text: chars.slice(position, start).join(""), match: false });
+    parts.push({ text: chars.slice(start, end).join(""), match: true });
+    position = end;
+  });
+  if (position < chars.length) parts.push({ text: chars.slice(position).join(""), match: false });
+  return parts;
+};
+
+// Bring the locally stored session list up to date with the server
+const syncSessions = async () => {
+  const since = await chatStore.getMeta("sessions");
+  const watermark = await fetchChanges(`${API}/sessions/sync`, since, async (page) => {
+    if (page.reset) await chatStore.clearAll();
+    await chatStore.putSessions(page.items);
+    if (page.deleted.length) await chatStore.deleteSessions(page.deleted);
+  });
+  if (watermark) await chatStore.setMeta("sessions", watermark);
+};
 
 function App() {
   const [currentSession, setCurrentSession] = useState(null);
   const [sessions, setSessions] = useState([]);
   const [messages, setMessages] = useState([]);
+  const [olderMessagesCursor, setOlderMessagesCursor] = useState(null);
   const [input, setInput] = useState("");
   const [isLoading, setIsLoading] = useState(false);
+  const [isStreaming, setIsStreaming] = useState(false);
   const [sidebarOpen, setSidebarOpen] = useState(true);
   const [isListening, setIsListening] = useState(false);
   const [speechEnabled, setSpeechEnabled] = useState(true);
+  const [searchQuery, setSearchQuery] = useState("");
+  const [searchResults, setSearchResults] = useState(null);
+  const [searchCursor, setSearchCursor] = useState(null);
   const messagesEndRef = useRef(null);
+  const messagesContainerRef = useRef(null);
+  const loadingPageRef = useRef(false);
+  const restoreScrollRef = useRef(null);
+  const activeSessionRef = useRef(null);
   const recognitionRef = useRef(null);
 
+  useEffect(() => {
+    const query = searchQuery.trim();
+    if (!query) {
+      setSearchResults(null);
+      setSearchCursor(null);
+      return;
+    }
+    // Wait for a pause in typing before searching
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const response = await axios.get(`${API}/search`, { params: { q: query } });
+        if (cancelled) return;
+        setSearchResults(response.data.items);
+        setSearchCursor(response.data.next_cursor);
+      } catch (error) {
+        console.error("Error searching messages:", error);
+      }
+    }, 250);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [searchQuery]);
+
+  const loadMoreSearchResults = async () => {
+    try {
+      const response = await axios.get(`${API}/search`, {
+        params: { q: searchQuery.trim(), cursor: searchCursor }
+      });
+      setSearchResults(prev => [...(prev || []), ...response.data.items]);
+      setSearchCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error("Error searching messages:", error);
+    }
+  };
+
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
   };
 
   useEffect(() => {
+    // Keep the viewport anchored when older messages are prepended
+    if (restoreScrollRef.current !== null) {
+      const container = messagesContainerRef.current;
+      container.scrollTop = container.scrollHeight - restoreScrollRef.current;
+      restoreScrollRef.current = null;
+      return;
+    }
     scrollToBottom();
   }, [messages]);
 
@@ -86,8 +243,10 @@ function App() {
 
   const loadSessions = async () => {
     try {
-      const response = await axios.get(`${API}/sessions`);
-      setSessions(response.data);
+      // Show the local copy straight away, then catch up with the server
+      setSessions(await chatStore.getSessions());
+      await syncSessions();
+      setSessions(await chatStore.getSessions());
     } catch (error) {
       console.error("Error loading sessions:", error);
     }
@@ -101,7 +260,13 @@ function App() {
       const newSession = response.data;
       setSessions([newSession, ...sessions]);
       setCurrentSession(newSession);
+      activeSessionRef.current = newSession.id;
       setMessages([]);
+      setOlderMessagesCursor(null);
+      await chatStore.putSessions([newSession]);
+      await chatStore.setMeta(`messages:${newSession.id}`, {
+        watermark: null, olderCursor: null, sessionUpdatedAt: newSession.updated_at
+      });
     } catch (error) {
       console.error("Error creating session:", error);
     }
@@ -109,11 +274,82 @@ function App() {
 
   const selectSession = async (session) => {
     setCurrentSession(session);
+    activeSessionRef.current = session.id;
+    const metaKey = `messages:${session.id}`;
+    try {
+      const meta = await chatStore.getMeta(metaKey);
+      if (activeSessionRef.current !== session.id) return;
+      setMessages(meta ? await chatStore.getMessages(session.id) : []);
+      setOlderMessagesCursor(meta ? meta.olderCursor : null);
+      // Nothing has happened in this session since it was last synced
+      if (meta && meta.sessionUpdatedAt === session.updated_at) return;
+
+      let fresh = [];
+      let watermark;
+      let olderCursor = meta ? meta.olderCursor : null;
+      if (!meta) {
+        // First visit: only the newest page; older ones load as the user scrolls up
+        const response = await axios.get(`${API}/sessions/${session.id}/messages`, {
+          params: { limit: PAGE_SIZE }
+        });
+        fresh = response.data.items;
+        olderCursor = response.data.next_cursor;
+        watermark = fresh.length ? fresh[fresh.length - 1].timestamp : null;
+      } else {
+        let deleted = false;
+        watermark = await fetchChanges(`${API}/sessions/${session.id}/messages/sync`, meta.watermark, (page) => {
+          deleted = deleted || page.deleted;
+          fresh = fresh.concat(page.items);
+        });
+        if (deleted) {
+          await chatStore.deleteSessions([session.id]);
+          setSessions(prev => prev.filter(s => s.id !== session.id));
+          if (activeSessionRef.current === session.id) {
+            setCurrentSession(null);
+            setMessages([]);
+          }
+          return;
+        }
+      }
+
+      await chatStore.putMessages(fresh);
+      await chatStore.setMeta(metaKey, { watermark, olderCursor, sessionUpdatedAt: session.updated_at });
+      if (activeSessionRef.current !== session.id) return;
+      setMessages(prev => mergeMessages(prev, fresh));
+      setOlderMessagesCursor(olderCursor);
+    } catch (error) {
+      console.error("Error loading messages:", error);
+    }
+  };
+
+  const loadOlderMessages = async () => {
+    if (!currentSession || !olderMessagesCursor || loadingPageRef.current) return;
+    loadingPageRef.current = true;
+    const sessionId = currentSession.id;
     try {
-      const response = await axios.get(`${API}/sessions/${session.id}/messages`);
-      setMessages(response.data);
+      const response = await axios.get(`${API}/sessions/${sessionId}/messages`, {
+        params: { limit: PAGE_SIZE, before: olderMessagesCursor }
+      });
+      const container = messagesContainerRef.current;
+      restoreScrollRef.current = container.scrollHeight - container.scrollTop;
+      setMessages(prev =>
+        prev.length && prev[0].session_id !== sessionId ? prev : [...response.data.items, ...prev]
+      );
+      setOlderMessagesCursor(response.data.next_cursor);
+      const metaKey = `messages:${sessionId}`;
+      const meta = await chatStore.getMeta(metaKey);
+      await chatStore.putMessages(response.data.items);
+      await chatStore.setMeta(metaKey, { ...meta, olderCursor: response.data.next_cursor });
     } catch (error) {
       console.error("Error loading messages:", error);
+    } finally {
+      loadingPageRef.current = false;
+    }
+  };
+
+  const handleMessagesScroll = (e) => {
+    if (e.currentTarget.scrollTop < 100) {
+      loadOlderMessages();
     }
   };
 
@@ -121,10 +357,12 @@ function App() {
     e.stopPropagation();
     try {
       await axios.delete(`${API}/sessions/${sessionId}`);
+      await chatStore.deleteSessions([sessionId]);
       setSessions(sessions.filter(s => s.id !== sessionId));
       if (currentSession?.id === sessionId) {
         setCurrentSession(null);
         setMessages([]);
+        setOlderMessagesCursor(null);
       }
     } catch (error) {
       console.error("Error deleting session:", error);
@@ -134,18 +372,31 @@ function App() {
   const sendMessage = async (e) => {
     e.preventDefault();
     if (!input.trim() || isLoading) return;
+    setInput("");
+    await deliverMessage(input);
+  };
+
+  // Send a chat turn; a failed one stays on screen, marked, so it can be retried
+  const deliverMessage = async (content, failedMessageId = null) => {
+    if (failedMessageId) {
+      setMessages(prev => prev.filter(m => m.id !== failedMessageId));
+    }
 
     let sessionToUse = currentSession;
     
     // Create new session if none exists
     if (!sessionToUse) {
       try {
-        const response = await axios.post(`${API}/sessions`, {
-          title: input.slice(0, 30) + (input.length > 30 ? "... 💕" : " 💕")
-        });
+        // The server titles the session from its first turn
+        const response = await axios.post(`${API}/sessions`, {});
         sessionToUse = response.data;
         setCurrentSession(sessionToUse);
+        activeSessionRef.current = sessionToUse.id;
         setSessions([sessionToUse, ...sessions]);
+        await chatStore.putSessions([sessionToUse]);
+        await chatStore.setMeta(`messages:${sessionToUse.id}`, {
+          watermark: null, olderCursor: null, sessionUpdatedAt: sessionToUse.updated_at
+        });
       } catch (error) {
         console.error("Error creating session:", error);
         return;
@@ -156,50 +407,81 @@ function App() {
       id: Date.now().toString(),
       session_id: sessionToUse.id,
       role: "user",
-      content: input,
+      content,
       timestamp: new Date().toISOString()
     };
 
     setMessages(prev => [...prev, userMessage]);
-    setInput("");
     setIsLoading(true);
 
+    const streamingId = `${userMessage.id}-reply`;
+
     try {
-      const response = await axios.post(`${API}/chat`, {
+      let userMessageSaved = null;
+      let assistantMessage = null;
+      let sessionFields = null;
+      let streamError = null;
+
+      await sendTurn({
         session_id: sessionToUse.id,
-        content: input
+        content
+      }, (event, data) => {
+        if (event === "delta") {
+          setIsStreaming(true);
+          setMessages(prev => {
+            const existing = prev.find(m => m.id === streamingId);
+            if (existing) {
+              return prev.map(m =>
+                m.id === streamingId ? { ...m, content: m.content + data.content } : m
+              );
+            }
+            return [...prev, {
+              id: streamingId,
+              session_id: sessionToUse.id,
+              role: "assistant",
+              content: data.content,
+              timestamp: new Date().toISOString()
+            }];
+          });
+        } else if (event === "done") {
+          userMessageSaved = data.user_message;
+          assistantMessage = data.assistant_message;
+          sessionFields = data.session;
+          setMessages(prev => [
+            ...prev.filter(m => m.id !== userMessage.id && m.id !== streamingId),
+            data.user_message,
+            assistantMessage
+          ]);
+        } else if (event === "error") {
+          streamError = new Error(data.detail);
+        }
       });
 
-      const assistantMessage = response.data.assistant_message;
-      
-      setMessages(prev => [
-        ...prev.filter(m => m.id !== userMessage.id),
-        response.data.user_message,
-        assistantMessage
-      ]);
+      if (streamError || !assistantMessage) {
+        throw streamError || new Error("Chat stream ended early");
+      }
+      await chatStore.putMessages([userMessageSaved, assistantMessage]);
 
       // Speak Mira's response
       if (speechEnabled) {
         setTimeout(() => speakMessage(assistantMessage.content), 500);
       }
 
-      // Update session title if it's still default
-      if (sessionToUse.title === "Chat with Mira 💕") {
-        const updatedTitle = input.slice(0, 30) + (input.length > 30 ? "... 💕" : " 💕");
-        setSessions(prev => 
-          prev.map(s => 
-            s.id === sessionToUse.id 
-              ? { ...s, title: updatedTitle }
-              : s
-          )
-        );
+      // Take the sidebar fields the server just set with the turn
+      if (sessionFields) {
+        setSessions(prev => prev.map(s => s.id === sessionToUse.id ? { ...s, ...sessionFields } : s));
+        await chatStore.putSessions([{ ...sessionToUse, ...sessionFields }]);
       }
 
     } catch (error) {
       console.error("Error sending message:", error);
-      setMessages(prev => prev.filter(m => m.id !== userMessage.id));
+      // The server saves nothing for a failed turn, so it is safe to send again
+      setMessages(prev => prev
+        .filter(m => m.id !== streamingId)
+        .map(m => m.id === userMessage.id ? { ...m, failed: true } : m));
     } finally {
       setIsLoading(false);
+      setIsStreaming(false);
     }
   };
 
@@ -229,10 +511,57 @@ function App() {
             </svg>
             New Chat with Mira 💕
           </button>
+          <input
+            type="search"
+            value={searchQuery}
+            onChange={(e) => setSearchQuery(e.target.value)}
+            placeholder="Search your chats..."
+            className="mt-3 w-full bg-white/10 border border-pink-400/30 rounded-xl px-4 py-2 text-sm text-white placeholder-gray-400 focus:outline-none focus:border-pink-400"
+          />
         </div>
         
         <div className="flex-1 overflow-y-auto">
-          {sessions.map((session) => (
+          {searchResults !== null && (
+            <div>
+              {searchResults.length === 0 && (
+                <div className="p-4 text-sm text-gray-400">No messages found</div>
+              )}
+              {searchResults.map((group) => (
+                <div
+                  key={group.session.id}
+                  onClick={() => {
+                    setSearchQuery("");
+                    selectSession(group.session);
+                  }}
+                  className="p-3 m-2 rounded-xl cursor-pointer transition-all duration-200 hover:bg-white/10 text-gray-300 border border-transparent hover:border-pink-400/30"
+                >
+                  <div className="truncate text-sm font-medium text-white">
+                    {group.session.title}
+                    <span className="ml-2 text-xs text-gray-400">{group.total_hits} found</span>
+                  </div>
+                  {group.hits.map((hit) => (
+                    <div key={hit.id} className="text-xs text-gray-300 mt-1 line-clamp-2">
+                      <span className="text-gray-400">{hit.role === 'assistant' ? 'Mira' : 'You'}: </span>
+                      {snippetParts(hit.snippet, hit.highlights).map((part, index) =>
+                        part.match
+                          ? <mark key={index} className="bg-pink-500/40 text-white rounded px-0.5">{part.text}</mark>
+                          : <span key={index}>{part.text}</span>
+                      )}
+                    </div>
+                  ))}
+                </div>
+              ))}
+              {searchCursor && (
+                <button
+                  onClick={loadMoreSearchResults}
+                  className="w-full p-3 text-sm text-pink-300 hover:text-pink-200"
+                >
+                  More results
+                </button>
+              )}
+            </div>
+          )}
+          {searchResults === null && sessions.map((session) => (
             <div
               key={session.id}
               onClick={() => selectSession(session)}
@@ -246,8 +575,14 @@ function App() {
                 <span className="animate-pulse">{getRandomEmoji()}</span>
                 {session.title}
               </div>
+              {session.last_message_preview && (
+                <div className="truncate text-xs text-gray-400 mt-1">
+                  {session.last_role === "user" ? "You: " : ""}{session.last_message_preview}
+                </div>
+              )}
               <div className="text-xs text-gray-400 mt-1">
                 {formatTime(session.updated_at)}
+                {session.message_count > 0 && ` · ${session.message_count} messages`}
               </div>
               <button
                 onClick={(e) => deleteSession(session.id, e)}
@@ -309,7 +644,11 @@ function App() {
         </div>
 
         {/* Messages Area */}
-        <div className="flex-1 overflow-y-auto p-6 space-y-6">
+        <div
+          ref={messagesContainerRef}
+          onScroll={handleMessagesScroll}
+          className="flex-1 overflow-y-auto p-6 space-y-6"
+        >
           {messages.length === 0 && !isLoading ? (
             <div className="text-center py-12">
               <div className="relative">
@@ -362,6 +701,15 @@ function App() {
                   </div>
                   <div className={`text-xs text-gray-300 mt-1 ${message.role === 'user' ? 'text-right mr-4' : 'ml-4'}`}>
                     {formatTime(message.timestamp)}
+                    {message.failed && (
+                      <button
+                        onClick={() => deliverMessage(message.content, message.id)}
+                        disabled={isLoading}
+                        className="ml-2 text-pink-300 hover:text-pink-200 underline disabled:opacity-50"
+                      >
+                        Not delivered, tap to retry
+                      </button>
+                    )}
                   </div>
                 </div>
 
@@ -376,7 +724,7 @@ function App() {
             ))
           )}
           
-          {isLoading && (
+          {isLoading && !isStreaming && (
             <div className="flex gap-4 justify-start animate-slide-in">
               <div className="w-10 h-10 bg-gradient-to-br from-pink-400 to-purple-600 rounded-full flex items-center justify-center flex-shrink-0 animate-pulse">
                 <span className="text-white text-sm font-bold">M</span>
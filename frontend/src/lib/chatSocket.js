@@ -0,0 +1,63 @@
+// A single WebSocket shared by every chat turn, whichever session it is for.
+// Turns are told apart by a per-connection ref; the server's heartbeat pings
+// are answered here so an idle connection stays open.
+
+export const createChatSocket = (url) => {
+  let socket = null;
+  let opening = null;
+  let nextRef = 0;
+  const pending = new Map();
+
+  const handleMessage = (ws, raw) => {
+    const message = JSON.parse(raw);
+    if (message.type === "ping") {
+      ws.send(JSON.stringify({ type: "pong" }));
+      return;
+    }
+    const turn = pending.get(message.ref);
+    if (!turn) return;
+    turn.onEvent(message);
+    if (message.type === "done" || message.type === "error") {
+      pending.delete(message.ref);
+      turn.resolve();
+    }
+  };
+
+  // Resolves once the socket is open; rejects if it cannot be opened
+  const connect = () => {
+    if (socket && socket.readyState === WebSocket.OPEN) return Promise.resolve(socket);
+    if (!opening) {
+      opening = new Promise((resolve, reject) => {
+        const ws = new WebSocket(url);
+        ws.onopen = () => {
+          socket = ws;
+          opening = null;
+          resolve(ws);
+        };
+        ws.onerror = () => {
+          opening = null;
+          reject(new Error("WebSocket connection failed"));
+        };
+        ws.onmessage = (event) => handleMessage(ws, event.data);
+        ws.onclose = () => {
+          if (socket === ws) socket = null;
+          pending.forEach(turn => turn.reject(new Error("Chat connection closed")));
+          pending.clear();
+        };
+      });
+    }
+    return opening;
+  };
+
+  // Send one chat turn; onEvent receives every frame tagged with its ref
+  const chat = async (payload, onEvent) => {
+    const ws = await connect();
+    const ref = String(++nextRef);
+    return new Promise((resolve, reject) => {
+      pending.set(ref, { onEvent, resolve, reject });
+      ws.send(JSON.stringify({ type: "chat", ref, ...payload }));
+    });
+  };
+
+  return { connect, chat };
+};
@@ -0,0 +1,105 @@
+// Local copy of sessions and messages in IndexedDB, kept current through the
+// backend's delta-sync endpoints. Every function degrades to a no-op (or an
+// empty result) where IndexedDB is unavailable, e.g. in private browsing.
+
+const DB_NAME = "mira-chat";
+const DB_VERSION = 1;
+
+let dbPromise = null;
+
+const openDb = () => {
+  if (!dbPromise) {
+    dbPromise = new Promise((resolve) => {
+      if (typeof indexedDB === "undefined") {
+        resolve(null);
+        return;
+      }
+      const request = indexedDB.open(DB_NAME, DB_VERSION);
+      request.onupgradeneeded = () => {
+        const db = request.result;
+        db.createObjectStore("sessions", { keyPath: "id" });
+        const messages = db.createObjectStore("messages", { keyPath: "id" });
+        messages.createIndex("session_id", "session_id");
+        // Sync watermarks and paging cursors, keyed by name
+        db.createObjectStore("meta");
+      };
+      request.onsuccess = () => resolve(request.result);
+      request.onerror = () => resolve(null);
+    });
+  }
+  return dbPromise;
+};
+
+const run = async (storeNames, mode, work) => {
+  const db = await openDb();
+  if (!db) return undefined;
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(storeNames, mode);
+    let result;
+    Promise.resolve(work(tx)).then(value => { result = value; });
+    tx.oncomplete = () => resolve(result);
+    tx.onerror = () => reject(tx.error);
+    tx.onabort = () => reject(tx.error);
+  });
+};
+
+const requestResult = (request) => new Promise((resolve, reject) => {
+  request.onsuccess = () => resolve(request.result);
+  request.onerror = () => reject(request.error);
+});
+
+const byTimestamp = (a, b) =>
+  a.timestamp === b.timestamp ? (a.id < b.id ? -1 : 1) : (new Date(a.timestamp) - new Date(b.timestamp));
+
+export const getSessions = async () => {
+  const sessions = await run(["sessions"], "readonly", tx =>
+    requestResult(tx.objectStore("sessions").getAll())
+  );
+  return (sessions || []).sort((a, b) => new Date(b.updated_at) - new Date(a.updated_at));
+};
+
+export const putSessions = (sessions) => run(["sessions"], "readwrite", tx => {
+  const store = tx.objectStore("sessions");
+  sessions.forEach(session => store.put(session));
+});
+
+export const deleteSessions = (sessionIds) => run(["sessions", "messages", "meta"], "readwrite", tx => {
+  const messages = tx.objectStore("messages");
+  const meta = tx.objectStore("meta");
+  sessionIds.forEach(sessionId => {
+    tx.objectStore("sessions").delete(sessionId);
+    meta.delete(`messages:${sessionId}`);
+    const cursorRequest = messages.index("session_id").openKeyCursor(IDBKeyRange.only(sessionId));
+    cursorRequest.onsuccess = () => {
+      const cursor = cursorRequest.result;
+      if (cursor) {
+        messages.delete(cursor.primaryKey);
+        cursor.continue();
+      }
+    };
+  });
+});
+
+export const getMessages = async (sessionId) => {
+  const messages = await run(["messages"], "readonly", tx =>
+    requestResult(tx.objectStore("messages").index("session_id").getAll(IDBKeyRange.only(sessionId)))
+  );
+  return (messages || []).sort(byTimestamp);
+};
+
+export const putMessages = (messages) => run(["messages"], "readwrite", tx => {
+  const store = tx.objectStore("messages");
+  messages.forEach(message => store.put(message));
+});
+
+export const getMeta = (key) => run(["meta"], "readonly", tx =>
+  requestResult(tx.objectStore("meta").get(key))
+);
+
+export const setMeta = (key, value) => run(["meta"], "readwrite", tx => {
+  tx.objectStore("meta").put(value, key);
+});
+
+export const clearAll = () => run(["sessions", "messages", "meta"], "readwrite", tx => {
+  ["sessions", "messages", "meta"].forEach(name => tx.objectStore(name).clear());
+});
@@ -0,0 +1,101 @@
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from compaction import SessionCompactor  # noqa: E402
+
+SESSION_ID = "s1"
+# 36 characters estimate at 10 tokens, so a 20 token batch folds two messages
+CONTENT = "x" * 36
+
+
+class SummaryLLM:
+    def __init__(self):
+        self.calls = 0
+
+    async def complete(self, messages, key="default"):
+        self.calls += 1
+        return f"summary {self.calls}"
+
+
+def count_only(aggregate):
+    """mongomock has no $strLenCP; size sessions by message count alone."""
+    def call(pipeline):
+        group = pipeline[-1]["$group"]
+        return aggregate(pipeline[:-1] + [{"$group": {**group, "chars": {"$sum": 0}}}])
+    return call
+
+
+async def seed(age):
+    mongo = AsyncMongoMockClient(tz_aware=True)["test"]
+    # Hold on to the collections so the patched method sticks
+    db = SimpleNamespace(chat_messages=mongo.chat_messages, chat_sessions=mongo.chat_sessions)
+    db.chat_messages.aggregate = count_only(db.chat_messages.aggregate)
+    now = datetime.now(timezone.utc)
+    await db.chat_sessions.insert_one({"id": SESSION_ID, "updated_at": now, "deleted_at": None})
+    await db.chat_messages.insert_many([
+        {"id": f"m{i:02d}", "session_id": SESSION_ID, "role": "user", "content": CONTENT,
+         "timestamp": now - timedelta(seconds=age) + timedelta(milliseconds=i)}
+        for i in range(10)
+    ])
+    return db
+
+
+def compactor(llm, **options):
+    return SessionCompactor(llm, enabled=True, message_threshold=4, keep_messages=2,
+                            input_tokens=20, retention="keep", **{"min_age": 0, **options})
+
+
+async def pending(db):
+    session = await db.chat_sessions.find_one({"id": SESSION_ID})
+    return session.get("compaction_pending", False)
+
+
+async def compacted(session_id):
+    pass
+
+
+def test_session_left_over_threshold_is_rescanned_until_under_it():
+    async def run():
+        db = await seed(age=60)
+        llm = SummaryLLM()
+        worker = compactor(llm)
+
+        # Each pass folds two messages; ten need three passes to drop to four
+        for expected_calls, still_pending in [(1, True), (2, True), (3, False)]:
+            await worker.compact_all(db, compacted)
+            assert llm.calls == expected_calls
+            assert await pending(db) is still_pending
+
+        # Nothing changed since, so the session is not looked at again
+        await worker.compact_all(db, compacted)
+        assert llm.calls == 3
+        session = await db.chat_sessions.find_one({"id": SESSION_ID})
+        assert session["summary"] == "summary 3"
+        assert session["summary_until"]["id"] == "m05"
+
+    asyncio.run(run())
+
+
+def test_session_with_messages_too_young_to_fold_is_rescanned():
+    async def run():
+        db = await seed(age=60)
+        llm = SummaryLLM()
+        worker = compactor(llm, min_age=3600)
+
+        await worker.compact_all(db, compacted)
+        await worker.compact_all(db, compacted)
+        assert llm.calls == 0 and await pending(db) is True
+
+        # Once the messages are old enough the next pass picks the session up
+        worker.min_age = 0
+        await worker.compact_all(db, compacted)
+        assert llm.calls == 1
+
+    asyncio.run(run())
@@ -0,0 +1,173 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from llm import LLM_HEDGE_MIN_SAMPLES, CircuitBreaker, LLMClient, LLMUnavailable  # noqa: E402
+
+
+class ProviderError(Exception):
+    pass
+
+
+class ScriptedBackend:
+    """A backend whose replies come from ``script(call_number)``."""
+    name = "scripted"
+    configured = True
+    transient_errors = (ProviderError,)
+
+    def __init__(self, script):
+        self.script = script
+        self.calls = 0
+        self.closed = []
+
+    async def warm_up(self):
+        pass
+
+    async def complete(self, messages):
+        self.calls += 1
+        return await self.script(self.calls)
+
+    async def stream(self, messages):
+        self.calls += 1
+        call = self.calls
+        try:
+            yield await self.script(call)
+        finally:
+            self.closed.append(call)
+
+
+async def reply(call):
+    return f"reply {call}"
+
+
+async def provider_down(call):
+    raise ProviderError("503")
+
+
+def test_queued_calls_take_turns_across_callers():
+    async def run():
+        client = LLMClient(ScriptedBackend(reply), max_concurrency=1, max_queue=10)
+        order = []
+
+        async def call(key, name):
+            async with client.slot(key):
+                order.append(name)
+
+        async with client.slot("a"):
+            # One chatty caller queues three calls before another queues one
+            tasks = [asyncio.create_task(call("a", f"a{i}")) for i in range(3)]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.create_task(call("b", "b0")))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert order == ["a0", "b0", "a1", "a2"]
+        assert client.active == 0 and client.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_breaker_opens_then_lets_one_trial_through_after_the_cooldown():
+    async def run():
+        backend = ScriptedBackend(provider_down)
+        breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+        client = LLMClient(backend, max_retries=0, breaker=breaker)
+        for _ in range(2):
+            with pytest.raises(ProviderError):
+                await client.complete([])
+        assert breaker.state == "open"
+
+        with pytest.raises(LLMUnavailable):
+            await client.complete([])
+        assert backend.calls == 2 and breaker.short_circuited == 1
+
+        await asyncio.sleep(0.06)
+        assert breaker.state == "half_open"
+        # A failed trial reopens the breaker straight away
+        with pytest.raises(ProviderError):
+            await client.complete([])
+        assert breaker.state == "open" and backend.calls == 3
+
+        await asyncio.sleep(0.06)
+        backend.script = reply
+        assert await client.complete([]) == "reply 4"
+        assert breaker.state == "closed" and breaker.trips == 1
+
+    asyncio.run(run())
+
+
+def hedged_client(backend):
+    client = LLMClient(backend, hedge=True)
+    # Known latencies put the hedging threshold at 10ms
+    for kind in ("complete", "first_token"):
+        client._latencies[kind].extend([0.01] * LLM_HEDGE_MIN_SAMPLES)
+    return client
+
+
+def test_hedge_wins_when_the_first_attempt_stalls():
+    async def run():
+        cancelled = []
+
+        async def script(call):
+            try:
+                await asyncio.sleep(5 if call == 1 else 0)
+            except asyncio.CancelledError:
+                cancelled.append(call)
+                raise
+            return f"reply {call}"
+
+        client = hedged_client(ScriptedBackend(script))
+        assert await asyncio.wait_for(client.complete([]), 1) == "reply 2"
+        assert client.hedges == 1 and client.hedge_wins == 1
+        assert cancelled == [1]
+        # The hedge's extra slot went back
+        assert client._free == client.max_concurrency
+
+    asyncio.run(run())
+
+
+def test_losing_hedged_stream_is_closed():
+    async def run():
+        both_started = asyncio.Event()
+
+        async def script(call):
+            if call == 2:
+                both_started.set()
+            # Both attempts open on the same tick, so one has to be discarded
+            await both_started.wait()
+            return f"token {call}"
+
+        backend = ScriptedBackend(script)
+        client = hedged_client(backend)
+        deltas = [delta async for delta in client.stream([])]
+        # Either may win the tie; the other must not be left open
+        assert deltas in (["token 1"], ["token 2"])
+        assert client.hedges == 1
+        assert sorted(backend.closed) == [1, 2]
+
+    asyncio.run(run())
+
+
+def test_cancelled_caller_stops_the_pending_attempt():
+    async def run():
+        started = asyncio.Event()
+
+        async def script(call):
+            started.set()
+            await asyncio.sleep(5)
+
+        backend = ScriptedBackend(script)
+        client = hedged_client(backend)
+        deltas = client.stream([])
+        caller = asyncio.create_task(deltas.__anext__())
+        await started.wait()
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        assert backend.closed == [1]
+        assert client.active == 0 and client.breaker.state == "closed"
+
+    asyncio.run(run())
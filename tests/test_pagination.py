@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+
+import server  # noqa: E402
+
+# Without the lifespan the app never connects; requests use this stand-in
+server.db = AsyncMongoMockClient(tz_aware=True)["test"]
+api = TestClient(server.app)
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def add_session(session_id, updated_at=START, **fields):
+    doc = {"id": session_id, "title": session_id, "created_at": START, "updated_at": updated_at,
+           "deleted_at": None, **fields}
+    run(server.db.chat_sessions.insert_one(doc))
+
+
+def message(session_id, index, timestamp):
+    return {"id": f"m{index}", "session_id": session_id, "role": "user",
+            "content": f"message {index}", "timestamp": timestamp}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def walk(url, direction, cursor=None, limit=3):
+    """Follow cursors from ``cursor`` until exhausted; returns the pages' ids."""
+    pages = []
+    while True:
+        params = {"limit": limit}
+        if cursor:
+            params[direction] = cursor
+        response = api.get(url, params=params)
+        assert response.status_code == 200, response.text
+        body = response.json()
+        pages.append([item["id"] for item in body["items"]])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def test_message_history_pages_back_through_equal_timestamps():
+    add_session("history")
+    # m2..m4 share a timestamp, so only the id tells them apart
+    stamps = [START, START + timedelta(seconds=1)] + [START + timedelta(seconds=2)] * 3 \
+        + [START + timedelta(seconds=3), START + timedelta(seconds=4)]
+    run(server.db.chat_messages.insert_many([message("history", i, t) for i, t in enumerate(stamps)]))
+
+    pages = walk("/api/sessions/history/messages", "before")
+    assert pages == [["m4", "m5", "m6"], ["m1", "m2", "m3"], ["m0"]]
+
+
+def test_message_history_pages_forward_after_a_cursor():
+    add_session("forward")
+    messages = [message("forward", i, START + timedelta(seconds=i // 2)) for i in range(6)]
+    run(server.db.chat_messages.insert_many(messages))
+    oldest = server.encode_cursor(messages[0], "timestamp")
+
+    assert walk("/api/sessions/forward/messages", "after", oldest, limit=2) == [
+        ["m1", "m2"], ["m3", "m4"], ["m5"]
+    ]
+
+
+def test_session_list_pages_newest_first_without_gaps():
+    for i in range(5):
+        add_session(f"list{i}", updated_at=START + timedelta(days=30, seconds=i // 2))
+
+    ids = [session_id for page in walk("/api/sessions", "before", limit=2) for session_id in page]
+    listed = [session_id for session_id in ids if session_id.startswith("list")]
+    assert listed == ["list4", "list3", "list2", "list1", "list0"]
+
+
+def test_bad_cursors_are_rejected():
+    add_session("cursors")
+    url = "/api/sessions/cursors/messages"
+    assert api.get(url, params={"before": "not-a-cursor"}).status_code == 400
+    cursor = server.encode_cursor({"timestamp": START, "id": "m0"}, "timestamp")
+    assert api.get(url, params={"before": cursor, "after": cursor}).status_code == 400
+
+
+def test_history_continues_into_the_archive_after_a_full_hot_page():
+    add_session("compacted", summary="earlier chat", summary_until={"timestamp": START, "id": "m2"})
+    messages = [message("compacted", i, START + timedelta(seconds=i)) for i in range(9)]
+    run(server.db[server.ARCHIVE_COLLECTION].insert_many(messages[:3]))
+    run(server.db.chat_messages.insert_many(messages[3:]))
+
+    # The second page takes exactly the rest of the hot history
+    assert walk("/api/sessions/compacted/messages", "before") == [
+        ["m6", "m7", "m8"], ["m3", "m4", "m5"], ["m0", "m1", "m2"]
+    ]
+    # A short hot page is topped up from the archive
+    assert walk("/api/sessions/compacted/messages", "before", limit=4) == [
+        ["m5", "m6", "m7", "m8"], ["m1", "m2", "m3", "m4"], ["m0"]
+    ]
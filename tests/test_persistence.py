@@ -0,0 +1,200 @@
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from persistence import Turn, TurnWriter, rollback_turn, write_turn  # noqa: E402
+from session_fields import DEFAULT_SESSION_TITLE, last_message_fields, turn_title  # noqa: E402
+
+SESSION_ID = "s1"
+
+
+def make_turn():
+    messages = [
+        {"id": "u1", "session_id": SESSION_ID, "role": "user", "content": "hi"},
+        {"id": "a1", "session_id": SESSION_ID, "role": "assistant", "content": "hello"},
+    ]
+    return Turn(session_id=SESSION_ID, messages=messages)
+
+
+def delayed(method, delay):
+    """Slow down the first call only, so the rollback's own writes are prompt."""
+    calls = []
+
+    async def call(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            await asyncio.sleep(delay)
+        return await method(*args, **kwargs)
+    return call
+
+
+async def failing(*args, **kwargs):
+    raise RuntimeError("write failed")
+
+
+async def save_with(patch):
+    mongo = AsyncMongoMockClient()["test"]
+    # Hold on to the collections so the patched methods stick
+    db = SimpleNamespace(chat_messages=mongo.chat_messages, chat_sessions=mongo.chat_sessions)
+    await db.chat_sessions.insert_one({"id": SESSION_ID, "message_count": 0})
+    patch(db)
+    with pytest.raises(RuntimeError):
+        await TurnWriter(write_behind=False).save(db, make_turn())
+    # Let any write the rollback did not wait for land before checking
+    await asyncio.sleep(0.1)
+    return db
+
+
+def test_failed_insert_is_rolled_back_after_slow_session_update():
+    def patch(db):
+        db.chat_messages.insert_many = failing
+        db.chat_sessions.update_one = delayed(db.chat_sessions.update_one, 0.02)
+
+    async def run():
+        db = await save_with(patch)
+        session = await db.chat_sessions.find_one({"id": SESSION_ID})
+        assert session["message_count"] == 0
+        assert session.get("recent_turn_ids", []) == []
+
+    asyncio.run(run())
+
+
+def test_failed_session_update_rolls_back_slow_insert():
+    def patch(db):
+        db.chat_messages.insert_many = delayed(db.chat_messages.insert_many, 0.02)
+        db.chat_sessions.update_one = failing
+
+    async def run():
+        db = await save_with(patch)
+        assert await db.chat_messages.count_documents({"session_id": SESSION_ID}) == 0
+
+    asyncio.run(run())
+
+
+def sidebar_turn(number, text):
+    messages = [
+        {"id": f"u{number}", "session_id": SESSION_ID, "role": "user", "content": text, "timestamp": number},
+        {"id": f"a{number}", "session_id": SESSION_ID, "role": "assistant", "content": f"re: {text}",
+         "timestamp": number + 0.5},
+    ]
+    return Turn(
+        session_id=SESSION_ID, messages=messages,
+        session_set=last_message_fields(messages[-1]), title=turn_title(messages),
+    )
+
+
+def test_title_is_only_taken_from_the_first_turn():
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        await db.chat_sessions.insert_one({"id": SESSION_ID, "title": DEFAULT_SESSION_TITLE})
+        await write_turn(db, sidebar_turn(1, "first"))
+        await write_turn(db, sidebar_turn(2, "second"))
+        session = await db.chat_sessions.find_one({"id": SESSION_ID})
+        assert session["title"] == "first 💕"
+        assert session["message_count"] == 4
+
+    asyncio.run(run())
+
+
+def test_rollback_restores_sidebar_fields():
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        await db.chat_sessions.insert_one({"id": SESSION_ID, "title": DEFAULT_SESSION_TITLE})
+        first = sidebar_turn(1, "first")
+        await write_turn(db, first)
+        second = sidebar_turn(2, "second")
+        await write_turn(db, second)
+        await rollback_turn(db, second)
+        session = await db.chat_sessions.find_one({"id": SESSION_ID})
+        assert session["last_message_preview"] == "re: first"
+        assert session["message_count"] == 2
+
+        await rollback_turn(db, first)
+        session = await db.chat_sessions.find_one({"id": SESSION_ID})
+        assert session["title"] == DEFAULT_SESSION_TITLE
+        assert "last_message_at" not in session
+
+    asyncio.run(run())
+
+
+def test_write_behind_turn_survives_a_crash(tmp_path):
+    async def run():
+        down = SimpleNamespace(chat_messages=SimpleNamespace(insert_many=failing),
+                               chat_sessions=SimpleNamespace(update_one=failing))
+        crashed = TurnWriter(write_behind=True, outbox_dir=tmp_path)
+        crashed.start(down)
+        await crashed.save(down, make_turn())
+        # Die without flushing: the worker stops and the outbox lock is released
+        crashed._worker.cancel()
+        crashed.outbox._file.close()
+
+        db = AsyncMongoMockClient()["test"]
+        await db.chat_sessions.insert_one({"id": SESSION_ID, "message_count": 0})
+        writer = TurnWriter(write_behind=True, outbox_dir=tmp_path)
+        writer.start(db)
+        await writer.close()
+        assert writer.recovered == 1
+        assert await db.chat_messages.count_documents({"session_id": SESSION_ID}) == 2
+        assert (await db.chat_sessions.find_one({"id": SESSION_ID}))["message_count"] == 2
+        assert list(tmp_path.iterdir()) == []
+
+    asyncio.run(run())
+
+
+def test_write_behind_keeps_retrying_instead_of_dropping(tmp_path):
+    async def run():
+        mongo = AsyncMongoMockClient()["test"]
+        db = SimpleNamespace(chat_messages=mongo.chat_messages, chat_sessions=mongo.chat_sessions)
+        await db.chat_sessions.insert_one({"id": SESSION_ID, "message_count": 0})
+        insert_many, failures = db.chat_messages.insert_many, []
+
+        async def flaky(*args, **kwargs):
+            if len(failures) < 3:
+                failures.append(1)
+                raise RuntimeError("primary stepped down")
+            return await insert_many(*args, **kwargs)
+        db.chat_messages.insert_many = flaky
+
+        writer = TurnWriter(write_behind=True, max_retries=1, outbox_dir=tmp_path)
+        writer.start(db)
+        await writer.save(db, make_turn())
+        await writer.close()
+        assert writer.rolled_back == 0
+        assert await db.chat_messages.count_documents({"session_id": SESSION_ID}) == 2
+
+    asyncio.run(run())
+
+
+def test_other_workers_outbox_is_left_alone_while_it_runs(tmp_path):
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        running = TurnWriter(write_behind=True, outbox_dir=tmp_path)
+        running.start(db)
+        starting = TurnWriter(write_behind=True, outbox_dir=tmp_path)
+        starting.start(db)
+        assert running.outbox.path.exists()
+        await running.close()
+        await starting.close()
+
+    asyncio.run(run())
+
+
+def test_turn_is_stamped_with_its_write_time():
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        await db.chat_sessions.insert_one({"id": SESSION_ID})
+        turn = make_turn()
+        await write_turn(db, turn)
+        saved = await db.chat_messages.find({"session_id": SESSION_ID}).to_list(None)
+        session = await db.chat_sessions.find_one({"id": SESSION_ID})
+        assert {message["saved_at"] for message in saved} == {session["updated_at"]}
+        # The caller's copies, which the session cache keeps, are left alone
+        assert all("saved_at" not in message for message in turn.messages)
+
+    asyncio.run(run())
@@ -0,0 +1,60 @@
+import asyncio
+import sys
+from pathlib import Path
+
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from purge import SessionPurger  # noqa: E402
+
+
+async def seed(db):
+    await db.chat_sessions.insert_many([
+        {"id": "live"},
+        {"id": "deleted", "deleted_at": 1},
+    ])
+    await db.chat_messages.insert_many([
+        {"id": f"{session_id}-{n}", "session_id": session_id}
+        for session_id in ("live", "deleted", "gone-a", "gone-b")
+        for n in range(3)
+    ])
+
+
+def test_sweep_finds_messages_of_missing_and_deleted_sessions():
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        await seed(db)
+        # Small batches, so the walk has to continue across several of them
+        purger = SessionPurger(batch_size=1, batch_pause=0)
+        orphans = [session_id async for session_id in purger._orphaned_sessions(db)]
+        assert orphans == ["deleted", "gone-a", "gone-b"]
+
+        for session_id in orphans:
+            await purger.purge(db, session_id)
+        assert await db.chat_messages.distinct("session_id") == ["live"]
+
+    asyncio.run(run())
+
+
+def test_only_one_worker_takes_the_sweep_lease():
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        workers = [SessionPurger(sweep_interval=3600) for _ in range(3)]
+        taken = [await worker.take_sweep_lease(db) for worker in workers]
+        assert taken == [True, False, False]
+
+    asyncio.run(run())
+
+
+def test_expired_sweep_lease_is_taken_over():
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        first, second = SessionPurger(sweep_interval=0.01), SessionPurger(sweep_interval=0.01)
+        assert await first.take_sweep_lease(db)
+        await asyncio.sleep(0.05)
+        assert await second.take_sweep_lease(db)
+        lease = await db.leases.find_one({"_id": "purge_sweep"})
+        assert lease["owner"] == second.worker_id
+
+    asyncio.run(run())
@@ -0,0 +1,107 @@
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from ratelimit import MemoryBuckets, RateLimited, RateLimiter, TrustedProxies  # noqa: E402
+
+
+def connection(peer, forwarded=None):
+    headers = {"x-forwarded-for": forwarded} if forwarded else {}
+    return SimpleNamespace(client=SimpleNamespace(host=peer), headers=headers)
+
+
+def test_forwarded_header_is_ignored_without_trusted_proxies():
+    proxies = TrustedProxies("")
+    assert proxies.client(connection("10.0.0.5", "203.0.113.7")) == "10.0.0.5"
+
+
+def test_client_behind_a_trusted_proxy_is_told_apart():
+    proxies = TrustedProxies("10.0.0.0/8")
+    assert proxies.client(connection("10.0.0.5", "203.0.113.7")) == "203.0.113.7"
+    assert proxies.client(connection("10.0.0.5", "198.51.100.2")) == "198.51.100.2"
+
+
+def test_spoofed_hops_before_the_proxies_are_skipped():
+    proxies = TrustedProxies("10.0.0.0/8, 192.168.1.1")
+    # The client made up the first hop; the proxies appended the real ones
+    forwarded = "1.2.3.4, 203.0.113.7, 192.168.1.1"
+    assert proxies.client(connection("10.0.0.5", forwarded)) == "203.0.113.7"
+
+
+def test_untrusted_peer_cannot_pick_its_own_identity():
+    proxies = TrustedProxies("10.0.0.0/8")
+    assert proxies.client(connection("203.0.113.7", "1.2.3.4")) == "203.0.113.7"
+
+
+def test_bucket_allows_a_burst_then_refills_at_its_rate():
+    async def run():
+        buckets = MemoryBuckets()
+        # 20 tokens a second: one comes back every 50ms
+        assert [(await buckets.take(None, "k", 20, 2))[0] for _ in range(3)] == [True, True, False]
+        await asyncio.sleep(0.06)
+        assert (await buckets.take(None, "k", 20, 2))[0] is True
+        assert (await buckets.take(None, "k", 20, 2))[0] is False
+        # Other keys have buckets of their own
+        assert (await buckets.take(None, "other", 20, 2))[0] is True
+
+    asyncio.run(run())
+
+
+def test_idle_buckets_are_evicted_beyond_the_key_limit():
+    async def run():
+        buckets = MemoryBuckets(max_keys=2)
+        for key in ("a", "b", "c"):
+            await buckets.take(None, key, 1, 1)
+        assert len(buckets) == 2
+        # "a" was forgotten, so it starts from a full bucket again
+        assert (await buckets.take(None, "a", 1, 1))[0] is True
+
+    asyncio.run(run())
+
+
+def test_busy_session_is_limited_apart_from_its_client():
+    async def run():
+        limiter = RateLimiter(enabled=True, use_mongo=False, client_rate=1, client_burst=10,
+                              session_rate=0.5, session_burst=2)
+        await limiter.check(None, "alice", "s1")
+        await limiter.check(None, "alice", "s1")
+        with pytest.raises(RateLimited) as limited:
+            await limiter.check(None, "alice", "s1")
+        assert limited.value.scope == "session" and limited.value.retry_after == 2
+        # The same client can still talk in another session
+        await limiter.check(None, "alice", "s2")
+        assert limiter.allowed == 3 and limiter.limited == {"client": 0, "session": 1}
+
+    asyncio.run(run())
+
+
+def test_client_bucket_spans_its_sessions():
+    async def run():
+        limiter = RateLimiter(enabled=True, use_mongo=False, client_rate=0.1, client_burst=2,
+                              session_rate=1, session_burst=10)
+        await limiter.check(None, "bob", "s1")
+        await limiter.check(None, "bob", "s2")
+        with pytest.raises(RateLimited) as limited:
+            await limiter.check(None, "bob", "s3")
+        assert limited.value.scope == "client" and limited.value.retry_after == 10
+
+    asyncio.run(run())
+
+
+def test_unreachable_bucket_store_lets_turns_through():
+    class BrokenBuckets:
+        async def take(self, db, key, rate, burst):
+            raise ConnectionError("bucket store unreachable")
+
+    async def run():
+        limiter = RateLimiter(enabled=True, use_mongo=False)
+        limiter.buckets = BrokenBuckets()
+        await limiter.check(None, "carol", "s1")
+        assert limiter.errors == 1 and limiter.allowed == 0
+
+    asyncio.run(run())
@@ -0,0 +1,51 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from context import build_context  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+
+PERSONA = {"role": "system", "content": "You are Mira."}
+
+
+def history(*contents):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": c} for i, c in enumerate(contents)]
+
+
+def reply_for(cache, messages):
+    return asyncio.run(cache.lookup(None, "persona", messages)).reply
+
+
+def remember(cache, messages, reply):
+    async def run():
+        probe = await cache.lookup(None, "persona", messages)
+        await cache.store(None, probe, reply)
+    asyncio.run(run())
+
+
+def new_cache():
+    return ResponseCache(enabled=True, use_mongo=False)
+
+
+def test_identical_prompt_is_served_from_the_cache():
+    cache = new_cache()
+    remember(cache, build_context([], PERSONA, "Hi Mira!"), "Hello!")
+    assert reply_for(cache, build_context([], PERSONA, "hi mira")) == "Hello!"
+
+
+def test_earlier_history_is_part_of_the_key():
+    cache = new_cache()
+    shared_tail = ("how are you", "great")
+    remember(cache, build_context(history("my name is Ana", "nice to meet you, Ana", *shared_tail), PERSONA,
+                                  "what's my name?"), "Ana!")
+    other = build_context(history("my name is Bo", "hi Bo", *shared_tail), PERSONA, "what's my name?")
+    assert reply_for(cache, other) is None
+
+
+def test_session_summary_is_part_of_the_key():
+    cache = new_cache()
+    remember(cache, build_context([], PERSONA, "remind me", "The user is called Ana."), "You're Ana!")
+    assert reply_for(cache, build_context([], PERSONA, "remind me", "The user is called Bo.")) is None
+    assert reply_for(cache, build_context([], PERSONA, "remind me")) is None
@@ -0,0 +1,37 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend_startup_profile import (  # noqa: E402
+    IMPORT_BUDGET_MS, LIVE_BUDGET_MS, cold_start, profile_imports, server_env,
+)
+
+# A timing over budget is retried, so one slow run on a busy machine does not fail
+ATTEMPTS = 3
+
+
+def test_server_import_defers_the_provider_sdks():
+    imports = profile_imports(server_env(None), top=0)
+    assert imports["deferred_loaded"] == []
+
+
+def test_server_import_is_within_budget():
+    timings = []
+    for _ in range(ATTEMPTS):
+        timings.append(profile_imports(server_env(None), top=0)["server_import_ms"])
+        if timings[-1] <= IMPORT_BUDGET_MS:
+            break
+    assert min(timings) <= IMPORT_BUDGET_MS, f"server import took {timings} ms"
+
+
+def test_server_answers_liveness_within_budget():
+    timings = []
+    for _ in range(ATTEMPTS):
+        live = asyncio.run(cold_start(server_env(None), with_mongo=False, wait=30))["live"]
+        assert live is not None, "server never answered /api/health/live"
+        timings.append(round(live * 1000, 1))
+        if timings[-1] <= LIVE_BUDGET_MS:
+            break
+    assert min(timings) <= LIVE_BUDGET_MS, f"liveness took {timings} ms"
@@ -0,0 +1,139 @@
+import asyncio
+import sys
+import tracemalloc
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import orjson
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from transfer import (  # noqa: E402
+    FORMAT_VERSION, Importer, MalformedExport, gzip_chunks, import_lines, ndjson_lines, validate,
+)
+
+SESSION = {
+    "id": "s1", "title": "Chat", "created_at": "2026-01-01T00:00:00Z", "updated_at": "2026-01-01T00:10:00Z",
+}
+
+
+def message(number, **fields):
+    return {
+        "id": f"m{number}", "session_id": "s1", "role": "user" if number % 2 else "assistant",
+        "content": f"message {number}", "timestamp": f"2026-01-01T00:00:{number:02d}Z", **fields,
+    }
+
+
+def record(kind, data=None):
+    return orjson.dumps({"type": kind, "data": data})
+
+
+async def lines_of(records):
+    for line in records:
+        yield line
+
+
+def test_session_is_written_before_its_first_message_batch():
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        importer = Importer(db, batch_size=2)
+        await importer.add("session", dict(SESSION))
+        await importer.add("message", message(1))
+        await importer.add("message", message(2))
+        # The message batch is full and flushed; its session must exist by now
+        assert await db.chat_messages.count_documents({"session_id": "s1"}) == 2
+        assert await db.chat_sessions.find_one({"id": "s1"}) is not None
+
+    asyncio.run(run())
+
+
+def test_interrupted_import_never_leaves_orphaned_messages():
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        records = [record("header", {"version": FORMAT_VERSION}), record("session", SESSION)]
+        records += [record("message", message(n)) for n in range(1, 4)]
+        records.append(b"not json")
+        with pytest.raises(MalformedExport):
+            await import_lines(db, lines_of(records), batch_size=2)
+        assert await db.chat_messages.count_documents({}) == 2
+        assert await db.chat_sessions.count_documents({"id": "s1"}) == 1
+
+    asyncio.run(run())
+
+
+def gzipped(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+async def collect(lines):
+    return [line async for line in lines]
+
+
+@pytest.mark.parametrize("kind, doc, error", [
+    ("session", {**SESSION, "title": None}, "session without title"),
+    ("session", {**SESSION, "created_at": "yesterday"}, "created_at: 'yesterday' is not a date"),
+    ("session", {**SESSION, "message_count": True}, "message_count must be an integer"),
+    ("session", {**SESSION, "summary_until": {"id": "m1"}}, "summary_until needs an id and a timestamp"),
+    ("message", message(1, role="system"), "role must be one of user, assistant"),
+    ("message", message(1, content=["hi"]), "content must be a string"),
+    ("archived_message", ["not", "a", "message"], "archived_message is not an object"),
+])
+def test_malformed_documents_are_refused(kind, doc, error):
+    with pytest.raises(MalformedExport, match=error):
+        validate(kind, doc)
+
+
+def test_valid_documents_get_their_dates_back():
+    doc = validate("session", {**SESSION, "summary_until": {"id": "m1", "timestamp": "2026-01-01T00:00:01Z"}})
+    assert isinstance(doc["created_at"], datetime) and doc["created_at"].tzinfo is not None
+    assert isinstance(doc["summary_until"]["timestamp"], datetime)
+
+
+def test_import_names_the_line_of_a_bad_document():
+    async def run():
+        db = AsyncMongoMockClient()["test"]
+        records = [record("header", {"version": FORMAT_VERSION}), record("session", SESSION),
+                   record("message", message(1, role="system"))]
+        with pytest.raises(MalformedExport, match="Line 3: role"):
+            await import_lines(db, lines_of(records))
+        assert await db.chat_messages.count_documents({}) == 0
+
+    asyncio.run(run())
+
+
+def test_gzipped_export_reads_back_line_by_line():
+    async def run():
+        records = [record("message", message(n % 60)) for n in range(2000)]
+        chunks = gzip_chunks(lines_of([line + b"\n" for line in records]), chunk_bytes=1024)
+        assert await collect(ndjson_lines(chunks, chunk_bytes=1024)) == records
+
+    asyncio.run(run())
+
+
+def test_truncated_gzip_is_refused():
+    async def run():
+        data = gzipped(b"".join(record("message", message(n)) + b"\n" for n in range(50)))
+        with pytest.raises(MalformedExport, match="Truncated"):
+            await collect(ndjson_lines(lines_of([data[:len(data) // 2]])))
+
+    asyncio.run(run())
+
+
+def test_gzip_bomb_is_refused_without_inflating_it():
+    async def run():
+        # About 100KB that would inflate to 100MB of one endless line
+        bomb = gzipped(bytes(100 * 1024 * 1024))
+        tracemalloc.start()
+        try:
+            with pytest.raises(MalformedExport, match="Line longer than"):
+                await collect(ndjson_lines(lines_of([bomb]), max_line_bytes=1024 * 1024, chunk_bytes=64 * 1024))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert peak < 8 * 1024 * 1024
+
+    asyncio.run(run())